@@ -0,0 +1,410 @@
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from PIL import Image
+
+import mapviewer
+
+
+# =========================
+# تنظیمات
+# =========================
+HISTORY_SIZES = (10, 100, 1_000, 10_000, 100_000)
+ROUTE_SIZES = (1_000, 10_000, 100_000)  # تعداد نقاط هندسه برای draw_route
+STUB_ROUTE_POINTS = 500  # تعداد نقاط مسیر برگشتی از OSRM جعلی
+REPEAT = 5
+GUI_TIMEOUT_S = 10.0
+STARTUP_TIMEOUT_S = 60.0
+REGRESSION_THRESHOLD = 0.20  # کندتر شدن میانه بیش از ۲۰٪ = پسرفت
+CENTER = (35.6892, 51.3890)
+
+
+# =========================
+# سرورهای جعلی (Nominatim / OSRM / کاشی)
+# =========================
+def make_tile_png():
+    buf = io.BytesIO()
+    Image.new("RGB", (256, 256), (200, 220, 200)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    tile_png = b""
+    route_points = STUB_ROUTE_POINTS
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, content_type="application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "max-age=3600")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+        if parts[0] == "search":
+            # نتیجه‌ای ثابت ولی وابسته به متن، تا کش‌ها کلیدهای متفاوت ببینند
+            q = query.get("q", [""])[0]
+            rnd = random.Random(q)
+            lat = CENTER[0] + rnd.uniform(-0.1, 0.1)
+            lon = CENTER[1] + rnd.uniform(-0.1, 0.1)
+            self._send(json.dumps([{"lat": str(lat), "lon": str(lon), "display_name": f"{q}, Stub City"}]).encode())
+        elif parts[0] == "route":
+            coords = [tuple(map(float, c.split(","))) for c in parts[-1].split(";")]
+            line = []
+            for (lon0, lat0), (lon1, lat1) in zip(coords, coords[1:]):
+                for i in range(self.route_points):
+                    t = i / self.route_points
+                    line.append([lon0 + (lon1 - lon0) * t, lat0 + (lat1 - lat0) * t])
+            line.append(list(coords[-1]))
+            route = {"geometry": {"coordinates": line}, "distance": 1000.0 * len(coords), "duration": 60.0 * len(coords)}
+            self._send(json.dumps({"code": "Ok", "routes": [route]}).encode())
+        elif parts[0] == "table":
+            coords = [tuple(map(float, c.split(","))) for c in parts[-1].split(";")]
+            sources = [int(i) for i in query["sources"][0].split(";")]
+            destinations = [int(i) for i in query["destinations"][0].split(";")]
+            distances = [[mapviewer.haversine_m(coords[i][1], coords[i][0], coords[j][1], coords[j][0])
+                          for j in destinations] for i in sources]
+            durations = [[d / 10.0 for d in row] for row in distances]
+            self._send(json.dumps({"code": "Ok", "durations": durations, "distances": distances}).encode())
+        elif parts[0] == "tiles":
+            self._send(self.tile_png, "image/png")
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+
+def start_stub_server():
+    StubHandler.tile_png = make_tile_png()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def point_app_at(base_url):
+    # همه‌ی آدرس‌های شبکه‌ی برنامه به سرور جعلی
+    mapviewer.NOMINATIM_URL = f"{base_url}/search"
+    mapviewer.OSRM_URL = base_url
+    for key, style in mapviewer.TILE_STYLES.items():
+        style["url"] = f"{base_url}/tiles/{key}/{{z}}/{{x}}/{{y}}.png"
+    # سقف نرخ سرویس‌های عمومی برای سرور جعلی لازم نیست و فقط زمان انتظار توکن را اندازه می‌گرفت
+    for options in mapviewer.HTTP_PROVIDERS.values():
+        options["rate_per_s"] = None
+    mapviewer.reset_http_clients()
+
+
+# =========================
+# ابزار اندازه‌گیری
+# =========================
+def summarize(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        "n": n,
+        "min_ms": round(samples[0] * 1000, 3),
+        "median_ms": round(samples[n // 2] * 1000, 3),
+        "p95_ms": round(samples[min(n - 1, int(math.ceil(n * 0.95)) - 1)] * 1000, 3),
+        "mean_ms": round(sum(samples) / n * 1000, 3),
+    }
+
+
+def measure(fn, repeat, setup=None):
+    samples = []
+    for i in range(repeat):
+        if setup is not None:
+            setup(i)
+        start = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def make_history(n, seed=0):
+    rnd = random.Random(seed)
+    ts = mapviewer.timestamp()
+    history = []
+    for i in range(n):
+        lat = CENTER[0] + rnd.uniform(-0.5, 0.5)
+        lon = CENTER[1] + rnd.uniform(-0.5, 0.5)
+        label = f"Place {i}"
+        history.append({"label": label, "address": f"{label}, Street {i % 97}, Stub City",
+                        "lat": lat, "lon": lon, "ts": ts})
+    return history
+
+
+def make_route(n):
+    # مسیری پیچ‌دار به طول تقریبی ۲۰ کیلومتر
+    return [(CENTER[0] + 0.1 * math.sin(i / n * 6.0) + i / n * 0.05, CENTER[1] + i / n * 0.2) for i in range(n)]
+
+
+# =========================
+# بنچمارک‌ها
+# =========================
+def bench_history_io(results, sizes, repeat, workdir):
+    for n in sizes:
+        history = make_history(n)
+        path = os.path.join(workdir, f"history-{n}.json")
+        r = max(1, repeat if n <= 10_000 else repeat // 2)
+        results[f"save_history[{n}]"] = measure(lambda i: mapviewer.save_history(history, path), r)
+        results[f"load_history[{n}]"] = measure(lambda i: mapviewer.load_history(path), r)
+
+        # مسیر فعلی برنامه: افزودن با fsync به ژورنال و بازخوانی snapshot + ژورنال
+        journal_path = os.path.join(workdir, f"history-{n}.journal")
+        journal = mapviewer.HistoryJournal(path, journal_path)
+        extra = make_history(r, seed=1)
+        results[f"journal_add[{n}]"] = measure(lambda i: journal.add(extra[i]), r)
+        results[f"journal_load[{n}]"] = measure(lambda i: mapviewer.HistoryJournal(path, journal_path).load(), r)
+        journal.close(history)
+
+
+def pump(app, done, timeout=GUI_TIMEOUT_S):
+    deadline = time.monotonic() + timeout
+    while not done():
+        if time.monotonic() > deadline:
+            raise TimeoutError("GUI operation did not finish in time")
+        app.update()
+
+
+def bench_gui(results, sizes, route_sizes, repeat):
+    app = mapviewer.MapApp(mainloop=False)
+    try:
+        app.update()
+        pump(app, lambda: app.history_ready)
+
+        # جست‌وجو: از submit_location تا اجرای کامل نتیجه روی نخ اصلی
+        finished = []
+        on_result = app.on_location_result
+
+        def wrapped(*args):
+            on_result(*args)
+            finished.append(time.perf_counter())
+
+        app.on_location_result = wrapped
+
+        def search(i, cached):
+            count = len(finished)
+            app.input_var.set("Stub Square" if cached else f"Stub Street {i} {time.time()}")
+            app.submit_location()
+            pump(app, lambda: len(finished) > count)
+
+        results["submit_location[network]"] = measure(lambda i: search(i, False), repeat)
+        search(0, True)
+        results["submit_location[cached]"] = measure(lambda i: search(i, True), repeat)
+
+        # مسیریابی با دو کلیک روی نقشه؛ زمان کلیک دوم تا رسم مسیر (دریافت در پس‌زمینه، ساده‌سازی و رسم)
+        app.routing_mode = True
+        drawn = []
+        on_route = app.on_route_result
+
+        def wrapped_route(*args):
+            on_route(*args)
+            drawn.append(time.perf_counter())
+
+        app.on_route_result = wrapped_route
+
+        def route_click(i, cached):
+            rnd = random.Random(0 if cached else i + 1)
+            a = (CENTER[0] + rnd.uniform(-0.1, 0.1), CENTER[1] + rnd.uniform(-0.1, 0.1))
+            b = (CENTER[0] + rnd.uniform(-0.1, 0.1), CENTER[1] + rnd.uniform(-0.1, 0.1))
+            app.route_start = None
+            app.on_map_click(*a)
+            count = len(drawn)
+            start = time.perf_counter()
+            app.on_map_click(*b)
+            pump(app, lambda: len(drawn) > count)
+            app.update_idletasks()
+            return time.perf_counter() - start
+
+        results["on_map_click_route[network]"] = summarize([route_click(i, False) for i in range(repeat)])
+        route_click(0, True)
+        results["on_map_click_route[cached]"] = summarize([route_click(i, True) for i in range(repeat)])
+        app.routing_mode = False
+        pump(app, lambda: app.map.animator.after_id is None)  # پایان انیمیشن فوکوس روی مسیر
+
+        for n in route_sizes:
+            points = make_route(n)
+
+            def draw(i):
+                app.draw_route(points)
+                app.update_idletasks()
+
+            results[f"draw_route[{n}]"] = measure(draw, repeat)
+
+        for n in sizes:
+            history = make_history(n)
+
+            def setup(i):
+                app.history[:] = history
+                app.history_index.clear()
+                for entry in history:
+                    app.history_index.insert(entry)
+                # بدون این، از تکرار دوم همه‌ی ردیف‌ها از قبل همین ورودی‌ها را نشان می‌دهند و refresh کاری نمی‌کند
+                app.history_list.invalidate()
+
+            def refresh(i):
+                app.refresh_history_ui()
+                app.update_idletasks()
+
+            results[f"refresh_history_ui[{n}]"] = measure(refresh, repeat, setup=setup)
+        app.history[:] = []
+        app.history_index.clear()
+    finally:
+        app.on_close()
+
+
+def startup_child(base_url):
+    # اجرا در فرایند جدا: راه‌اندازی سرد واقعی، با همان سرور جعلی برای کاشی‌ها
+    point_app_at(base_url)
+    return mapviewer.main(["--startup-report"])
+
+
+def bench_startup(results, sizes, repeat, base_url):
+    # زمان تا اولین فریم و تا بارگذاری کامل تاریخچه، از شروع import برنامه در فرایند تازه
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        p for p in (os.path.dirname(os.path.abspath(__file__)), os.environ.get("PYTHONPATH")) if p
+    ))
+    code = "import sys, benchmark; sys.exit(benchmark.startup_child(sys.argv[1]))"
+    for n in sizes:
+        mapviewer.save_history(make_history(n), mapviewer.HISTORY_FILE)
+        first_frame, ready = [], []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, "-c", code, base_url], env=env, capture_output=True,
+                                 text=True, timeout=STARTUP_TIMEOUT_S).stdout
+            report = json.loads(out.strip().splitlines()[-1])
+            first_frame.append(report["first_frame_ms"] / 1000.0)
+            ready.append(report["history_ready_ms"] / 1000.0)
+        results[f"startup_first_frame[{n}]"] = summarize(first_frame)
+        results[f"startup_history_ready[{n}]"] = summarize(ready)
+    for path in (mapviewer.HISTORY_FILE, mapviewer.HISTORY_JOURNAL_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def start_display():
+    # نمایشگر مجازی (Xvfb) وقتی DISPLAY در دسترس نیست
+    if os.environ.get("DISPLAY") or sys.platform in ("win32", "darwin"):
+        return None, True
+    try:
+        from pyvirtualdisplay import Display
+    except ImportError:
+        return None, False
+    try:
+        display = Display(visible=False, size=(1280, 800))
+        display.start()
+    except Exception:
+        return None, False
+    return display, True
+
+
+# =========================
+# ذخیره و مقایسه
+# =========================
+def run_metadata():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": mapviewer.timestamp(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+def compare(previous, current, threshold):
+    # نسبت میانه‌ی اجرای فعلی به قبلی؛ خروجی: فهرست پسرفت‌ها
+    regressions = []
+    print(f"{'benchmark':42} {'before ms':>11} {'after ms':>11} {'change':>8}")
+    for name, after in current["results"].items():
+        before = previous.get("results", {}).get(name)
+        if not before or not before.get("median_ms"):
+            continue
+        ratio = after["median_ms"] / before["median_ms"] - 1.0
+        mark = "  <-- slower" if ratio > threshold else ""
+        print(f"{name:42} {before['median_ms']:11.3f} {after['median_ms']:11.3f} {ratio:+8.1%}{mark}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Advanced Map Viewer benchmarks (local stub servers)")
+    parser.add_argument("-o", "--output", default="benchmark-results.json")
+    parser.add_argument("--compare", metavar="PREVIOUS_JSON", help="compare medians with an earlier run")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=list(HISTORY_SIZES),
+                        help="comma-separated history sizes")
+    parser.add_argument("--route-sizes", type=lambda v: [int(x) for x in v.split(",")], default=list(ROUTE_SIZES))
+    parser.add_argument("--no-gui", action="store_true", help="only the non-GUI benchmarks")
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output)
+    previous = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+
+    server = start_stub_server()
+    point_app_at(f"http://127.0.0.1:{server.server_port}")
+    results = {}
+    report = {"meta": run_metadata(), "results": results}
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="mapviewer-bench-") as workdir:
+        # history.json و کش‌های برنامه در پوشه‌ی موقت ساخته می‌شوند، نه کنار پروژه
+        os.chdir(workdir)
+        try:
+            bench_history_io(results, args.sizes, args.repeat, workdir)
+            if not args.no_gui:
+                display, ok = start_display()
+                if ok:
+                    try:
+                        bench_gui(results, args.sizes, args.route_sizes, args.repeat)
+                        bench_startup(results, args.sizes, args.repeat, f"http://127.0.0.1:{server.server_port}")
+                    finally:
+                        if display is not None:
+                            display.stop()
+                else:
+                    report["meta"]["gui"] = "skipped: no DISPLAY and pyvirtualdisplay/Xvfb unavailable"
+                    print("GUI benchmarks skipped (install Xvfb and pyvirtualdisplay)", file=sys.stderr)
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"results written to {output}")
+
+    if previous is not None:
+        regressions = compare(previous, report, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.threshold:.0%}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
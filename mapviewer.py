@@ -1,10 +1,35 @@
+import io
+import re
+import csv
 import json
 import os
+import sys
 import time
 import math
+import queue
+import sqlite3
+import bisect
+import unicodedata
+import mmap
+import heapq
+import random
+import argparse
+import functools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from tkinter import filedialog, messagebox
+from urllib.parse import urlsplit
+from urllib.request import pathname2url
+
+# مبدأ زمان راه‌اندازی؛ پیش از بارگذاری کتابخانه‌های رابط کاربری و شبکه
+STARTUP_T0 = time.perf_counter()
+
 import requests
 import customtkinter as ctk
 import tkintermapview
+from PIL import Image, ImageTk
 
 
 # =========================
@@ -12,7 +37,93 @@ import tkintermapview
 # =========================
 APP_TITLE = "Advanced Map Viewer"
 APP_ICON = "map.ico"
+USER_AGENT = "keyvan-map-app (contact: example@example.com)"
 HISTORY_FILE = "history.json"
+HISTORY_JOURNAL_FILE = "history.journal"
+HISTORY_DEDUP_RADIUS_M = 1.0  # نقاط نزدیک‌تر از این فاصله تکراری حساب می‌شوند
+NEARBY_RESULTS = 5
+IMPORT_BATCH_SIZE = 1000  # هر دسته در یک تیک after() اعمال می‌شود
+IMPORT_TICK_MS = 5
+CACHE_FILE = "cache.sqlite3"  # کنار history.json
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+GEOCODE_CACHE_TTL_S = 30 * 24 * 3600
+GEOCODE_CACHE_MAX_ENTRIES = 50_000
+GEOCODE_RATE_PER_S = 1.0  # سیاست استفاده‌ی Nominatim: حداکثر یک درخواست در ثانیه
+GEOCODE_BATCH_WORKERS = 2
+GEOCODE_RETRIES = 3
+GEOCODE_BACKOFF_S = 1.0  # تاخیر پایه؛ در هر تلاش دو برابر می‌شود
+GAZETTEER_FILE = "gazetteer.sqlite3"  # خروجی «mapviewer.py build-gazetteer»
+GAZETTEER_MODE = "fallback"  # off | fallback (وقتی Nominatim در دسترس نیست) | primary (اول گزتیر، سپس Nominatim)
+GAZETTEER_SCAN = 500  # سقف مکان‌های نامزد هر جست‌وجو (به ترتیب اهمیت خوانده می‌شوند)
+GAZETTEER_TYPO_MIN_LEN = 4  # کلمه‌های کوتاه‌تر فقط دقیق/پیشوندی تطبیق می‌خورند
+GAZETTEER_DISTANCE_WEIGHT = 0.1  # جریمه به ازای هر ده برابر شدن فاصله (کیلومتر) تا مرکز نقشه
+
+OSRM_URL = "https://router.project-osrm.org"
+ROUTE_PROFILE = "driving"
+ROUTE_CACHE_PRECISION_M = 10  # اندازه‌ی شبکه‌ی گرد کردن مبدأ/مقصد
+ROUTE_CACHE_TTL_S = 7 * 24 * 3600
+ROUTE_CACHE_MAX_ENTRIES = 5_000
+MATRIX_CACHE_MAX_ENTRIES = 200_000  # هر جفت توقف یک سطر
+TABLE_MAX_COORDS = 100  # سقف مختصات در هر درخواست /table (max-table-size سرور OSRM)
+TRIP_MAX_STOPS = 200
+TRIP_ROUTE_CHUNK = 50  # حداکثر نقطه‌ی میانی در هر درخواست /route
+TRIP_SOLVE_TIME_S = 3.0
+ROUTE_ENGINE = "auto"  # osrm | offline | auto (گراف آفلاین اگر ساخته شده، سپس OSRM)
+OFFLINE_GRAPH_FILE = "roads.graph"  # خروجی «mapviewer.py build-graph»
+OFFLINE_SNAP_MAX_M = 500  # دورترین فاصله‌ی مبدأ/مقصد از نزدیک‌ترین راه
+OFFLINE_SPEEDS_KMH = {  # سرعت پیش‌فرض هر نوع راه وقتی maxspeed ندارد
+    "motorway": 100, "motorway_link": 60, "trunk": 80, "trunk_link": 50, "primary": 60, "primary_link": 40,
+    "secondary": 50, "secondary_link": 35, "tertiary": 40, "tertiary_link": 30, "unclassified": 30,
+    "residential": 30, "living_street": 10, "service": 15, "road": 30,
+}
+
+TILE_STORE_FILE = "tiles.mbtiles"
+TILE_STORE_MAX_BYTES = 512 * 1024 * 1024
+TILE_DEFAULT_MAX_AGE_S = 7 * 24 * 3600  # وقتی سرور Cache-Control/Expires نمی‌دهد
+TILE_MIN_MAX_AGE_S = 3600
+TILE_OFFLINE_ONLY = False  # فقط از دیسک؛ هیچ درخواست شبکه‌ای برای کاشی‌ها
+TILE_POOL_MAX_BYTES = 256 * 1024 * 1024  # سقف حافظه‌ی کاشی‌های رمزگشایی‌شده (همه‌ی استایل‌ها با هم)
+TILE_PREWARM_DELAY_MS = 800  # مکث نقشه پیش از گرم کردن استایل‌های مجاور
+TILE_PREWARM_STYLES = 2  # استایل‌های قبل و بعد از استایل فعلی (به ترتیب دکمه‌ها)؛ ۰ = خاموش
+
+PREFETCH_WORKERS = 4
+PREFETCH_HOST_RATE_PER_S = 4.0  # سقف درخواست در ثانیه برای هر میزبان کاشی
+PREFETCH_MAX_TILES = 250_000
+PREFETCH_DEFAULT_TILE_BYTES = 20_000  # برای تخمین، وقتی هنوز کاشی‌ای از این استایل ذخیره نشده
+
+HTTP_POOL_SIZE = 8  # اتصال‌های keep-alive نگه‌داشته‌شده برای هر میزبان
+HTTP_RETRIES = 2
+HTTP_BACKOFF_S = 0.5  # تاخیر پایه‌ی تلاش مجدد (با jitter، دو برابر در هر تلاش)
+HTTP_TIMEOUT_S = 10
+HTTP_MAX_RETRY_AFTER_S = 60  # Retry-After طولانی‌تر یعنی تلاش مجدد نمی‌کنیم و پاسخ برگردانده می‌شود
+HTTP_PROVIDERS = {
+    # rate_per_s: سقف درخواست در ثانیه برای هر میزبان؛ None یعنی بدون محدودیت
+    "nominatim": {"rate_per_s": GEOCODE_RATE_PER_S},
+    "osrm": {"rate_per_s": 1.0, "burst": 3},  # سیاست سرور نمایشی؛ برای سرور شخصی بیشتر شود
+    # مسیر کلیک کاربر: صف جدا از ماتریس TripPlanner و بدون تلاش مجدد (کلیک دوباره همان تلاش مجدد است)
+    "route": {"rate_per_s": 1.0, "burst": 3, "retries": 0},
+    "tiles": {"rate_per_s": None, "pool_size": 16, "retries": 1},
+    "suggest": {"rate_per_s": 2.0, "burst": 2, "retries": 0, "timeout": 4},
+}
+
+SUGGEST_LIMIT = 8
+SUGGEST_DEBOUNCE_MS = 300
+SUGGEST_MIN_CHARS = 3  # برای پیشنهاد از شبکه
+# سرور پیشنهاد هنگام تایپ (Nominatim شخصی یا سازگار). سیاست سرور عمومی Nominatim
+# تکمیل خودکار سمت کاربر را ممنوع کرده، پس به‌طور پیش‌فرض فقط پیشنهاد محلی داریم
+SUGGEST_REMOTE_URL = None
+
+MOUSE_MOVE_FRAME_MS = 16  # حداکثر یک به‌روزرسانی مختصات در هر فریم
+CLUSTER_CELL_PX = 64  # اندازه‌ی سلول خوشه‌بندی روی صفحه
+CLUSTER_MAX_ZOOM = 17  # بعد از این زوم همه‌ی نقاط جدا نمایش داده می‌شوند
+HISTORY_LOAD_CHUNK = 2000  # ورودی‌های تاریخچه که در هر گام (بعد از اولین فریم) به برنامه اضافه می‌شوند
+POLYGON_HANDLE_PX = 5  # شعاع دستگیره‌ی رئوس چندضلعی (و فاصله‌ی انتخاب آن‌ها)
+
+METRICS_ENABLED = False  # با دکمه‌ی Perf در نوار وضعیت هم روشن می‌شود
+METRICS_LAG_INTERVAL_MS = 100  # فاصله‌ی نمونه‌برداری تاخیر حلقه‌ی رویداد Tk
+METRICS_TRACE_MAX_EVENTS = 200_000
+METRICS_OVERLAY_MS = 500
 
 TILE_STYLES = {
     "map": {
@@ -53,30 +164,31 @@ COLOR_RANGE = list("0123456789ABCDEF")
 # =========================
 # ابزارها و توابع کمکی
 # =========================
-def load_history():
-    def _normalize_entry(h):
-        # فقط دیکشنری‌های دارای lat/lon عددی
-        if not isinstance(h, dict):
-            return None
-        lat = h.get("lat")
-        lon = h.get("lon")
-        if not (isinstance(lat, (int, float)) and isinstance(lon, (int, float))):
-            return None
-        address = h.get("address")
-        label = h.get("label")
-        if not label:
-            if address:
-                label = str(address).split(",")[0]
-            else:
-                label = f"{lat:.5f}, {lon:.5f}"
-        if address is None:
-            address = label
-        ts = h.get("ts") or timestamp()
-        return {"label": label, "address": address, "lat": float(lat), "lon": float(lon), "ts": ts}
+def _normalize_entry(h):
+    # فقط دیکشنری‌های دارای lat/lon عددی
+    if not isinstance(h, dict):
+        return None
+    lat = h.get("lat")
+    lon = h.get("lon")
+    if not (isinstance(lat, (int, float)) and isinstance(lon, (int, float))):
+        return None
+    address = h.get("address")
+    label = h.get("label")
+    if not label:
+        if address:
+            label = str(address).split(",")[0]
+        else:
+            label = f"{lat:.5f}, {lon:.5f}"
+    if address is None:
+        address = label
+    ts = h.get("ts") or timestamp()
+    return {"label": label, "address": address, "lat": float(lat), "lon": float(lon), "ts": ts}
 
-    if os.path.exists(HISTORY_FILE):
+
+def load_history(path=HISTORY_FILE):
+    if os.path.exists(path):
         try:
-            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
+            with open(path, "r", encoding="utf-8") as f:
                 data = json.load(f)
             if not isinstance(data, list):
                 return []
@@ -91,132 +203,4325 @@ def load_history():
     return []
 
 
-def save_history(history_list):
+def save_history(history_list, path=HISTORY_FILE):
+    # نوشتن اتمیک: فایل موقت + fsync + جایگزینی، تا کرش وسط نوشتن فایل را خراب نکند
+    tmp_path = path + ".tmp"
     try:
-        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(history_list, f, ensure_ascii=False, indent=2)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(history_list, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return True
     except Exception:
-        pass
+        return False
+
+
+EARTH_RADIUS_M = 6_371_008.8
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+class PointIndex:
+    # شاخص مکانی با سطل‌های شبکه‌ای؛ بررسی تکرار و جست‌وجوی نزدیک‌ترین‌ها بدون پیمایش کل تاریخچه
+    def __init__(self, cell_m=50.0):
+        self.cell_deg = cell_m / 111_320.0
+        # ستون‌ها دور کره را دقیقاً پر می‌کنند تا همسایگی از نصف‌النهار ۱۸۰ درجه بگذرد
+        self.columns = max(1, int(360.0 / self.cell_deg))
+        self.lon_cell_deg = 360.0 / self.columns
+        self.cells = {}  # (i, j) -> [entry, ...]
+        self.size = 0
+
+    def _cell(self, lat, lon):
+        j = int(math.floor(((lon + 180.0) % 360.0) / self.lon_cell_deg)) % self.columns
+        return int(math.floor(lat / self.cell_deg)), j
+
+    def insert(self, entry):
+        self.cells.setdefault(self._cell(entry["lat"], entry["lon"]), []).append(entry)
+        self.size += 1
+
+    def remove(self, entry):
+        key = self._cell(entry["lat"], entry["lon"])
+        bucket = self.cells.get(key)
+        if not bucket:
+            return
+        for i, item in enumerate(bucket):
+            if item is entry:
+                del bucket[i]
+                self.size -= 1
+                break
+        if not bucket:
+            del self.cells[key]
+
+    def clear(self):
+        self.cells.clear()
+        self.size = 0
+
+    def _candidates(self, lat, lon, radius_m):
+        ci, cj = self._cell(lat, lon)
+        span_i = int(math.ceil(radius_m / 111_320.0 / self.cell_deg))
+        cos_lat = math.cos(math.radians(min(abs(lat) + span_i * self.cell_deg, 90.0)))
+        if cos_lat < 1e-6:
+            span_j = self.columns
+        else:
+            span_j = min(self.columns, int(math.ceil(radius_m / (111_320.0 * cos_lat) / self.lon_cell_deg)))
+        columns = self.columns
+        all_columns = 2 * span_j + 1 >= columns
+
+        # وقتی محدوده‌ی جست‌وجو از تعداد سطل‌های پر بیشتر است، سطل‌های پر را مستقیم می‌گردیم
+        if (2 * span_i + 1) * min(2 * span_j + 1, columns) > len(self.cells):
+            for (i, j), bucket in self.cells.items():
+                dj = abs(j - cj)
+                if abs(i - ci) <= span_i and (all_columns or min(dj, columns - dj) <= span_j):
+                    yield from bucket
+            return
+        js = range(columns) if all_columns else [j % columns for j in range(cj - span_j, cj + span_j + 1)]
+        for i in range(ci - span_i, ci + span_i + 1):
+            for j in js:
+                bucket = self.cells.get((i, j))
+                if bucket:
+                    yield from bucket
+
+    def find_within(self, lat, lon, radius_m):
+        best, best_d = None, radius_m
+        for entry in self._candidates(lat, lon, radius_m):
+            d = haversine_m(lat, lon, entry["lat"], entry["lon"])
+            if d <= best_d:
+                best, best_d = entry, d
+        return best
+
+    def nearest(self, lat, lon, k=NEARBY_RESULTS, max_radius_m=100_000.0):
+        # جست‌وجوی حلقه‌ای: شعاع دو برابر می‌شود تا k نقطه در داخل شعاع پیدا شود
+        radius = self.cell_deg * 111_320.0
+        while True:
+            found = []
+            for entry in self._candidates(lat, lon, radius):
+                d = haversine_m(lat, lon, entry["lat"], entry["lon"])
+                if d <= radius:
+                    found.append((d, entry))
+            if len(found) >= k or radius >= max_radius_m or len(found) == self.size:
+                found.sort(key=lambda item: item[0])
+                return found[:k]
+            radius = min(radius * 2, max_radius_m)
+
+
+class PrefixIndex:
+    # جست‌وجوی پیشوندی روی آرایه‌ی مرتب (bisect)؛ هر متن با کل عبارت و با شروع هر کلمه‌اش کلید می‌خورد
+    # تا «تهران» هم «میدان آزادی، تهران» را پیدا کند. exact فقط متن کامل را می‌پذیرد (دیکشنری جدا)
+    def __init__(self, max_words=4):
+        self.max_words = max_words
+        self.keys = []
+        self.items = []
+        self.full = {}  # متن کامل یکسان‌شده -> آیتم
+
+    def _keys_for(self, texts):
+        keys = set()
+        for text in texts:
+            if text:
+                words = normalize_query(text).split(" ")
+                keys.update(" ".join(words[i:]) for i in range(min(len(words), self.max_words)) if words[i])
+        return keys
+
+    def _remember_full(self, texts, item):
+        for text in texts:
+            if text:
+                self.full.setdefault(normalize_query(text), item)
+
+    def _merge(self, pairs):
+        # pairs مرتب‌شده؛ ادغام خطی با برش‌های آرایه‌ی فعلی به جای مرتب‌سازی دوباره‌ی کل شاخص
+        keys, items = [], []
+        prev = 0
+        for key, item in pairs:
+            pos = bisect.bisect_right(self.keys, key, prev)
+            keys.extend(self.keys[prev:pos])
+            items.extend(self.items[prev:pos])
+            keys.append(key)
+            items.append(item)
+            prev = pos
+        keys.extend(self.keys[prev:])
+        items.extend(self.items[prev:])
+        self.keys = keys
+        self.items = items
+
+    def add(self, texts, item):
+        self._remember_full(texts, item)
+        for key in self._keys_for(texts):
+            i = bisect.bisect_right(self.keys, key)
+            self.keys.insert(i, key)
+            self.items.insert(i, item)
+
+    def add_many(self, pairs):
+        # pairs: [(texts, item)]؛ فقط کلیدهای تازه مرتب و در یک گذر ادغام می‌شوند
+        new = []
+        for texts, item in pairs:
+            self._remember_full(texts, item)
+            new.extend((key, item) for key in self._keys_for(texts))
+        new.sort(key=lambda p: p[0])
+        self._merge(new)
+
+    def retain(self, keep):
+        # کنار گذاشتن آیتم‌هایی که keep برایشان False است
+        pairs = [(k, i) for k, i in zip(self.keys, self.items) if keep(i)]
+        self.keys = [p[0] for p in pairs]
+        self.items = [p[1] for p in pairs]
+        self.full = {k: i for k, i in self.full.items() if keep(i)}
+
+    def absorb(self, other):
+        # افزودن محتوای یک شاخص دیگر (معمولاً کوچک)
+        for key, item in other.full.items():
+            self.full.setdefault(key, item)
+        if len(other.keys) < 1000:
+            for key, item in zip(other.keys, other.items):
+                i = bisect.bisect_right(self.keys, key)
+                self.keys.insert(i, key)
+                self.items.insert(i, item)
+        else:
+            self._merge(zip(other.keys, other.items))
+
+    def remove(self, texts, item):
+        for text in texts:
+            if text and self.full.get(normalize_query(text)) is item:
+                del self.full[normalize_query(text)]
+        for key in self._keys_for(texts):
+            i = bisect.bisect_left(self.keys, key)
+            while i < len(self.keys) and self.keys[i] == key:
+                if self.items[i] is item:
+                    del self.keys[i]
+                    del self.items[i]
+                    break
+                i += 1
+
+    def clear(self):
+        self.keys = []
+        self.items = []
+        self.full = {}
+
+    def search(self, prefix, limit=SUGGEST_LIMIT, scan=256):
+        # حداکثر scan کلید بررسی می‌شود تا پیشوندهای خیلی کوتاه هم زمان ثابت داشته باشند
+        prefix = normalize_query(prefix)
+        if not prefix:
+            return []
+        found = []
+        seen = set()
+        i = bisect.bisect_left(self.keys, prefix)
+        end = min(len(self.keys), i + scan)
+        while i < end and len(found) < limit and self.keys[i].startswith(prefix):
+            item = self.items[i]
+            if id(item) not in seen:
+                seen.add(id(item))
+                found.append(item)
+            i += 1
+        return found
+
+    def exact(self, text):
+        return self.full.get(normalize_query(text))
+
+
+def history_key(entry):
+    return f"{entry['lat']:.7f},{entry['lon']:.7f}"
+
+
+class HistoryJournal:
+    # تاریخچه = آخرین snapshot (history.json) + ژورنال فقط-افزودنی تغییرات بعد از آن.
+    # هر تغییر یک خط JSON است که fsync می‌شود؛ فشرده‌سازی گاه‌به‌گاه در پس‌زمینه انجام می‌شود.
+    def __init__(self, snapshot_path=HISTORY_FILE, journal_path=HISTORY_JOURNAL_FILE, compact_min_ops=500):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.rotated_path = journal_path + ".1"  # ژورنال در حال فشرده‌سازی
+        self.compact_min_ops = compact_min_ops
+        self.ops = 0
+        self.file = None
+        self.compactor = None
+        self.loader = None
+        self.loaded = True  # تا پایان load_async تغییرات فقط در حافظه صف می‌شوند
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def load(self):
+        entries = OrderedDict()  # قدیمی‌ترین اول
+        for entry in reversed(load_history(self.snapshot_path)):
+            entries[history_key(entry)] = entry
+        for path in (self.rotated_path, self.journal_path):
+            self.ops += self._replay(path, entries)
+        history = list(reversed(entries.values()))
+
+        # فشرده‌سازی قبلی نیمه‌کاره مانده؛ همین‌جا تمامش می‌کنیم
+        if os.path.exists(self.rotated_path):
+            self._write_snapshot(history)
+        return history
+
+    def load_async(self, callback):
+        # خواندن در نخ جدا؛ callback(history) روی همان نخ صدا زده می‌شود.
+        # تغییرات این فاصله بعد از خواندن ژورنال نوشته می‌شوند تا نه دوباره خوانده شوند و نه با snapshot پاک شوند
+        with self.lock:
+            self.loaded = False
+
+        def run():
+            history = self.load()
+            with self.lock:
+                self.loaded = True
+                pending, self.pending = self.pending, []
+                if pending:
+                    self._write(b"".join(data for data, _ in pending), sum(count for _, count in pending))
+            callback(history)
+
+        self.loader = threading.Thread(target=run, daemon=True)
+        self.loader.start()
+
+    def wait_loaded(self):
+        if self.loader is not None:
+            self.loader.join()
+
+    @staticmethod
+    def _replay(path, entries):
+        # خواندن خط‌به‌خط؛ کل ژورنال هیچ‌وقت یک‌جا در حافظه نیست
+        count = 0
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        continue  # خط ناقص ناشی از کرش
+                    kind = op.get("op") if isinstance(op, dict) else None
+                    if kind == "add":
+                        entry = _normalize_entry(op.get("entry"))
+                        if entry:
+                            key = history_key(entry)
+                            entries.pop(key, None)
+                            entries[key] = entry
+                    elif kind == "del":
+                        entries.pop(op.get("key"), None)
+                    elif kind == "clear":
+                        entries.clear()
+                    count += 1
+        except OSError:
+            pass
+        return count
+
+    def _open(self):
+        if self.file is None:
+            needs_newline = False
+            try:
+                with open(self.journal_path, "rb") as f:
+                    f.seek(0, os.SEEK_END)
+                    if f.tell() > 0:
+                        f.seek(-1, os.SEEK_END)
+                        needs_newline = f.read(1) != b"\n"
+            except OSError:
+                pass
+            self.file = open(self.journal_path, "ab")
+            if needs_newline:
+                # خط ناقص قبلی نباید به خط جدید بچسبد
+                self.file.write(b"\n")
+        return self.file
+
+    def _close_file(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+
+    def _append(self, *ops):
+        # چند عملیات با یک write و یک fsync
+        data = b"".join(
+            (json.dumps(op, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8") for op in ops
+        )
+        with self.lock:
+            if not self.loaded:
+                self.pending.append((data, len(ops)))
+                return
+            self._write(data, len(ops))
+
+    def _write(self, data, count):
+        try:
+            f = self._open()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            self.ops += count
+        except OSError:
+            pass
+
+    def add(self, entry):
+        self._append({"op": "add", "entry": entry})
+
+    def add_many(self, entries):
+        if entries:
+            self._append(*({"op": "add", "entry": e} for e in entries))
+
+    def delete(self, entry):
+        self._append({"op": "del", "key": history_key(entry)})
+
+    def clear(self):
+        self._append({"op": "clear"})
+
+    def maybe_compact(self, history):
+        # وقتی ژورنال از خود تاریخچه بزرگ‌تر شد، snapshot تازه در پس‌زمینه نوشته می‌شود
+        if not self.loaded or self.ops < max(self.compact_min_ops, len(history)):
+            return
+        if self.compactor is not None and self.compactor.is_alive():
+            return
+        if os.path.exists(self.rotated_path):
+            return
+        snapshot = list(history)
+        with self.lock:
+            self._close_file()
+            try:
+                os.replace(self.journal_path, self.rotated_path)
+            except OSError:
+                return
+            self.ops = 0
+        self.compactor = threading.Thread(target=self._compact, args=(snapshot,), daemon=True)
+        self.compactor.start()
+
+    def _compact(self, snapshot):
+        if save_history(snapshot, self.snapshot_path):
+            try:
+                os.remove(self.rotated_path)
+            except OSError:
+                pass
+
+    def _write_snapshot(self, history):
+        with self.lock:
+            self._close_file()
+            if save_history(history, self.snapshot_path):
+                for path in (self.rotated_path, self.journal_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self.ops = 0
+
+    def close(self, history):
+        self.wait_loaded()
+        if self.compactor is not None:
+            self.compactor.join()
+        if self.ops or os.path.exists(self.rotated_path):
+            self._write_snapshot(history)
+        self._close_file()
 
 
 def timestamp():
     return time.strftime("%Y-%m-%d %H:%M:%S")
 
 
+def normalize_query(text):
+    # یکسان‌سازی فاصله‌ها و حروف برای مقایسه‌ی عبارت‌های جست‌وجو
+    return " ".join(str(text).split()).casefold()
+
+
 # =========================
-# ویدجت‌های سفارشی
+# اندازه‌گیری کارایی
 # =========================
-class LocationEntry(ctk.CTkEntry):
-    def __init__(self, parent, input_var, submit_callback):
-        self.color_index = 15
-        self.error = False
-        super().__init__(
-            master=parent,
-            textvariable=input_var,
-            corner_radius=8,
-            border_width=3,
-            fg_color="#FFFFFF",
-            border_color="#CCCCCC",
-            text_color="#000000",
-            font=ctk.CTkFont(family="Tahoma", size=14),
-            placeholder_text="نام مکان را وارد کنید و Enter بزنید"
-        )
-        self.bind("<Return>", submit_callback)
-        input_var.trace_add("write", self.clean_error)
+class Histogram:
+    # هیستوگرام لگاریتمی زمان بر حسب میلی‌ثانیه؛ چهار سطل در هر دو برابر (خطای صدک کمتر از ۱۹٪)
+    STEPS = 4
+    MIN_MS = 0.001
 
-    def display_error(self):
-        self.error = True
-        if self.color_index > 0:
-            self.color_index -= 1
-            color = COLOR_RANGE[self.color_index]
-            self.configure(border_color=f"#F{color}{color}", text_color=f"#{color}00")
-            self.after(40, self.display_error)
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
 
-    def clean_error(self, *args):
-        if self.error:
-            self.configure(border_color="#CCCCCC", text_color="#000000")
-            self.color_index = 15
-            self.error = False
+    def add(self, ms):
+        index = int(math.log2(ms / self.MIN_MS) * self.STEPS) if ms > self.MIN_MS else 0
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += ms
+        self.min = min(self.min, ms)
+        self.max = max(self.max, ms)
 
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        target = self.count * p / 100.0
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= target:
+                # لبه‌ی بالای سطل، محدود به بیشینه‌ی واقعی
+                return min(self.max, self.MIN_MS * 2 ** ((index + 1) / self.STEPS))
+        return self.max
 
-class MapWidget(tkintermapview.TkinterMapView):
-    def __init__(self, parent, on_left_click=None, on_mouse_move=None):
-        super().__init__(master=parent)
-        self.on_left_click = on_left_click
-        self.on_mouse_move = on_mouse_move
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "min_ms": round(self.min, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 3),
+            "p90_ms": round(self.percentile(90), 3),
+            "p99_ms": round(self.percentile(99), 3),
+            "max_ms": round(self.max, 3),
+        }
 
-        # کلیک چپ روی نقشه
-        self.add_left_click_map_command(self._handle_left_click)
 
-        # حرکت ماوس
-        self.bind("<Motion>", self._handle_mouse_move)
+class _Span:
+    __slots__ = ("metrics", "name", "category", "start")
 
-    def map_view_style(self, style_key: str):
-        style = TILE_STYLES.get(style_key, TILE_STYLES["map"])
-        self.set_tile_server(style["url"])
-        self.set_zoom(self.zoom)
+    def __init__(self, metrics, name, category):
+        self.metrics = metrics
+        self.name = name
+        self.category = category
+        self.start = None
 
-    def _handle_left_click(self, coords_tuple):
-        lat, lon = coords_tuple
-        if self.on_left_click:
-            self.on_left_click(lat, lon)
+    def __enter__(self):
+        if self.metrics.enabled:
+            self.start = time.perf_counter()
+        return self
 
-    def _handle_mouse_move(self, event):
-        lat, lon = None, None
-        # تبدیل مختصات پیکسل به جغرافیایی
-        for attr_name in (
-            "convert_canvas_coords_to_decimal_coords",
-            "convert_canvas_coords_to_gps",
-            "get_position_from_xy",
-        ):
-            if hasattr(self, attr_name):
-                try:
-                    func = getattr(self, attr_name)
-                    result = func(event.x, event.y)
-                    if isinstance(result, tuple) and len(result) == 2:
-                        lat, lon = float(result[0]), float(result[1])
-                    break
-                except Exception:
-                    pass
-        if lat is None or lon is None:
-            lat, lon = self.get_position()
+    def __exit__(self, *exc):
+        if self.start is not None:
+            self.metrics.record(self.name, self.start, time.perf_counter(), self.category)
+        return False
 
-        if self.on_mouse_move:
-            self.on_mouse_move(lat, lon)
 
-    def animate_to(self, target_lat, target_lon, duration_ms=350, steps=24):
-        start_lat, start_lon = self.get_position()
-        d_lat = target_lat - start_lat
-        d_lon = target_lon - start_lon
-        if steps <= 1:
-            self.set_position(target_lat, target_lon)
+class Metrics:
+    # هیستوگرام به ازای هر نام و یک بافر حلقوی از رویدادها برای خروجی Chrome trace (thread-safe).
+    # وقتی خاموش است، هزینه فقط بررسی یک پرچم است
+    def __init__(self, enabled=METRICS_ENABLED, max_events=METRICS_TRACE_MAX_EVENTS):
+        self.enabled = enabled
+        self.histograms = {}
+        self.events = deque(maxlen=max_events)  # (name, category, start, duration, thread id)
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def record(self, name, start, end, category="app"):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add((end - start) * 1000.0)
+            self.events.append((name, category, start, end - start, threading.get_ident()))
+
+    def percentiles(self, name, *ps):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            return tuple(histogram.percentile(p) if histogram else 0.0 for p in ps)
+
+    def span(self, name, category="app"):
+        return _Span(self, name, category)
+
+    def snapshot(self):
+        with self.lock:
+            return {name: h.to_dict() for name, h in sorted(self.histograms.items())}
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.events.clear()
+            self.origin = time.perf_counter()
+
+    def export_json(self, path, extra=None):
+        report = {"time": timestamp(), "metrics": self.snapshot()}
+        report.update(extra or {})
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    def export_chrome_trace(self, path):
+        # قالب Trace Event (قابل باز کردن در chrome://tracing یا Perfetto)
+        with self.lock:
+            events = list(self.events)
+            origin = self.origin
+        pid = os.getpid()
+        trace = [{
+            "name": name, "cat": category, "ph": "X", "pid": pid, "tid": tid,
+            "ts": round((start - origin) * 1e6, 1), "dur": round(duration * 1e6, 1),
+        } for name, category, start, duration, tid in events]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+
+METRICS = Metrics()
+
+
+def timed(name, category="app"):
+    # دکوراتور اندازه‌گیری؛ وقتی METRICS خاموش است تابع اصلی مستقیم صدا زده می‌شود
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                METRICS.record(name, start, time.perf_counter(), category)
+        return wrapper
+    return decorate
+
+
+class EventLoopLagMonitor:
+    # تاخیر حلقه‌ی رویداد: فاصله‌ی اجرای واقعی یک after() با زمان موعودش
+    def __init__(self, widget, metrics=METRICS, interval_ms=METRICS_LAG_INTERVAL_MS):
+        self.widget = widget
+        self.metrics = metrics
+        self.interval_ms = interval_ms
+        self.after_id = None
+        self.expected = 0.0
+
+    def start(self):
+        if self.after_id is None:
+            self._schedule()
+
+    def stop(self):
+        if self.after_id is not None:
+            try:
+                self.widget.after_cancel(self.after_id)
+            except Exception:
+                pass
+            self.after_id = None
+
+    def _schedule(self):
+        self.expected = time.perf_counter() + self.interval_ms / 1000.0
+        self.after_id = self.widget.after(self.interval_ms, self._tick)
+
+    def _tick(self):
+        now = time.perf_counter()
+        if self.metrics.enabled:
+            self.metrics.record("ui.loop_lag", self.expected, max(now, self.expected), "ui")
+        self._schedule()
+
+
+# =========================
+# ورود فایل نقاط (CSV / GeoJSON)
+# =========================
+CSV_COLUMNS = {
+    "lat": ("lat", "latitude", "y"),
+    "lon": ("lon", "lng", "long", "longitude", "x"),
+    "label": ("label", "name", "title"),
+    "address": ("address", "display_name", "description"),
+    "ts": ("ts", "timestamp", "time"),
+}
+
+
+def _to_float(value):
+    try:
+        return float(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def iter_csv_points(path):
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.DictReader(f, dialect=dialect)
+        fields = {name.strip().lower(): name for name in (reader.fieldnames or [])}
+        columns = {}
+        for key, aliases in CSV_COLUMNS.items():
+            columns[key] = next((fields[a] for a in aliases if a in fields), None)
+        for row in reader:
+            yield {
+                "lat": _to_float(row.get(columns["lat"])) if columns["lat"] else None,
+                "lon": _to_float(row.get(columns["lon"])) if columns["lon"] else None,
+                "label": row.get(columns["label"]) if columns["label"] else None,
+                "address": row.get(columns["address"]) if columns["address"] else None,
+                "ts": row.get(columns["ts"]) if columns["ts"] else None,
+            }
+
+
+def iter_json_items(f, chunk_size=1 << 16):
+    # پیمایش جریانی عناصر یک آرایه‌ی JSON (آرایه‌ی سطح بالا یا "features" در FeatureCollection)
+    # بدون بارگذاری کل فایل؛ هر عنصر جداگانه با raw_decode خوانده می‌شود
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size)
+    pos = 0
+    eof = not buf
+
+    def more(buf, pos):
+        data = f.read(chunk_size)
+        return buf[pos:] + data, 0, not data
+
+    def complete(buf, end, eof):
+        # عدد ممکن است در مرز بافر بریده شده باشد («12» از «1234» یا «2.» از «2.5»)؛
+        # مقدار فقط وقتی پذیرفته می‌شود که جداکننده‌ی بعدی (, : ] }) هم در بافر باشد
+        rest = buf[end:].lstrip()
+        return eof or (rest != "" and rest[0] in ",:]}")
+
+    while not eof and not buf.strip():
+        buf, pos, eof = more(buf, pos)
+    start = buf.lstrip()[:1]
+    if start == "{":
+        # کلید/مقدارهای سطح بالا یکی‌یکی خوانده و مقدار کلیدهای دیگر کامل رد می‌شود
+        # تا "features" تودرتو (مثلاً داخل crs یا properties) با آرایه‌ی اصلی اشتباه نشود
+        pos = buf.index("{") + 1
+        key = None  # None یعنی منتظر کلید هستیم
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,:":
+                pos += 1
+            if pos >= len(buf):
+                if eof:
+                    return
+                buf, pos, eof = more(buf, pos)
+                continue
+            if key == "features" and buf[pos] == "[":
+                pos += 1
+                break
+            if buf[pos] == "}":
+                return
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                value, end = None, None
+            if end is None or not complete(buf, end, eof):
+                if eof:
+                    return
+                buf, pos, eof = more(buf, pos)
+                continue
+            pos = end
+            key = value if key is None else None
+    elif start == "[":
+        pos = buf.index("[") + 1
+    else:
+        return
+
+    while True:
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            buf, pos, eof = more(buf, pos)
+        if pos >= len(buf) or buf[pos] == "]":
             return
-        interval = max(10, duration_ms // steps)
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            item, end = None, None
+        if end is None or not complete(buf, end, eof):
+            if eof:
+                return
+            buf, pos, eof = more(buf, pos)
+            continue
+        pos = end
+        yield item
 
-        def step(i=1):
-            t = i / steps
-            ease = (1 - math.cos(math.pi * t)) / 2  # ease in-out
-            self.set_position(start_lat + d_lat * ease, start_lon + d_lon * ease)
-            if i < steps:
-                self.after(interval, lambda: step(i + 1))
 
-        step()
+def _feature_points(item):
+    # یک Feature با هندسه‌ی Point/MultiPoint، یا یک رکورد ساده با lat/lon (مثل history.json)
+    if not isinstance(item, dict):
+        return
+    if item.get("type") != "Feature":
+        yield item
+        return
+    geometry = item.get("geometry") or {}
+    props = item.get("properties") or {}
+    if geometry.get("type") == "Point":
+        coords = [geometry.get("coordinates")]
+    elif geometry.get("type") == "MultiPoint":
+        coords = geometry.get("coordinates") or []
+    else:
+        return
+    for c in coords:
+        if not isinstance(c, (list, tuple)) or len(c) < 2:
+            continue
+        yield {
+            "lat": c[1], "lon": c[0],
+            "label": props.get("label") or props.get("name"),
+            "address": props.get("address") or props.get("display_name"),
+            "ts": props.get("ts") or props.get("timestamp"),
+        }
+
+
+def iter_geojson_points(path):
+    with open(path, "r", encoding="utf-8-sig") as f:
+        if path.lower().endswith((".geojsonl", ".geojsons", ".ndjson", ".jsonl")):
+            items = (json.loads(line) for line in f if line.strip())
+        else:
+            items = iter_json_items(f)
+        for item in items:
+            yield from _feature_points(item)
+
+
+def iter_point_file(path):
+    if path.lower().endswith((".csv", ".tsv", ".txt")):
+        return iter_csv_points(path)
+    return iter_geojson_points(path)
+
+
+class PointImporter:
+    # ورود جریانی: خواندن و اعتبارسنجی (با همان قواعد _normalize_entry) در نخ پس‌زمینه،
+    # تحویل دسته‌ها از طریق صف محدود تا خواننده از رابط کاربری خیلی جلو نیفتد
+    def __init__(self, path, batch_size=IMPORT_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.batches = queue.Queue(maxsize=4)
+        self.cancelled = threading.Event()
+        self.read = 0
+        self.rejected = 0
+        self.error = None
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def _put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.batches.put(item, timeout=0.2)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        batch = []
+        try:
+            for raw in iter_point_file(self.path):
+                if self.cancelled.is_set():
+                    break
+                self.read += 1
+                entry = _normalize_entry(raw)
+                if entry is None or not (-90 <= entry["lat"] <= 90 and -180 <= entry["lon"] <= 180):
+                    self.rejected += 1
+                    continue
+                batch.append(entry)
+                if len(batch) >= self.batch_size:
+                    self._put(batch)
+                    batch = []
+            if batch:
+                self._put(batch)
+        except (OSError, ValueError, csv.Error) as e:
+            self.error = e
+        self._put(None)  # پایان
+
+    def next_batch(self):
+        # دسته‌ی بعدی، None در پایان، یا queue.Empty اگر هنوز آماده نیست
+        return self.batches.get_nowait()
+
+
+# =========================
+# شبکه (HTTP)
+# =========================
+class TokenBucket:
+    # محدودکننده‌ی نرخ: rate توکن در ثانیه با ظرفیت burst (thread-safe)
+    def __init__(self, rate_per_s, burst=1):
+        self.rate = rate_per_s
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            # توکن همین حالا رزرو می‌شود (حتی منفی)، پس درخواست‌های هم‌زمان پشت سر هم صف می‌کشند
+            self.tokens -= 1.0
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay > 0:
+            time.sleep(delay)
+
+    def hold(self, seconds):
+        # همه‌ی درخواست‌های بعدی دست‌کم seconds ثانیه صبر می‌کنند (مثلاً پس از 429 با Retry-After)
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+
+def retry_after_s(response):
+    # Retry-After به صورت ثانیه یا تاریخ HTTP
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+class HttpClient:
+    # یک Session مشترک با pool اتصال‌های keep-alive برای هر سرویس، زمان‌بندی درخواست‌ها به ازای هر میزبان
+    # و تلاش مجدد با backoff تصادفی روی خطای شبکه، 429 و 5xx (با رعایت Retry-After).
+    # رابط get مثل requests.get است، پس هر جا session پذیرفته می‌شود قابل استفاده است
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, name, rate_per_s=None, burst=1, retries=HTTP_RETRIES, backoff_s=HTTP_BACKOFF_S,
+                 pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT_S):
+        self.name = name
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self.retries = retries
+        self.backoff_s = backoff_s
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.buckets = {}  # میزبان -> TokenBucket
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "retries": 0, "throttled": 0, "failures": 0}
+
+    def _bucket(self, host):
+        if self.rate_per_s is None:
+            return None
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = TokenBucket(self.rate_per_s, self.burst)
+            return bucket
+
+    def _count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        bucket = self._bucket(urlsplit(url).netloc)
+        for attempt in range(self.retries + 1):
+            if bucket is not None:
+                bucket.acquire()
+            self._count("requests")
+            last = attempt == self.retries
+            try:
+                with METRICS.span(f"http.{self.name}", "network"):
+                    response = self.session.get(url, params=params, headers=headers, timeout=timeout or self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                time.sleep(random.uniform(0, self.backoff_s * (2 ** attempt)))
+                continue
+            if response.status_code not in self.RETRY_STATUSES or last:
+                if response.status_code >= 400:
+                    self._count("failures")
+                return response
+            delay = retry_after_s(response)
+            if response.status_code == 429:
+                self._count("throttled")
+            if delay is not None and delay > HTTP_MAX_RETRY_AFTER_S:
+                # انتظار یک‌روزه برای همه‌ی درخواست‌های این میزبان پذیرفتنی نیست
+                self._count("failures")
+                return response
+            self._count("retries")
+            server_delay = delay is not None
+            if delay is None:
+                delay = random.uniform(0, self.backoff_s * (2 ** attempt))
+            if bucket is not None and (response.status_code == 429 or server_delay):
+                # سرور گفته صبر کنیم؛ برای همه‌ی نخ‌هایی که سراغ همین میزبان می‌روند
+                bucket.hold(delay)
+            else:
+                time.sleep(delay)
+        return response
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def close(self):
+        self.session.close()
+
+
+_http_clients = {}
+_http_clients_lock = threading.Lock()
+
+
+def http_client(provider):
+    # کلاینت مشترک هر سرویس (nominatim / osrm / tiles)، در اولین استفاده ساخته می‌شود
+    with _http_clients_lock:
+        client = _http_clients.get(provider)
+        if client is None:
+            client = _http_clients[provider] = HttpClient(provider, **HTTP_PROVIDERS.get(provider, {}))
+        return client
+
+
+def reset_http_clients():
+    # بستن کلاینت‌های مشترک؛ استفاده‌ی بعدی با تنظیمات فعلی HTTP_PROVIDERS از نو ساخته می‌شود
+    with _http_clients_lock:
+        for client in _http_clients.values():
+            client.close()
+        _http_clients.clear()
+
+
+# =========================
+# کش‌ها
+# =========================
+class SqliteCache:
+    # کش کلید/مقدار روی SQLite با انقضا (TTL)، سقف تعداد و حذف LRU؛ یک لایه‌ی LRU در حافظه جلوی دیسک
+    def __init__(self, path, table, ttl_s=None, max_entries=10_000, memory_entries=2048):
+        self.path = path
+        self.table = table
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()  # key -> (value, created)
+        self.touched = {}  # key -> last_used که هنوز روی دیسک نوشته نشده
+        self.hits = 0
+        self.misses = 0
+        self.count = 0
+        self.conn = None
+        self.lock = threading.RLock()
+
+    def _connect(self):
+        # اتصال تنبل؛ تا اولین استفاده فایل باز نمی‌شود
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_lru ON {self.table}(last_used)")
+            self.count = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            self.conn = conn
+        return self.conn
+
+    def _expired(self, created, now):
+        return self.ttl_s is not None and now - created > self.ttl_s
+
+    def _remember(self, key, value, created):
+        self.memory[key] = (value, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key, allow_stale=False):
+        # allow_stale: برای حالت آفلاین، مقدار منقضی‌شده هم برگردانده می‌شود
+        now = time.time()
+        with self.lock:
+            item = self.memory.get(key)
+            if item is not None and (allow_stale or not self._expired(item[1], now)):
+                self.memory.move_to_end(key)
+                self.touched[key] = now
+                self.hits += 1
+                return item[0]
+
+            row = None
+            try:
+                conn = self._connect()
+                row = conn.execute(f"SELECT value, created FROM {self.table} WHERE key=?", (key,)).fetchone()
+                # ردیف منقضی حذف نمی‌شود تا بعداً به‌عنوان نسخه‌ی آفلاین قابل استفاده بماند
+                if row is not None and not allow_stale and self._expired(row[1], now):
+                    row = None
+                if row is not None:
+                    self.touched[key] = now
+            except sqlite3.Error:
+                row = None
+
+            if row is None:
+                self.memory.pop(key, None)
+                self.misses += 1
+                return None
+
+            value = json.loads(row[0])
+            self._remember(key, value, row[1])
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        # همه در یک تراکنش؛ برای نوشتن‌های انبوه (مثل بلوک‌های ماتریس فاصله)
+        now = time.time()
+        with self.lock:
+            rows = []
+            for key, value in items:
+                self._remember(key, value, now)
+                self.touched.pop(key, None)
+                rows.append((key, json.dumps(value, ensure_ascii=False, separators=(",", ":")), now, now))
+            if not rows:
+                return
+            try:
+                conn = self._connect()
+                for key, *_ in rows:
+                    if conn.execute(f"SELECT 1 FROM {self.table} WHERE key=?", (key,)).fetchone() is None:
+                        self.count += 1
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, created, last_used) VALUES (?, ?, ?, ?)", rows
+                )
+                if self.count > self.max_entries:
+                    self._evict(conn)
+                conn.commit()
+            except sqlite3.Error:
+                pass
+
+    def _flush_touched(self, conn):
+        if self.touched:
+            conn.executemany(
+                f"UPDATE {self.table} SET last_used=? WHERE key=?",
+                [(t, k) for k, t in self.touched.items()]
+            )
+            self.touched.clear()
+
+    def _evict(self, conn):
+        # حذف کم‌استفاده‌ترین‌ها تا ۹۰٪ سقف، تا حذف در هر put تکرار نشود
+        self._flush_touched(conn)
+        excess = self.count - int(self.max_entries * 0.9)
+        keys = [r[0] for r in conn.execute(
+            f"SELECT key FROM {self.table} ORDER BY last_used LIMIT ?", (excess,)
+        )]
+        conn.executemany(f"DELETE FROM {self.table} WHERE key=?", [(k,) for k in keys])
+        for k in keys:
+            self.memory.pop(k, None)
+        self.count -= len(keys)
+
+    def delete(self, key):
+        with self.lock:
+            self.memory.pop(key, None)
+            self.touched.pop(key, None)
+            try:
+                conn = self._connect()
+                if conn.execute(f"DELETE FROM {self.table} WHERE key=?", (key,)).rowcount:
+                    self.count -= 1
+                conn.commit()
+            except sqlite3.Error:
+                pass
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.touched.clear()
+            try:
+                conn = self._connect()
+                conn.execute(f"DELETE FROM {self.table}")
+                conn.commit()
+                self.count = 0
+            except sqlite3.Error:
+                pass
+
+    def items(self, limit=None):
+        # (key, value) روی دیسک، تازه‌ترین استفاده اول
+        with self.lock:
+            try:
+                conn = self._connect()
+                self._flush_touched(conn)
+                rows = conn.execute(
+                    f"SELECT key, value FROM {self.table} ORDER BY last_used DESC LIMIT ?",
+                    (-1 if limit is None else limit,)
+                ).fetchall()
+            except sqlite3.Error:
+                rows = []
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": self.count,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                try:
+                    self._flush_touched(self.conn)
+                    self.conn.commit()
+                    self.conn.close()
+                except sqlite3.Error:
+                    pass
+                self.conn = None
+
+
+def encode_polyline(points, precision=5):
+    # الگوریتم Encoded Polyline گوگل؛ ذخیره‌ی فشرده‌ی فهرست نقاط
+    factor = 10 ** precision
+    out = []
+    prev_lat = prev_lon = 0
+    for lat, lon in points:
+        ilat = int(round(lat * factor))
+        ilon = int(round(lon * factor))
+        for delta in (ilat - prev_lat, ilon - prev_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                out.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            out.append(chr(value + 63))
+        prev_lat, prev_lon = ilat, ilon
+    return "".join(out)
+
+
+def decode_polyline(encoded, precision=5):
+    factor = 10 ** precision
+    points = []
+    index = lat = lon = 0
+    length = len(encoded)
+    while index < length:
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                b = ord(encoded[index]) - 63
+                index += 1
+                result |= (b & 0x1F) << shift
+                shift += 5
+                if b < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        points.append((lat / factor, lon / factor))
+    return points
+
+
+def quantize_coord(lat, lon, precision_m):
+    # گرد کردن مختصات روی شبکه‌ای با اندازه‌ی تقریبی precision_m متر
+    lat_step = precision_m / 111_320.0
+    ilat = round(lat / lat_step)
+    lon_step = precision_m / (111_320.0 * max(math.cos(math.radians(ilat * lat_step)), 1e-6))
+    return ilat, round(lon / lon_step)
+
+
+class RouteCache:
+    # کش مسیر: حافظه (نقاط آماده) + دیسک (polyline فشرده)، با کلید مبدأ/مقصد گرد‌شده و پروفایل
+    def __init__(self, path, profile=ROUTE_PROFILE, precision_m=ROUTE_CACHE_PRECISION_M,
+                 ttl_s=ROUTE_CACHE_TTL_S, max_entries=ROUTE_CACHE_MAX_ENTRIES, memory_entries=64):
+        self.profile = profile
+        self.precision_m = precision_m
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()  # key -> route
+        self.lock = threading.Lock()
+        self.disk = SqliteCache(path, "routes", ttl_s=ttl_s, max_entries=max_entries, memory_entries=0)
+
+    def key(self, start_lat, start_lon, end_lat, end_lon):
+        a = quantize_coord(start_lat, start_lon, self.precision_m)
+        b = quantize_coord(end_lat, end_lon, self.precision_m)
+        return f"{self.profile}:{self.precision_m}:{a[0]},{a[1]};{b[0]},{b[1]}"
+
+    def get(self, start_lat, start_lon, end_lat, end_lon, allow_stale=False):
+        key = self.key(start_lat, start_lon, end_lat, end_lon)
+        with self.lock:
+            route = self.memory.get(key)
+            if route is not None:
+                # حافظه از TTL دیسک پیروی نمی‌کند؛ عمرش محدود به همین اجراست
+                self.memory.move_to_end(key)
+                return route
+        value = self.disk.get(key, allow_stale=allow_stale)
+        if not value:
+            return None
+        route = {
+            "points": decode_polyline(value["polyline"]),
+            "distance_m": value["distance_m"],
+            "duration_s": value["duration_s"],
+        }
+        self._remember(key, route)
+        return route
+
+    def put(self, start_lat, start_lon, end_lat, end_lon, route):
+        key = self.key(start_lat, start_lon, end_lat, end_lon)
+        self._remember(key, route)
+        self.disk.put(key, {
+            "polyline": encode_polyline(route["points"]),
+            "distance_m": route["distance_m"],
+            "duration_s": route["duration_s"],
+        })
+
+    def _remember(self, key, route):
+        with self.lock:
+            self.memory[key] = route
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+
+    def invalidate(self, start_lat, start_lon, end_lat, end_lon):
+        key = self.key(start_lat, start_lon, end_lat, end_lon)
+        with self.lock:
+            self.memory.pop(key, None)
+        self.disk.delete(key)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        self.disk.clear()
+
+    def stats(self):
+        stats = self.disk.stats()
+        stats["memory_entries"] = len(self.memory)
+        return stats
+
+    def close(self):
+        self.disk.close()
+
+
+class TileStore:
+    # انبار کاشی روی دیسک با چیدمان MBTiles (یک جدول برای هر کلید استایل، ردیف‌ها به صورت TMS)،
+    # سقف حجم با حذف LRU، اعتبارسنجی دوباره با ETag/Expires و حالت فقط-آفلاین
+    def __init__(self, path, max_bytes=TILE_STORE_MAX_BYTES, offline=TILE_OFFLINE_ONLY):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.total_bytes = 0
+        self.tables = set()
+        self.touched = {}  # (table, z, x, row) -> last_used
+        self.conn = None
+        self.lock = threading.RLock()
+
+    def _connect(self):
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("INSERT OR IGNORE INTO metadata (name, value) VALUES ('format', 'png')")
+            for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'tiles_%'"):
+                self.tables.add(name)
+                self.total_bytes += conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {name}").fetchone()[0]
+            self.conn = conn
+        return self.conn
+
+    def _table(self, conn, style_key):
+        table = "tiles_" + re.sub(r"\W", "_", style_key)
+        if table not in self.tables:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB, "
+                "etag TEXT, expires REAL, last_used REAL, size INTEGER, "
+                "PRIMARY KEY (zoom_level, tile_column, tile_row))"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_lru ON {table}(last_used)")
+            self.tables.add(table)
+        return table
+
+    @staticmethod
+    def _tms_row(zoom, y):
+        return (1 << zoom) - 1 - y
+
+    def get(self, style_key, zoom, x, y):
+        # خروجی: (data, etag, expires) یا None
+        with self.lock:
+            try:
+                conn = self._connect()
+                table = self._table(conn, style_key)
+                row = self._tms_row(zoom, y)
+                result = conn.execute(
+                    f"SELECT tile_data, etag, expires FROM {table} WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                    (zoom, x, row)
+                ).fetchone()
+                if result is not None:
+                    self.touched[(table, zoom, x, row)] = time.time()
+                    if len(self.touched) > 256:
+                        self._flush_touched(conn)
+                        conn.commit()
+                return result
+            except sqlite3.Error:
+                return None
+
+    def has_fresh(self, style_key, zoom, x, y):
+        result = self.get(style_key, zoom, x, y)
+        return result is not None and (self.offline or result[2] > time.time())
+
+    def put(self, style_key, zoom, x, y, data, etag=None, expires=None):
+        now = time.time()
+        with self.lock:
+            try:
+                conn = self._connect()
+                table = self._table(conn, style_key)
+                row = self._tms_row(zoom, y)
+                old = conn.execute(
+                    f"SELECT size FROM {table} WHERE zoom_level=? AND tile_column=? AND tile_row=?", (zoom, x, row)
+                ).fetchone()
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {table} "
+                    "(zoom_level, tile_column, tile_row, tile_data, etag, expires, last_used, size) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (zoom, x, row, sqlite3.Binary(data), etag, expires or now + TILE_DEFAULT_MAX_AGE_S, now, len(data))
+                )
+                self.touched.pop((table, zoom, x, row), None)
+                self.total_bytes += len(data) - (old[0] if old else 0)
+                if self.total_bytes > self.max_bytes:
+                    self._evict(conn)
+                conn.commit()
+            except sqlite3.Error:
+                pass
+
+    def refresh(self, style_key, zoom, x, y, expires):
+        # پاسخ 304: فقط زمان انقضا تمدید می‌شود
+        with self.lock:
+            try:
+                conn = self._connect()
+                table = self._table(conn, style_key)
+                conn.execute(
+                    f"UPDATE {table} SET expires=?, last_used=? WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                    (expires, time.time(), zoom, x, self._tms_row(zoom, y))
+                )
+                conn.commit()
+            except sqlite3.Error:
+                pass
+
+    def _flush_touched(self, conn):
+        for (table, zoom, x, row), t in self.touched.items():
+            conn.execute(
+                f"UPDATE {table} SET last_used=? WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                (t, zoom, x, row)
+            )
+        self.touched.clear()
+
+    def _evict(self, conn):
+        # حذف کم‌استفاده‌ترین کاشی‌ها در همه‌ی استایل‌ها تا ۹۰٪ بودجه
+        self._flush_touched(conn)
+        target = int(self.max_bytes * 0.9)
+        union = " UNION ALL ".join(
+            f"SELECT '{t}', zoom_level, tile_column, tile_row, size, last_used FROM {t}" for t in self.tables
+        )
+        while self.total_bytes > target:
+            victims = conn.execute(f"SELECT * FROM ({union}) ORDER BY last_used LIMIT 500").fetchall()
+            if not victims:
+                break
+            for table, zoom, x, row, size, _ in victims:
+                conn.execute(
+                    f"DELETE FROM {table} WHERE zoom_level=? AND tile_column=? AND tile_row=?", (zoom, x, row)
+                )
+                self.total_bytes -= size or 0
+                if self.total_bytes <= target:
+                    break
+
+    @staticmethod
+    def _expires_from_headers(headers):
+        now = time.time()
+        max_age = None
+        match = re.search(r"max-age=(\d+)", headers.get("Cache-Control", ""))
+        if match:
+            max_age = int(match.group(1))
+        elif headers.get("Expires"):
+            try:
+                max_age = parsedate_to_datetime(headers["Expires"]).timestamp() - now
+            except (TypeError, ValueError):
+                max_age = None
+        if max_age is None:
+            max_age = TILE_DEFAULT_MAX_AGE_S
+        return now + max(max_age, TILE_MIN_MAX_AGE_S)
+
+    def load(self, style_key, url_template, zoom, x, y, session=None):
+        # بایت‌های کاشی: اول دیسک، سپس اعتبارسنجی/دانلود از سرور (مگر در حالت آفلاین)
+        cached = self.get(style_key, zoom, x, y)
+        if cached is not None and (self.offline or cached[2] > time.time()):
+            return cached[0]
+        if self.offline:
+            return None
+
+        url = url_template.replace("{x}", str(x)).replace("{y}", str(y)).replace("{z}", str(zoom))
+        headers = {}
+        if cached is not None and cached[1]:
+            headers["If-None-Match"] = cached[1]
+        try:
+            with METRICS.span("tile.fetch", "network"):
+                r = (session or http_client("tiles")).get(url, headers=headers, timeout=10)
+        except requests.RequestException:
+            return cached[0] if cached is not None else None
+
+        if r.status_code == 304 and cached is not None:
+            self.refresh(style_key, zoom, x, y, self._expires_from_headers(r.headers))
+            return cached[0]
+        if r.status_code == 200 and r.content:
+            self.put(style_key, zoom, x, y, r.content, r.headers.get("ETag"), self._expires_from_headers(r.headers))
+            return r.content
+        return cached[0] if cached is not None else None
+
+    def average_tile_size(self, style_key):
+        with self.lock:
+            try:
+                conn = self._connect()
+                table = self._table(conn, style_key)
+                avg = conn.execute(f"SELECT AVG(size) FROM {table}").fetchone()[0]
+            except sqlite3.Error:
+                avg = None
+        return int(avg) if avg else PREFETCH_DEFAULT_TILE_BYTES
+
+    def get_meta(self, name):
+        with self.lock:
+            try:
+                row = self._connect().execute("SELECT value FROM metadata WHERE name=?", (name,)).fetchone()
+            except sqlite3.Error:
+                row = None
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, name, value):
+        with self.lock:
+            try:
+                conn = self._connect()
+                if value is None:
+                    conn.execute("DELETE FROM metadata WHERE name=?", (name,))
+                else:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                        (name, json.dumps(value, ensure_ascii=False))
+                    )
+                conn.commit()
+            except sqlite3.Error:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {"bytes": self.total_bytes, "max_bytes": self.max_bytes, "offline": self.offline}
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                try:
+                    self._flush_touched(self.conn)
+                    self.conn.commit()
+                    self.conn.close()
+                except sqlite3.Error:
+                    pass
+                self.conn = None
+
+
+class TilePool(dict):
+    # کاشی‌های رمزگشایی‌شده‌ی یک استایل؛ جایگزین dict کتابخانه (tile_image_cache) با حساب حافظه
+    def __init__(self, pools, style_key):
+        super().__init__()
+        self.pools = pools
+        self.style_key = style_key
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __setitem__(self, key, image):
+        self.pools.put(self, key, image)
+
+    def __delitem__(self, key):
+        self.pools.discard(self, key)
+
+    def lookup(self, key):
+        # مثل get_tile_image_from_cache کتابخانه: False یعنی نیست
+        return self.pools.lookup(self, key)
+
+
+class TilePools:
+    # یک TilePool برای هر استایل با سقف حافظه‌ی مشترک و LRU سراسری؛
+    # با تعویض استایل چیزی دور ریخته نمی‌شود و برگشت به استایل قبلی از حافظه رسم می‌شود
+    def __init__(self, max_bytes=TILE_POOL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.pools = {}
+        self.order = OrderedDict()  # (style_key, key) -> bytes، قدیمی‌ترین اول
+        self.lock = threading.RLock()
+
+    def pool(self, style_key):
+        with self.lock:
+            pool = self.pools.get(style_key)
+            if pool is None:
+                pool = self.pools[style_key] = TilePool(self, style_key)
+            return pool
+
+    @staticmethod
+    def _image_bytes(image):
+        # PhotoImage در Tk برای هر پیکسل ۴ بایت نگه می‌دارد، فارغ از حجم فایل PNG/JPEG
+        try:
+            return image.width() * image.height() * 4
+        except Exception:
+            return 256 * 256 * 4
+
+    def put(self, pool, key, image):
+        size = self._image_bytes(image)
+        with self.lock:
+            self._forget(pool, key)
+            dict.__setitem__(pool, key, image)
+            self.order[(pool.style_key, key)] = size
+            pool.bytes += size
+            self.used += size
+            while self.used > self.max_bytes and len(self.order) > 1:
+                (style_key, old_key), _ = next(iter(self.order.items()))
+                self._forget(self.pools[style_key], old_key)
+
+    def _forget(self, pool, key):
+        size = self.order.pop((pool.style_key, key), None)
+        if size is not None:
+            dict.__delitem__(pool, key)
+            pool.bytes -= size
+            self.used -= size
+
+    def discard(self, pool, key):
+        with self.lock:
+            self._forget(pool, key)
+
+    def lookup(self, pool, key):
+        with self.lock:
+            image = dict.get(pool, key)
+            if image is None:
+                pool.misses += 1
+                return False
+            pool.hits += 1
+            self.order.move_to_end((pool.style_key, key))
+            return image
+
+    def stats(self):
+        with self.lock:
+            styles = {}
+            for style_key, pool in self.pools.items():
+                lookups = pool.hits + pool.misses
+                styles[style_key] = {
+                    "tiles": len(pool), "bytes": pool.bytes, "hits": pool.hits, "misses": pool.misses,
+                    "hit_rate": round(pool.hits / lookups, 3) if lookups else None,
+                }
+            return {"bytes": self.used, "max_bytes": self.max_bytes, "styles": styles}
+
+
+def adjacent_styles(style_key, count=TILE_PREWARM_STYLES):
+    # به ترتیب نزدیکی در فهرست دکمه‌ها: بعدی، قبلی، دو بعدی، ...
+    keys = list(TILE_STYLES)
+    if style_key not in keys or count <= 0:
+        return []
+    i = keys.index(style_key)
+    found = []
+    for step in range(1, len(keys)):
+        for j in (i + step, i - step):
+            key = keys[j % len(keys)]
+            if key != style_key and key not in found:
+                found.append(key)
+    return found[:count]
+
+
+# =========================
+# مسیریابی چندتوقفی
+# =========================
+def fetch_osrm_route(waypoints, session=None, timeout=10):
+    # waypoints: [(lat, lon), ...]؛ خروجی همان دیکشنری get_route یا None
+    coords = ";".join(f"{lon},{lat}" for lat, lon in waypoints)
+    url = f"{OSRM_URL}/route/v1/{ROUTE_PROFILE}/{coords}"
+    params = {"overview": "full", "geometries": "geojson"}
+    r = (session or http_client("osrm")).get(url, params=params, timeout=timeout)
+    if r.status_code != 200:
+        return None
+    data = r.json()
+    if not data.get("routes"):
+        return None
+    route0 = data["routes"][0]
+    points = [(lat, lon) for lon, lat in route0["geometry"]["coordinates"]]
+    return {
+        "points": points,
+        "distance_m": float(route0.get("distance", 0.0)),
+        "duration_s": float(route0.get("duration", 0.0)),
+    }
+
+
+def fetch_osrm_table(stops, sources, destinations, session=None, timeout=20):
+    # یک بلوک از ماتریس: سطرهای sources در ستون‌های destinations (اندیس‌ها در stops)
+    used = sorted(set(sources) | set(destinations))
+    position = {i: p for p, i in enumerate(used)}
+    coords = ";".join(f"{stops[i][1]},{stops[i][0]}" for i in used)
+    url = f"{OSRM_URL}/table/v1/{ROUTE_PROFILE}/{coords}"
+    params = {
+        "sources": ";".join(str(position[i]) for i in sources),
+        "destinations": ";".join(str(position[i]) for i in destinations),
+        "annotations": "duration,distance",
+    }
+    r = (session or http_client("osrm")).get(url, params=params, timeout=timeout)
+    r.raise_for_status()
+    data = r.json()
+    if data.get("code") != "Ok":
+        raise ValueError(data.get("message") or data.get("code"))
+    return data["durations"], data.get("distances")
+
+
+def fallback_cost(a, b):
+    # جفت‌هایی که سرور مسیری برایشان ندارد: فاصله‌ی مستقیم با ضریب پیچ‌وخم و سرعت ۳۶ کیلومتر بر ساعت
+    distance = haversine_m(a[0], a[1], b[0], b[1]) * 1.4
+    return distance / 10.0, distance
+
+
+def tour_cost(cost, tour):
+    return sum(cost[a][b] for a, b in zip(tour, tour[1:]))
+
+
+def nearest_neighbor_tour(cost, start=0):
+    n = len(cost)
+    tour = [start]
+    left = set(range(n)) - {start}
+    while left:
+        row = cost[tour[-1]]
+        nxt = min(left, key=row.__getitem__)
+        left.remove(nxt)
+        tour.append(nxt)
+    return tour
+
+
+def two_opt(cost, tour, deadline):
+    # مسیر باز با مبدأ ثابت؛ برعکس کردن tour[i..j] (ماتریس متقارن فرض شده)
+    n = len(tour)
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(1, n - 1):
+            a = tour[i - 1]
+            b = tour[i]
+            row_a = cost[a]
+            row_b = cost[b]
+            base = row_a[b]
+            for j in range(i + 1, n):
+                c = tour[j]
+                if j + 1 < n:
+                    d = tour[j + 1]
+                    delta = row_a[c] + row_b[d] - base - cost[c][d]
+                else:
+                    delta = row_a[c] - base
+                if delta < -1e-9:
+                    tour[i:j + 1] = tour[i:j + 1][::-1]
+                    improved = True
+                    b = tour[i]
+                    row_b = cost[b]
+                    base = row_a[b]
+    return tour
+
+
+def or_opt(cost, tour, deadline, max_len=3):
+    # جابه‌جایی زنجیره‌های ۱ تا ۳ توقفی (مستقیم یا برعکس) به بهترین جای دیگر مسیر
+    n = len(tour)
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for seg_len in range(1, max_len + 1):
+            i = 1
+            while i + seg_len <= n:
+                first, last = tour[i], tour[i + seg_len - 1]
+                prev = tour[i - 1]
+                nxt = tour[i + seg_len] if i + seg_len < n else None
+                removed = cost[prev][first] - (cost[prev][nxt] if nxt is not None else 0.0)
+                if nxt is not None:
+                    removed += cost[last][nxt]
+                best = (-1e-9, None, False)
+                for k in range(n):
+                    if i - 1 <= k < i + seg_len:
+                        continue
+                    a = tour[k]
+                    b = tour[k + 1] if k + 1 < n else None
+                    ab = cost[a][b] if b is not None else 0.0
+                    forward = cost[a][first] + (cost[last][b] if b is not None else 0.0) - ab
+                    backward = cost[a][last] + (cost[first][b] if b is not None else 0.0) - ab
+                    gain = min(forward, backward) - removed
+                    if gain < best[0]:
+                        best = (gain, k, backward < forward)
+                if best[1] is not None:
+                    segment = tour[i:i + seg_len]
+                    if best[2]:
+                        segment.reverse()
+                    k = best[1]
+                    rest = tour[:i] + tour[i + seg_len:]
+                    at = k + 1 if k < i else k + 1 - seg_len
+                    tour[:] = rest[:at] + segment + rest[at:]
+                    improved = True
+                i += 1
+    return tour
+
+
+def solve_tour(cost, start=0, time_limit_s=TRIP_SOLVE_TIME_S):
+    # همسایه‌ی نزدیک + تکرار 2-opt و Or-opt تا بهبودی نماند یا زمان تمام شود
+    deadline = time.monotonic() + time_limit_s
+    tour = nearest_neighbor_tour(cost, start)
+    if len(tour) < 4:
+        return tour
+    while True:
+        before = tour_cost(cost, tour)
+        two_opt(cost, tour, deadline)
+        or_opt(cost, tour, deadline)
+        if tour_cost(cost, tour) >= before - 1e-9 or time.monotonic() >= deadline:
+            return tour
+
+
+class TripPlanner:
+    # ترتیب بهینه‌ی بازدید از چند توقف: ماتریس زمان/فاصله از /table (بلوکی و کش‌شده به ازای هر جفت)،
+    # حل روی ماتریس متقارن‌شده‌ی زمان، و هندسه از /route چندنقطه‌ای در تکه‌های پیوسته
+    def __init__(self, path, precision_m=ROUTE_CACHE_PRECISION_M, block=TABLE_MAX_COORDS // 2):
+        self.precision_m = precision_m
+        self.block = block
+        self.cache = SqliteCache(
+            path, "matrix", ttl_s=ROUTE_CACHE_TTL_S, max_entries=MATRIX_CACHE_MAX_ENTRIES, memory_entries=50_000
+        )
+        self.cancelled = False
+
+    def pair_key(self, a, b):
+        qa = quantize_coord(a[0], a[1], self.precision_m)
+        qb = quantize_coord(b[0], b[1], self.precision_m)
+        return f"{ROUTE_PROFILE}:{self.precision_m}:{qa[0]},{qa[1]};{qb[0]},{qb[1]}"
+
+    def matrix(self, stops, session=None, on_progress=None):
+        n = len(stops)
+        durations = [[0.0] * n for _ in range(n)]
+        distances = [[0.0] * n for _ in range(n)]
+        blocks = [list(range(i, min(i + self.block, n))) for i in range(0, n, self.block)]
+        pending = []
+        for rows in blocks:
+            for cols in blocks:
+                missing = False
+                for i in rows:
+                    for j in cols:
+                        if i == j:
+                            continue
+                        cached = self.cache.get(self.pair_key(stops[i], stops[j]))
+                        if cached:
+                            durations[i][j], distances[i][j] = cached
+                        else:
+                            missing = True
+                if missing:
+                    pending.append((rows, cols))
+
+        for done, (rows, cols) in enumerate(pending):
+            if self.cancelled:
+                return None, None
+            if on_progress is not None:
+                on_progress(done, len(pending))
+            try:
+                block_durations, block_distances = fetch_osrm_table(stops, rows, cols, session=session)
+            except (requests.RequestException, ValueError, KeyError):
+                block_durations = block_distances = None
+            fetched = []
+            for r, i in enumerate(rows):
+                for c, j in enumerate(cols):
+                    if i == j:
+                        continue
+                    duration = block_durations[r][c] if block_durations else None
+                    distance = block_distances[r][c] if block_distances else None
+                    if duration is None:
+                        duration, distance = fallback_cost(stops[i], stops[j])
+                    else:
+                        if distance is None:
+                            distance = fallback_cost(stops[i], stops[j])[1]
+                        fetched.append((self.pair_key(stops[i], stops[j]), [duration, distance]))
+                    durations[i][j], distances[i][j] = duration, distance
+            self.cache.put_many(fetched)
+        return durations, distances
+
+    def geometry(self, ordered, session=None):
+        # تکه‌های همپوشان (آخرین نقطه‌ی هر تکه اولین نقطه‌ی تکه‌ی بعد است)
+        points, distance_m, duration_s = [], 0.0, 0.0
+        step = TRIP_ROUTE_CHUNK - 1
+        for i in range(0, len(ordered) - 1, step):
+            if self.cancelled:
+                return None
+            chunk = ordered[i:i + TRIP_ROUTE_CHUNK]
+            try:
+                route = fetch_osrm_route(chunk, session=session)
+            except (requests.RequestException, ValueError, KeyError):
+                route = None
+            if route is None:
+                # بدون هندسه‌ی واقعی، خط مستقیم بین توقف‌ها
+                route = {"points": list(chunk), "distance_m": 0.0, "duration_s": 0.0}
+                for a, b in zip(chunk, chunk[1:]):
+                    duration, distance = fallback_cost(a, b)
+                    route["duration_s"] += duration
+                    route["distance_m"] += distance
+            points.extend(route["points"][1:] if points else route["points"])
+            distance_m += route["distance_m"]
+            duration_s += route["duration_s"]
+        return {"points": points, "distance_m": distance_m, "duration_s": duration_s}
+
+    def plan(self, stops, on_progress=None):
+        # stops[0] مبدأ ثابت است؛ خروجی دیکشنری get_route به‌علاوه‌ی order (اندیس‌ها در stops)
+        durations, distances = self.matrix(stops, on_progress=on_progress)
+        if durations is None:
+            return None
+        n = len(stops)
+        symmetric = [[(durations[i][j] + durations[j][i]) / 2.0 for j in range(n)] for i in range(n)]
+        order = solve_tour(symmetric, start=0)
+        route = self.geometry([stops[i] for i in order])
+        if route is None:
+            return None
+        route["order"] = order
+        route["matrix_duration_s"] = tour_cost(durations, order)
+        route["matrix_distance_m"] = tour_cost(distances, order)
+        return route
+
+    def cancel(self):
+        self.cancelled = True
+
+    def close(self):
+        self.cache.close()
+
+
+# =========================
+# مسیریابی آفلاین
+# =========================
+GRAPH_MAGIC = b"MVGRAPH1"
+KD_LEAF = 16  # نقاط هر برگ درخت k-d که خطی بررسی می‌شوند
+KD_SAMPLE_M = 100  # فاصله‌ی نمونه‌های میانی روی تکه‌های بلند هندسه در درخت k-d
+GRAPH_LANDMARKS = 16  # نشانه‌های ALT؛ هر کدام دو دایکسترای کامل هنگام ساخت و 8n بایت در فایل
+LANDMARK_ACTIVE = 4  # نشانه‌هایی که در هر جست‌وجو (بهترین‌ها برای همان مبدأ و مقصد) به کار می‌روند
+
+
+def _open_osm(path):
+    if path.endswith(".gz"):
+        import gzip
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        import bz2
+        return bz2.open(path, "rb")
+    return open(path, "rb")
+
+
+def _iter_osm(path, tags):
+    # پیمایش جریانی عناصر سطح بالا؛ عناصر پردازش‌شده پاک می‌شوند تا درخت در حافظه بزرگ نشود
+    from xml.etree.ElementTree import iterparse
+    with _open_osm(path) as f:
+        root = None
+        for event, elem in iterparse(f, events=("start", "end")):
+            if root is None:
+                root = elem
+            elif event == "end" and elem.tag in ("node", "way", "relation"):
+                if elem.tag in tags:
+                    yield elem
+                root.clear()
+
+
+def _way_speed_mps(tags):
+    speed = OFFLINE_SPEEDS_KMH[tags["highway"]]
+    maxspeed = tags.get("maxspeed", "")
+    match = re.match(r"\s*(\d+(?:\.\d+)?)\s*(mph)?", maxspeed)
+    if match:
+        speed = float(match.group(1)) * (1.609344 if match.group(2) else 1.0)
+    return max(speed, 1.0) / 3.6
+
+
+def _way_oneway(tags):
+    # ۱: فقط در جهت رئوس، ۱-: فقط خلاف آن، ۰: دوطرفه
+    value = tags.get("oneway", "")
+    if value in ("yes", "true", "1"):
+        return 1
+    if value == "-1":
+        return -1
+    if value == "no":
+        return 0
+    if tags["highway"] in ("motorway", "motorway_link") or tags.get("junction") in ("roundabout", "circular"):
+        return 1
+    return 0
+
+
+def read_osm_roads(path):
+    # گذر اول: راه‌های قابل تردد خودرو؛ گذر دوم: مختصات فقط رئوسی که در این راه‌ها به کار رفته‌اند
+    ways = []
+    uses = {}
+    for elem in _iter_osm(path, ("way",)):
+        tags = {t.get("k"): t.get("v") for t in elem.iter("tag")}
+        if tags.get("highway") not in OFFLINE_SPEEDS_KMH or tags.get("area") == "yes":
+            continue
+        if tags.get("access") in ("no", "private") or tags.get("motor_vehicle") in ("no", "private"):
+            continue
+        refs = [int(nd.get("ref")) for nd in elem.iter("nd")]
+        if len(refs) < 2:
+            continue
+        for ref in refs:
+            uses[ref] = uses.get(ref, 0) + 1
+        # دو سر هر راه همیشه تقاطع حساب می‌شوند
+        uses[refs[0]] += 1
+        uses[refs[-1]] += 1
+        ways.append((refs, _way_speed_mps(tags), _way_oneway(tags)))
+
+    coords = {}
+    for elem in _iter_osm(path, ("node",)):
+        node_id = int(elem.get("id"))
+        if node_id in uses:
+            coords[node_id] = (float(elem.get("lat")), float(elem.get("lon")))
+    return ways, uses, coords
+
+
+def _graph_distances(offsets, heads, weights, source):
+    # دایکسترای کامل روی CSR؛ فاصله‌ی رئوس دست‌نیافتنی inf می‌ماند
+    dist = [math.inf] * (len(offsets) - 1)
+    dist[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        for e in range(offsets[u], offsets[u + 1]):
+            nd = d + weights[e]
+            v = heads[e]
+            if nd < dist[v]:
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return dist
+
+
+def _road_landmarks(offsets, targets, weights, roffsets, rsources, rweights, count=GRAPH_LANDMARKS):
+    # انتخاب «دورترین»: هر نشانه‌ی تازه رأسی است که رفت و برگشتش تا نزدیک‌ترین نشانه‌ی قبلی بیشترین باشد.
+    # شروع از پرشاخه‌ترین تقاطع تا نشانه‌ها در مؤلفه‌ی اصلی بیفتند نه در جزیره‌های کوچک لبه‌ی نقشه
+    np = _numpy()
+    n = len(offsets) - 1
+    node = int(np.argmax(np.diff(offsets)))
+    cover = None
+    lm_from, lm_to = [], []
+    for _ in range(min(count, n) + 1):
+        forward = np.asarray(_graph_distances(offsets, targets, weights, node))
+        backward = np.asarray(_graph_distances(roffsets, rsources, rweights, node))
+        if cover is None:
+            cover = forward + backward
+        else:
+            lm_from.append(forward)
+            lm_to.append(backward)
+            cover = np.minimum(cover, forward + backward)
+        node = int(np.argmax(np.where(np.isfinite(cover), cover, -1.0)))
+    return np.concatenate(lm_from), np.concatenate(lm_to)
+
+
+def build_road_graph(osm_path, out_path=OFFLINE_GRAPH_FILE):
+    # گراف فشرده: فقط تقاطع‌ها رأس‌اند و زنجیره‌ی رئوس بین دو تقاطع یک «قطعه» با هندسه‌ی کامل است.
+    # یال‌ها به صورت CSR (و CSR معکوس برای جست‌وجوی پس‌رو)، فاصله تا نشانه‌های ALT و درخت k-d ضمنی روی نقاط هندسه
+    np = _numpy()
+    ways, uses, coords = read_osm_roads(osm_path)
+
+    node_of = {}
+    node_lat, node_lon = [], []
+
+    def node(ref):
+        index = node_of.get(ref)
+        if index is None:
+            index = node_of[ref] = len(node_lat)
+            lat, lon = coords[ref]
+            node_lat.append(lat)
+            node_lon.append(lon)
+        return index
+
+    shape_lat, shape_lon, shape_cum, shape_seg = [], [], [], []
+    seg_start, seg_len, seg_dur, seg_oneway, seg_u, seg_v = [], [], [], [], [], []
+    src, dst, weight, edge_seg = [], [], [], []
+    for refs, speed, oneway in ways:
+        refs = [r for r in refs if r in coords]
+        if len(refs) < 2:
+            continue
+        start = 0
+        for i in range(1, len(refs)):
+            if i < len(refs) - 1 and uses[refs[i]] < 2:
+                continue
+            seg = len(seg_start)
+            seg_start.append(len(shape_lat))
+            length = 0.0
+            prev = None
+            for ref in refs[start:i + 1]:
+                lat, lon = coords[ref]
+                if prev is not None:
+                    length += haversine_m(prev[0], prev[1], lat, lon)
+                prev = (lat, lon)
+                shape_lat.append(lat)
+                shape_lon.append(lon)
+                shape_cum.append(length)
+                shape_seg.append(seg)
+            u, v = node(refs[start]), node(refs[i])
+            duration = length / speed
+            seg_len.append(length)
+            seg_dur.append(duration)
+            seg_oneway.append(oneway)
+            seg_u.append(u)
+            seg_v.append(v)
+            if oneway >= 0:
+                src.append(u)
+                dst.append(v)
+                weight.append(duration)
+                edge_seg.append(seg)
+            if oneway <= 0:
+                src.append(v)
+                dst.append(u)
+                weight.append(duration)
+                edge_seg.append(~seg)
+            start = i
+    seg_start.append(len(shape_lat))
+    if not seg_len:
+        raise ValueError("no drivable roads found in the extract")
+
+    n = len(node_lat)
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    order = np.argsort(src, kind="stable")
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(src, minlength=n))))
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.arange(len(order))
+    rorder = np.argsort(dst, kind="stable")
+    roffsets = np.concatenate(([0], np.cumsum(np.bincount(dst, minlength=n))))
+    weights = np.asarray(weight, dtype=np.float32)[order]
+    lm_from, lm_to = _road_landmarks(
+        offsets.tolist(), dst[order].tolist(), weights.tolist(),
+        roffsets.tolist(), src[rorder].tolist(), weights[position[rorder]].tolist()
+    )
+
+    # نمونه‌های درخت k-d: همه‌ی نقاط هندسه (اندیس نقطه) و روی تکه‌های بلندتر از KD_SAMPLE_M
+    # نقاط میانی (~اندیس ابتدای تکه)، تا هر نقطه‌ی هر تکه حداکثر نیم گام با نمونه‌ای از همان تکه فاصله داشته باشد
+    lat = np.asarray(shape_lat)
+    lat0 = math.radians(float(lat.mean()))
+    kd_step = KD_SAMPLE_M / (EARTH_RADIUS_M * math.pi / 180)
+    x, y = np.asarray(shape_lon) * math.cos(lat0), lat
+    piece = np.flatnonzero(np.diff(np.asarray(shape_seg)) == 0)
+    parts = np.maximum(np.ceil(np.hypot(x[piece + 1] - x[piece], y[piece + 1] - y[piece]) / kd_step), 1).astype(np.int64)
+    inner = np.repeat(piece, parts - 1)
+    t = (np.arange(len(inner)) - np.repeat(np.cumsum(parts - 1) - (parts - 1), parts - 1) + 1) / np.repeat(parts, parts - 1)
+    kd_x = np.concatenate((x, x[inner] + t * (x[inner + 1] - x[inner])))
+    kd_y = np.concatenate((y, y[inner] + t * (y[inner + 1] - y[inner])))
+    kd_ref = np.concatenate((np.arange(len(x)), ~inner))
+
+    # درخت k-d ضمنی: بازه‌ی [lo, hi) با میانه‌ی mid روی محور depth % 2 تقسیم می‌شود
+    kd_order = np.arange(len(kd_x))
+    stack = [(0, len(kd_x), 0)]
+    while stack:
+        lo, hi, depth = stack.pop()
+        if hi - lo <= KD_LEAF:
+            continue
+        mid = (lo + hi) // 2
+        sub = kd_order[lo:hi]
+        kd_order[lo:hi] = sub[np.argpartition((kd_x, kd_y)[depth % 2][sub], mid - lo)]
+        stack.append((lo, mid, depth + 1))
+        stack.append((mid + 1, hi, depth + 1))
+
+    arrays = {
+        "node_lat": ("d", node_lat), "node_lon": ("d", node_lon),
+        "offsets": ("q", offsets), "targets": ("i", dst[order]), "weights": ("f", weights),
+        "edge_seg": ("i", np.asarray(edge_seg)[order]),
+        "roffsets": ("q", roffsets), "rsources": ("i", src[rorder]), "redges": ("i", position[rorder]),
+        "lm_from": ("f", lm_from), "lm_to": ("f", lm_to),
+        "seg_start": ("q", seg_start), "seg_len": ("f", seg_len), "seg_dur": ("f", seg_dur),
+        "seg_oneway": ("b", seg_oneway), "seg_u": ("i", seg_u), "seg_v": ("i", seg_v),
+        "shape_lat": ("d", shape_lat), "shape_lon": ("d", shape_lon), "shape_cum": ("f", shape_cum),
+        "shape_seg": ("i", shape_seg),
+        "kd_x": ("d", kd_x[kd_order]), "kd_y": ("d", kd_y[kd_order]), "kd_ref": ("i", kd_ref[kd_order]),
+    }
+    dtypes = {"d": np.float64, "f": np.float32, "q": np.int64, "i": np.int32, "b": np.int8}
+    blobs = {name: np.asarray(values, dtype=dtypes[code]).tobytes() for name, (code, values) in arrays.items()}
+    meta = {
+        "source": os.path.basename(osm_path), "built": timestamp(), "byteorder": sys.byteorder,
+        "nodes": n, "edges": len(src), "segments": len(seg_len), "shape_points": len(shape_lat),
+        "landmarks": len(lm_from) // n, "kd_cos_lat": math.cos(lat0), "kd_step": kd_step, "arrays": {},
+    }
+    offset = 0
+    for name, (code, _) in arrays.items():
+        meta["arrays"][name] = [offset, code, len(blobs[name]) // np.dtype(dtypes[code]).itemsize]
+        offset += (len(blobs[name]) + 7) // 8 * 8
+    header = json.dumps(meta).encode("utf-8")
+    header += b" " * (-(len(GRAPH_MAGIC) + 8 + len(header)) % 8)
+
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(GRAPH_MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for name in arrays:
+            f.write(blobs[name])
+            f.write(b"\0" * (-len(blobs[name]) % 8))
+    os.replace(tmp, out_path)
+    meta.pop("arrays")
+    return meta
+
+
+def struct_size(code):
+    return {"d": 8, "q": 8, "f": 4, "i": 4, "b": 1}[code]
+
+
+class OsrmRouter:
+    name = "osrm"
+
+    def route(self, waypoints):
+        route = fetch_osrm_route(waypoints, session=http_client("route"))
+        if route is None:
+            raise ValueError("no route")
+        return route
+
+    def close(self):
+        pass
+
+
+class OfflineRouter:
+    # مسیریابی روی فایل build-graph؛ آرایه‌ها مستقیماً از فایل mmap‌شده خوانده می‌شوند (memoryview)
+    # و جست‌وجو A* دوطرفه با پتانسیل میانگین است؛ کران پایین از نشانه‌ها (ALT) و نابرابری مثلث می‌آید
+    name = "offline"
+
+    def __init__(self, path=OFFLINE_GRAPH_FILE, snap_max_m=OFFLINE_SNAP_MAX_M):
+        self.snap_max_m = snap_max_m
+        self.file = open(path, "rb")
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            self.file.close()
+            raise ValueError(f"{path}: empty or unreadable graph file")
+        self.view = memoryview(self.mm)
+        self.arrays = {}
+        try:
+            if bytes(self.view[:len(GRAPH_MAGIC)]) != GRAPH_MAGIC:
+                raise ValueError(f"{path}: not a road graph file")
+            size = int.from_bytes(self.view[len(GRAPH_MAGIC):len(GRAPH_MAGIC) + 8], "little")
+            base = len(GRAPH_MAGIC) + 8
+            self.meta = json.loads(bytes(self.view[base:base + size]))
+            if self.meta["byteorder"] != sys.byteorder:
+                raise ValueError(f"{path}: built on a {self.meta['byteorder']}-endian machine")
+            base += size
+            for name, (offset, code, count) in self.meta["arrays"].items():
+                start = base + offset
+                self.arrays[name] = self.view[start:start + count * struct_size(code)].cast(code)
+        except (ValueError, KeyError):
+            self.close()
+            raise
+        for name, array in self.arrays.items():
+            setattr(self, name, array)
+        self.kd_cos_lat = self.meta["kd_cos_lat"]
+        self.kd_step = self.meta["kd_step"]
+
+    def close(self):
+        for array in self.arrays.values():
+            array.release()
+        self.arrays = {}
+        if getattr(self, "view", None) is not None:
+            self.view.release()
+            self.view = None
+            self.mm.close()
+        self.file.close()
+
+    # ---- اتصال نقطه به شبکه
+    def _project(self, i, x, y):
+        # تصویر نقطه روی تکه‌ی i تا i+1 هندسه: (فاصله، t)
+        lats, lons, kx = self.shape_lat, self.shape_lon, self.kd_cos_lat
+        ax, ay = lons[i] * kx, lats[i]
+        dx, dy = lons[i + 1] * kx - ax, lats[i + 1] - ay
+        length2 = dx * dx + dy * dy
+        t = min(max(((x - ax) * dx + (y - ay) * dy) / length2, 0.0), 1.0) if length2 > 0 else 0.0
+        return math.hypot(x - ax - t * dx, y - ay - t * dy), t
+
+    def nearest_piece(self, lat, lon):
+        # نزدیک‌ترین تکه‌ی هندسه: (اندیس ابتدای تکه، t). تکه‌ی بهینه نمونه‌ای در فاصله‌ی best + نیم گام دارد،
+        # پس هر نمونه‌ای در این شعاع روی تکه(های) خودش تصویر می‌شود و بقیه‌ی درخت هرس می‌شود
+        xs, ys, refs, segs = self.kd_x, self.kd_y, self.kd_ref, self.shape_seg
+        x, y, half = lon * self.kd_cos_lat, lat, self.kd_step / 2
+        best, best_piece, best_t = math.inf, -1, 0.0
+        last = len(segs) - 1
+
+        def visit(k):
+            nonlocal best, best_piece, best_t
+            if math.hypot(xs[k] - x, ys[k] - y) > best + half:
+                return
+            ref = refs[k]
+            if ref < 0:
+                pieces = (~ref,)
+            else:
+                pieces = [i for i in (ref - 1, ref) if 0 <= i < last and segs[i] == segs[i + 1]]
+            for i in pieces:
+                d, t = self._project(i, x, y)
+                if d < best:
+                    best, best_piece, best_t = d, i, t
+
+        stack = [(0, len(refs), 0, 0.0)]
+        while stack:
+            lo, hi, depth, bound = stack.pop()
+            if bound > best + half:
+                continue
+            if hi - lo <= KD_LEAF:
+                for k in range(lo, hi):
+                    visit(k)
+                continue
+            mid = (lo + hi) // 2
+            visit(mid)
+            diff = x - xs[mid] if depth % 2 == 0 else y - ys[mid]
+            near, far = ((lo, mid), (mid + 1, hi)) if diff < 0 else ((mid + 1, hi), (lo, mid))
+            stack.append((far[0], far[1], depth + 1, abs(diff)))
+            stack.append((near[0], near[1], depth + 1, 0.0))
+        return best_piece, best_t
+
+    def snap(self, lat, lon):
+        # خروجی: (قطعه، موقعیت) که موقعیت = (عرض، طول، اندیس ابتدای تکه، کسر پیموده‌شده از ابتدای قطعه)
+        i, t = self.nearest_piece(lat, lon)
+        if i >= 0:
+            lats, lons, cum = self.shape_lat, self.shape_lon, self.shape_cum
+            point = (lats[i] * (1 - t) + lats[i + 1] * t, lons[i] * (1 - t) + lons[i + 1] * t)
+        if i < 0 or haversine_m(lat, lon, *point) > self.snap_max_m:
+            raise ValueError(f"({lat:.5f}, {lon:.5f}) is too far from the road network")
+        seg = self.shape_seg[i]
+        length = self.seg_len[seg]
+        frac = (cum[i] * (1 - t) + cum[i + 1] * t) / length if length > 0 else 0.0
+        return seg, (point[0], point[1], i, frac)
+
+    # ---- جست‌وجو
+    def _landmarks(self, sources, targets):
+        # برای هر نشانه ثابت‌های کران پایین (با هزینه‌ی اولیه‌ی مبدأها و مقصدها) و کران کل مسیر؛
+        # LANDMARK_ACTIVE نشانه با بیشترین کران برای این جست‌وجو نگه داشته می‌شوند
+        n, lm_from, lm_to = self.meta["nodes"], self.lm_from, self.lm_to
+        ranked = []
+        for base in range(0, len(lm_from), n):
+            at = min(lm_from[base + v] + c for v, c in targets.items())
+            bt = max(lm_to[base + v] - c for v, c in targets.items())
+            fs = max(lm_from[base + v] - c for v, c in sources.items())
+            bs = min(lm_to[base + v] + c for v, c in sources.items())
+            if all(math.isfinite(c) for c in (at, bt, fs, bs)):
+                ranked.append((max(at - fs, bs - bt), base, at, bt, fs, bs))
+        ranked.sort(reverse=True)
+        return [r[1:] for r in ranked[:LANDMARK_ACTIVE]]
+
+    def _search(self, sources, targets):
+        # sources/targets: {رأس: هزینه‌ی اولیه}؛ خروجی (هزینه، رأس ملاقات، والد پیش‌رو، والد پس‌رو)
+        offsets, targets_, weights = self.offsets, self.targets, self.weights
+        roffsets, rsources, redges = self.roffsets, self.rsources, self.redges
+        lm_from, lm_to = self.lm_from, self.lm_to
+        active = self._landmarks(sources, targets)
+        potentials = {}
+
+        def potential(v):
+            # (کران فاصله تا مقصد - کران فاصله از مبدأ) / 2
+            p = potentials.get(v)
+            if p is None:
+                to_t = from_s = 0.0
+                for base, at, bt, fs, bs in active:
+                    f, b = lm_from[base + v], lm_to[base + v]
+                    if at - f > to_t:
+                        to_t = at - f
+                    if b - bt > to_t:
+                        to_t = b - bt
+                    if f - fs > from_s:
+                        from_s = f - fs
+                    if bs - b > from_s:
+                        from_s = bs - b
+                p = potentials[v] = (to_t - from_s) / 2
+            return p
+
+        dist_f, dist_r = dict(sources), dict(targets)
+        parent_f = {v: None for v in sources}
+        parent_r = {v: None for v in targets}
+        heap_f = [(d + potential(v), v) for v, d in sources.items()]
+        heap_r = [(d - potential(v), v) for v, d in targets.items()]
+        heapq.heapify(heap_f)
+        heapq.heapify(heap_r)
+        done_f, done_r = set(), set()
+        best, meet = math.inf, None
+        for v, d in sources.items():
+            if v in targets and d + targets[v] < best:
+                best, meet = d + targets[v], v
+
+        while heap_f and heap_r and heap_f[0][0] + heap_r[0][0] < best:
+            if len(heap_f) <= len(heap_r):
+                _, u = heapq.heappop(heap_f)
+                if u in done_f:
+                    continue
+                done_f.add(u)
+                du = dist_f[u]
+                for e in range(offsets[u], offsets[u + 1]):
+                    v = targets_[e]
+                    d = du + weights[e]
+                    if d < dist_f.get(v, math.inf):
+                        dist_f[v] = d
+                        parent_f[v] = (u, e)
+                        heapq.heappush(heap_f, (d + potential(v), v))
+                        other = dist_r.get(v)
+                        if other is not None and d + other < best:
+                            best, meet = d + other, v
+            else:
+                _, u = heapq.heappop(heap_r)
+                if u in done_r:
+                    continue
+                done_r.add(u)
+                du = dist_r[u]
+                for j in range(roffsets[u], roffsets[u + 1]):
+                    v = rsources[j]
+                    e = redges[j]
+                    d = du + weights[e]
+                    if d < dist_r.get(v, math.inf):
+                        dist_r[v] = d
+                        parent_r[v] = (u, e)
+                        heapq.heappush(heap_r, (d - potential(v), v))
+                        other = dist_f.get(v)
+                        if other is not None and d + other < best:
+                            best, meet = d + other, v
+        return best, meet, parent_f, parent_r
+
+    def _seg_points(self, seg, first, last):
+        # نقاط هندسه‌ی قطعه از اندیس first تا last (هر دو شامل؛ اگر last < first وارونه)
+        lats, lons = self.shape_lat, self.shape_lon
+        step = 1 if last >= first else -1
+        return [(lats[i], lons[i]) for i in range(first, last + step, step)]
+
+    def _seg_path(self, a, b):
+        # هندسه‌ی یک قطعه از موقعیت a تا موقعیت b (هم‌جهت یا خلاف جهت رئوس)
+        lats, lons = self.shape_lat, self.shape_lon
+        inner = range(a[2] + 1, b[2] + 1) if b[3] >= a[3] else range(a[2], b[2], -1)
+        points = [(a[0], a[1])] + [(lats[i], lons[i]) for i in inner] + [(b[0], b[1])]
+        # موقعیت تصویرشده ممکن است بر یک نقطه‌ی هندسه منطبق باشد
+        return [p for k, p in enumerate(points) if k == 0 or p != points[k - 1]]
+
+    def _seg_ends(self, seg, pos, leaving):
+        # سرهای قطعه که از موقعیت (leaving) یا به موقعیت قابل پیمودن‌اند: {رأس: (هزینه، موقعیت آن سر)}
+        first, last = self.seg_start[seg], self.seg_start[seg + 1] - 1
+        duration, oneway, frac = self.seg_dur[seg], self.seg_oneway[seg], pos[3]
+        ends = {}
+        if (oneway >= 0 if leaving else oneway <= 0) or frac == 1.0:
+            ends[self.seg_v[seg]] = (duration * (1 - frac), (self.shape_lat[last], self.shape_lon[last], last - 1, 1.0))
+        if (oneway <= 0 if leaving else oneway >= 0) or frac == 0.0:
+            u = self.seg_u[seg]
+            if u not in ends or duration * frac < ends[u][0]:
+                ends[u] = (duration * frac, (self.shape_lat[first], self.shape_lon[first], first, 0.0))
+        return ends
+
+    def _leg(self, a, b):
+        seg_a, pos_a = self.snap(*a)
+        seg_b, pos_b = self.snap(*b)
+        starts = self._seg_ends(seg_a, pos_a, True)
+        ends = self._seg_ends(seg_b, pos_b, False)
+        best, meet, parent_f, parent_r = self._search(
+            {v: c for v, (c, _) in starts.items()}, {v: c for v, (c, _) in ends.items()}
+        )
+
+        # هر دو نقطه روی یک قطعه: شاید مستقیم روی همان قطعه کوتاه‌تر باشد
+        if seg_a == seg_b:
+            oneway, frac_a, frac_b = self.seg_oneway[seg_a], pos_a[3], pos_b[3]
+            if frac_a == frac_b or (oneway >= 0 if frac_b > frac_a else oneway <= 0):
+                direct = abs(frac_b - frac_a) * self.seg_dur[seg_a]
+                if direct <= best:
+                    return self._seg_path(pos_a, pos_b), direct
+        if meet is None:
+            raise ValueError("no route between the points in the offline graph")
+
+        # یال‌های مسیر: از ملاقات به عقب تا مبدأ و به جلو تا مقصد
+        edges = []
+        v = meet
+        while parent_f[v] is not None:
+            v, e = parent_f[v]
+            edges.append(e)
+        points = self._seg_path(pos_a, starts[v][1])
+        edges.reverse()
+        v = meet
+        while parent_r[v] is not None:
+            v, e = parent_r[v]
+            edges.append(e)
+        seg_start = self.seg_start
+        for e in edges:
+            seg = self.edge_seg[e]
+            if seg >= 0:
+                points.extend(self._seg_points(seg, seg_start[seg], seg_start[seg + 1] - 1)[1:])
+            else:
+                seg = ~seg
+                points.extend(self._seg_points(seg, seg_start[seg + 1] - 1, seg_start[seg])[1:])
+        points.extend(self._seg_path(ends[v][1], pos_b)[1:])
+        return points, best
+
+    def route(self, waypoints):
+        # همان خروجی fetch_osrm_route
+        points, duration = [], 0.0
+        for a, b in zip(waypoints, waypoints[1:]):
+            leg, leg_duration = self._leg(a, b)
+            points.extend(leg[1:] if points else leg)
+            duration += leg_duration
+        distance = sum(haversine_m(p[0], p[1], q[0], q[1]) for p, q in zip(points, points[1:]))
+        return {"points": points, "distance_m": distance, "duration_s": duration}
+
+
+def make_routers(engine=ROUTE_ENGINE, graph_path=OFFLINE_GRAPH_FILE):
+    # ترتیب امتحان موتورها؛ در حالت auto گراف آفلاین (اگر ساخته شده) اول و OSRM پشتیبان است
+    routers = []
+    if engine in ("offline", "auto") and os.path.exists(graph_path):
+        try:
+            routers.append(OfflineRouter(graph_path))
+        except (OSError, ValueError):
+            pass
+    if engine in ("osrm", "auto"):
+        routers.append(OsrmRouter())
+    return routers
+
+
+# =========================
+# تحلیل چندضلعی
+# =========================
+def _numpy():
+    # numpy فقط در اولین تحلیل بارگذاری می‌شود تا شروع برنامه کند نشود
+    import numpy
+    return numpy
+
+
+def polygon_area_m2(polygon):
+    # مساحت روی کره‌ی زمین (فرمول فزونی کروی)؛ خطا نسبت به بیضوی WGS84 زیر ۰٫۵٪
+    np = _numpy()
+    ring = np.radians(np.asarray(polygon, dtype=float))
+    lat, lon = ring[:, 0], ring[:, 1]
+    lat2, lon2 = np.roll(lat, -1), np.roll(lon, -1)
+    dlon = (lon2 - lon + math.pi) % (2 * math.pi) - math.pi
+    return abs(float(np.sum(dlon * (2 + np.sin(lat) + np.sin(lat2))))) * EARTH_RADIUS_M ** 2 / 2
+
+
+def polygon_perimeter_m(polygon):
+    np = _numpy()
+    ring = np.radians(np.asarray(polygon, dtype=float))
+    lat, lon = ring[:, 0], ring[:, 1]
+    lat2, lon2 = np.roll(lat, -1), np.roll(lon, -1)
+    a = np.sin((lat2 - lat) / 2) ** 2 + np.cos(lat) * np.cos(lat2) * np.sin((lon2 - lon) / 2) ** 2
+    return float(np.sum(2 * EARTH_RADIUS_M * np.arcsin(np.minimum(1.0, np.sqrt(a)))))
+
+
+def points_in_polygon(lats, lons, polygon):
+    # ماسک بولی نقاط داخل چندضلعی: پیش‌فیلتر با قاب محیطی، سپس آزمون زوج/فرد روی نقاط باقی‌مانده
+    # (حلقه فقط روی اضلاع است؛ همه‌ی نقاط در هر ضلع یک‌جا بررسی می‌شوند)
+    np = _numpy()
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    ring = np.asarray(polygon, dtype=float)
+    mask = np.zeros(lats.shape, dtype=bool)
+    (lat_min, lon_min), (lat_max, lon_max) = ring.min(axis=0), ring.max(axis=0)
+    candidates = np.nonzero((lats >= lat_min) & (lats <= lat_max) & (lons >= lon_min) & (lons <= lon_max))[0]
+    if not len(candidates):
+        return mask
+    y, x = lats[candidates], lons[candidates]
+    inside = np.zeros(len(candidates), dtype=bool)
+    y1, x1 = ring[-1]
+    for y2, x2 in ring:
+        if y1 != y2:
+            crosses = (y1 > y) != (y2 > y)
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (x < x_cross)
+        y1, x1 = y2, x2
+    mask[candidates] = inside
+    return mask
+
+
+def analyze_polygon(polygon, entries):
+    # مساحت، محیط و ورودی‌هایی از entries (دیکشنری‌های lat/lon) که داخل منطقه‌اند
+    np = _numpy()
+    inside = []
+    if entries:
+        lats = np.fromiter((e["lat"] for e in entries), dtype=float, count=len(entries))
+        lons = np.fromiter((e["lon"] for e in entries), dtype=float, count=len(entries))
+        inside = [entries[i] for i in np.nonzero(points_in_polygon(lats, lons, polygon))[0]]
+    return {
+        "area_m2": polygon_area_m2(polygon),
+        "perimeter_m": polygon_perimeter_m(polygon),
+        "inside": inside,
+    }
+
+
+def export_polygon_geojson(path, polygon, result):
+    # منطقه به‌علاوه‌ی نقاط داخلش؛ همان قالبی که «ورود فایل نقاط» می‌خواند
+    ring = [[lon, lat] for lat, lon in polygon]
+    ring.append(ring[0])
+    area = {
+        "type": "Feature",
+        "geometry": {"type": "Polygon", "coordinates": [ring]},
+        "properties": {"area_m2": round(result["area_m2"], 1), "perimeter_m": round(result["perimeter_m"], 1),
+                       "points_inside": len(result["inside"])},
+    }
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write('{"type":"FeatureCollection","features":[\n')
+        f.write(json.dumps(area, ensure_ascii=False))
+        for e in result["inside"]:
+            point = {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [e["lon"], e["lat"]]},
+                "properties": {"label": e.get("label"), "address": e.get("address"), "ts": e.get("ts")},
+            }
+            f.write(",\n" + json.dumps(point, ensure_ascii=False))
+        f.write("\n]}\n")
+    os.replace(tmp, path)
+
+
+# =========================
+# ساده‌سازی خطوط
+# =========================
+def project_world_px(lat, lon):
+    # مختصات پیکسلی Web Mercator در زوم ۰ (دنیای ۲۵۶×۲۵۶)
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    x = (lon + 180.0) / 360.0 * 256.0
+    s = math.sin(math.radians(lat))
+    y = (0.5 - math.log((1 + s) / (1 - s)) / (4 * math.pi)) * 256.0
+    return x, y
+
+
+def douglas_peucker_ranks(xy):
+    # رتبه‌ی هر رأس = بیشترین تلرانسی که رأس در Douglas–Peucker با آن باقی می‌ماند.
+    # رتبه‌ها یک‌بار حساب می‌شوند و هر سطح جزئیات با یک فیلتر ساده به دست می‌آید.
+    n = len(xy)
+    ranks = [0.0] * n
+    if n == 0:
+        return ranks
+    ranks[0] = ranks[-1] = math.inf
+    stack = [(0, n - 1, math.inf)]
+    while stack:
+        first, last, parent_rank = stack.pop()
+        if last - first < 2:
+            continue
+        ax, ay = xy[first]
+        bx, by = xy[last]
+        dx, dy = bx - ax, by - ay
+        seg_len2 = dx * dx + dy * dy
+        best_d2, best_i = -1.0, first
+        for i in range(first + 1, last):
+            px, py = xy[i]
+            if seg_len2 == 0:
+                ex, ey = px - ax, py - ay
+            else:
+                t = ((px - ax) * dx + (py - ay) * dy) / seg_len2
+                if t < 0:
+                    t = 0.0
+                elif t > 1:
+                    t = 1.0
+                ex, ey = px - (ax + t * dx), py - (ay + t * dy)
+            d2 = ex * ex + ey * ey
+            if d2 > best_d2:
+                best_d2, best_i = d2, i
+        # رتبه‌ی فرزند از والد بیشتر نمی‌شود تا سطوح تو در تو بمانند
+        rank = min(math.sqrt(best_d2), parent_rank)
+        ranks[best_i] = rank
+        stack.append((first, best_i, rank))
+        stack.append((best_i, last, rank))
+    return ranks
+
+
+class PolylineLevels:
+    # نسخه‌ی چندسطحی یک خط: برای هر زوم فقط رئوسی که در آن مقیاس بیش از tolerance_px پیکسل اثر دارند
+    def __init__(self, points, tolerance_px=0.75):
+        self.points = points
+        self.tolerance_px = tolerance_px
+        self.ranks = douglas_peucker_ranks([project_world_px(lat, lon) for lat, lon in points])
+        self.levels = {}
+
+    def for_zoom(self, zoom):
+        zoom = int(round(zoom))
+        level = self.levels.get(zoom)
+        if level is None:
+            tolerance = self.tolerance_px / (2 ** zoom)
+            level = [p for p, r in zip(self.points, self.ranks) if r >= tolerance]
+            self.levels[zoom] = level
+        return level
+
+
+# =========================
+# پیش‌بارگذاری کاشی‌های یک منطقه
+# =========================
+def polygon_tile_spans(polygon, zoom):
+    # برای هر ردیف کاشی، بازه‌های ستونی که با چندضلعی تلاقی دارند: (y, x_from, x_to)
+    n = 1 << zoom
+    scale = n / 256.0
+    pts = [(x * scale, y * scale) for x, y in (project_world_px(lat, lon) for lat, lon in polygon)]
+    if len(pts) < 3:
+        return
+    edges = list(zip(pts, pts[1:] + pts[:1]))
+    ys = [p[1] for p in pts]
+    y_first = max(int(math.floor(min(ys))), 0)
+    y_last = min(int(math.floor(max(ys))), n - 1)
+
+    for ty in range(y_first, y_last + 1):
+        intervals = []
+        # کاشی‌هایی که ضلعی از چندضلعی از آن‌ها می‌گذرد
+        for (ax, ay), (bx, by) in edges:
+            lo, hi = max(min(ay, by), ty), min(max(ay, by), ty + 1)
+            if lo > hi:
+                continue
+            if ay == by:
+                xa, xb = ax, bx
+            else:
+                xa = ax + (bx - ax) * (lo - ay) / (by - ay)
+                xb = ax + (bx - ax) * (hi - ay) / (by - ay)
+            intervals.append((math.floor(min(xa, xb)), math.floor(max(xa, xb))))
+        # کاشی‌هایی که کاملاً داخل چندضلعی‌اند (زوج/فرد روی خط وسط ردیف)
+        yc = ty + 0.5
+        crossings = sorted(
+            ax + (bx - ax) * (yc - ay) / (by - ay)
+            for (ax, ay), (bx, by) in edges if (ay <= yc) != (by <= yc)
+        )
+        for i in range(0, len(crossings) - 1, 2):
+            intervals.append((math.floor(crossings[i]), math.floor(crossings[i + 1])))
+
+        intervals.sort()
+        merged = []
+        for a, b in intervals:
+            a, b = max(a, 0), min(b, n - 1)
+            if a > b:
+                continue
+            if merged and a <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], b)
+            else:
+                merged.append([a, b])
+        for a, b in merged:
+            yield ty, a, b
+
+
+class TilePrefetcher:
+    # دانلود همه‌ی کاشی‌های یک چندضلعی در بازه‌ی زوم مشخص به انبار کاشی.
+    # کاشی‌های تازه‌ی موجود رد می‌شوند، پس اجرای دوباره‌ی همان کار از جای قطع‌شده ادامه می‌یابد.
+    JOB_META = "prefetch_job"
+
+    def __init__(self, tile_store, style_key, polygon, min_zoom, max_zoom,
+                 workers=PREFETCH_WORKERS, rate_per_s=PREFETCH_HOST_RATE_PER_S):
+        self.tile_store = tile_store
+        self.style_key = style_key
+        self.url_template = TILE_STYLES[style_key]["url"]
+        self.polygon = [tuple(p) for p in polygon]
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.workers = workers
+        self.rate_per_s = rate_per_s
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.total = 0
+        self.done = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+
+    @classmethod
+    def from_job(cls, tile_store, job):
+        return cls(tile_store, job["style"], job["polygon"], job["min_zoom"], job["max_zoom"])
+
+    def job(self):
+        return {"style": self.style_key, "polygon": self.polygon,
+                "min_zoom": self.min_zoom, "max_zoom": self.max_zoom}
+
+    def tiles(self):
+        for zoom in range(self.min_zoom, self.max_zoom + 1):
+            for y, x_from, x_to in polygon_tile_spans(self.polygon, zoom):
+                for x in range(x_from, x_to + 1):
+                    yield zoom, x, y
+
+    def estimate(self):
+        # (تعداد کاشی، حجم تقریبی به بایت) بدون شمردن تک‌تک کاشی‌ها
+        count = sum(
+            x_to - x_from + 1
+            for zoom in range(self.min_zoom, self.max_zoom + 1)
+            for _, x_from, x_to in polygon_tile_spans(self.polygon, zoom)
+        )
+        return count, count * self.tile_store.average_tile_size(self.style_key)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def start(self, on_progress=None, on_done=None):
+        self.tile_store.set_meta(self.JOB_META, self.job())
+        threading.Thread(target=self._run, args=(on_progress, on_done), daemon=True).start()
+
+    def _fetch(self, client, zoom, x, y):
+        if self.cancelled.is_set():
+            return
+        if self.tile_store.has_fresh(self.style_key, zoom, x, y):
+            with self.lock:
+                self.skipped += 1
+                self.done += 1
+            return
+        data = self.tile_store.load(self.style_key, self.url_template, zoom, x, y, session=client)
+        with self.lock:
+            self.done += 1
+            if data is None:
+                self.failed += 1
+            else:
+                self.bytes += len(data)
+
+    def _run(self, on_progress, on_done):
+        self.total = self.estimate()[0]
+        # کلاینت جدا از نمایش نقشه، با سقف نرخ مودبانه‌تر برای هر میزبان کاشی
+        client = HttpClient("tiles-prefetch", rate_per_s=self.rate_per_s, pool_size=self.workers)
+
+        # تعداد کارهای در صف محدود است تا فهرست کاشی‌ها هرگز کامل در حافظه ساخته نشود
+        window = threading.BoundedSemaphore(self.workers * 4)
+        last_report = 0.0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for zoom, x, y in self.tiles():
+                if self.cancelled.is_set():
+                    break
+                window.acquire()
+                future = pool.submit(self._fetch, client, zoom, x, y)
+                future.add_done_callback(lambda f: window.release())
+                now = time.monotonic()
+                if on_progress and now - last_report > 0.25:
+                    last_report = now
+                    on_progress(self.done, self.total, self.bytes)
+        client.close()
+
+        if not self.cancelled.is_set():
+            self.tile_store.set_meta(self.JOB_META, None)
+        if on_progress:
+            on_progress(self.done, self.total, self.bytes)
+        if on_done:
+            on_done(self)
+
+
+# =========================
+# ژئوکد (مشترک بین برنامه و خط فرمان)
+# =========================
+def fetch_geocode(query, session=None, timeout=8):
+    # خروجی (lat, lon, display_name) یا None اگر مکانی پیدا نشد؛
+    # خطای شبکه و پاسخ‌های غیر 200 به صورت requests.RequestException بالا می‌روند
+    params = {"q": query, "format": "json", "limit": 1, "addressdetails": 1}
+    response = (session or http_client("nominatim")).get(NOMINATIM_URL, params=params, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    if not data:
+        return None
+    return float(data[0]["lat"]), float(data[0]["lon"]), data[0]["display_name"]
+
+
+def fetch_suggestions(query, limit=5, session=None):
+    # پیشنهادهای هنگام تایپ از SUGGEST_REMOTE_URL؛ خروجی [(lat, lon, display_name)]
+    if not SUGGEST_REMOTE_URL:
+        return []
+    params = {"q": query, "format": "json", "limit": limit}
+    response = (session or http_client("suggest")).get(SUGGEST_REMOTE_URL, params=params)
+    response.raise_for_status()
+    return [(float(d["lat"]), float(d["lon"]), d["display_name"]) for d in response.json()]
+
+
+def geocode_query(query, cache=None, session=None):
+    # اول کش؛ فقط در صورت نبودن نتیجه سراغ Nominatim می‌رویم
+    key = normalize_query(query)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached:
+            return tuple(cached)
+    result = fetch_geocode(query, session=session)
+    if result and cache is not None:
+        cache.put(key, list(result))
+    return result
+
+
+class BatchGeocoder:
+    # ژئوکد دسته‌ای بدون رابط کاربری: چند worker روی یک HttpClient (محدودیت نرخ میزبان، تلاش مجدد با backoff)
+    # و ادامه از فایل خروجی نیمه‌کاره (پرس‌وجوهای ok/not_found دوباره فرستاده نمی‌شوند)
+    FIELDS = ("query", "lat", "lon", "display_name", "status")
+
+    def __init__(self, output_path, cache=None, workers=GEOCODE_BATCH_WORKERS, rate_per_s=GEOCODE_RATE_PER_S,
+                 retries=GEOCODE_RETRIES, backoff_s=GEOCODE_BACKOFF_S):
+        self.output_path = output_path
+        self.jsonl = output_path.lower().endswith((".jsonl", ".ndjson", ".json"))
+        self.cache = cache
+        self.workers = max(1, workers)
+        self.client = HttpClient(
+            "nominatim", rate_per_s=rate_per_s, retries=retries, backoff_s=backoff_s, pool_size=self.workers
+        )
+        self.write_lock = threading.Lock()
+        self.counts = {"ok": 0, "not_found": 0, "error": 0, "resumed": 0}
+        self.file = None
+        self.writer = None
+
+    def done_queries(self):
+        # پرس‌وجوهایی که در اجرای قبلی نتیجه‌ی قطعی گرفته‌اند
+        done = set()
+        if not os.path.exists(self.output_path):
+            return done
+        try:
+            with open(self.output_path, "r", encoding="utf-8", newline="") as f:
+                if self.jsonl:
+                    rows = []
+                    for line in f:
+                        try:
+                            rows.append(json.loads(line))
+                        except ValueError:
+                            pass  # خط نیمه‌کاره‌ی آخر
+                else:
+                    rows = csv.DictReader(f)
+                for row in rows:
+                    if isinstance(row, dict) and row.get("status") in ("ok", "not_found") and row.get("query"):
+                        done.add(normalize_query(row["query"]))
+        except (OSError, csv.Error):
+            pass
+        return done
+
+    def _open_output(self):
+        exists = os.path.exists(self.output_path) and os.path.getsize(self.output_path) > 0
+        if exists:
+            with open(self.output_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+        self.file = open(self.output_path, "a", encoding="utf-8", newline="")
+        if exists and torn:
+            self.file.write("\n")
+        if not self.jsonl:
+            self.writer = csv.DictWriter(self.file, fieldnames=self.FIELDS)
+            if not exists:
+                self.writer.writeheader()
+
+    def _write(self, row):
+        with self.write_lock:
+            if self.jsonl:
+                self.file.write(json.dumps(row, ensure_ascii=False) + "\n")
+            else:
+                self.writer.writerow(row)
+            self.file.flush()
+            self.counts[row["status"]] += 1
+
+    def _geocode(self, query):
+        try:
+            result = geocode_query(query, cache=self.cache, session=self.client)
+        except (requests.RequestException, ValueError, KeyError):
+            return "error", None
+        return "ok" if result else "not_found", result
+
+    def _worker(self, tasks):
+        while True:
+            query = tasks.get()
+            if query is None:
+                return
+            status, result = self._geocode(query)
+            lat, lon, name = result if result else ("", "", "")
+            self._write({"query": query, "lat": lat, "lon": lon, "display_name": name, "status": status})
+
+    def run(self, queries, on_progress=None):
+        done = self.done_queries()
+        self._open_output()
+        tasks = queue.Queue(maxsize=self.workers * 4)
+        threads = [threading.Thread(target=self._worker, args=(tasks,), daemon=True) for _ in range(self.workers)]
+        for t in threads:
+            t.start()
+        start = time.monotonic()
+        seen = set()
+        try:
+            for query in queries:
+                key = normalize_query(query)
+                if not key or key in seen:
+                    continue
+                seen.add(key)
+                if key in done:
+                    self.counts["resumed"] += 1
+                    continue
+                tasks.put(query)
+                if on_progress is not None:
+                    on_progress(self.counts)
+        finally:
+            for _ in threads:
+                tasks.put(None)
+            for t in threads:
+                t.join()
+            self.file.close()
+            self.client.close()
+        elapsed = time.monotonic() - start
+        processed = self.counts["ok"] + self.counts["not_found"] + self.counts["error"]
+        summary = dict(self.counts, processed=processed, elapsed_s=round(elapsed, 2),
+                       per_s=round(processed / elapsed, 2) if elapsed > 0 else 0.0, http=self.client.stats())
+        if self.cache is not None:
+            summary["cache"] = self.cache.stats()
+        return summary
+
+
+def iter_queries(path):
+    # یک پرس‌وجو در هر خط؛ در CSV ستون query/address/q (یا ستون اول)
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if not path.lower().endswith(".csv"):
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+            return
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        names = [h.strip().lower() for h in header]
+        column = next((names.index(n) for n in ("query", "address", "q") if n in names), None)
+        if column is None:
+            column = 0
+            if header[0].strip():
+                yield header[0].strip()  # بدون سرستون
+        for row in reader:
+            if len(row) > column and row[column].strip():
+                yield row[column].strip()
+
+
+# =========================
+# کارهای پس‌زمینه
+# =========================
+class UiDispatcher:
+    # نتایج نخ‌های پس‌زمینه فقط از طریق after() روی نخ اصلی Tk اجرا می‌شوند
+    def __init__(self, widget, interval_ms=30):
+        self.widget = widget
+        self.interval_ms = interval_ms
+        self.queue = queue.Queue()
+        self.widget.after(self.interval_ms, self._drain)
+
+    def post(self, callback, *args):
+        self.queue.put((callback, args))
+
+    def _drain(self):
+        while True:
+            try:
+                callback, args = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                callback(*args)
+            except Exception:
+                self.widget.report_callback_exception(*sys.exc_info())
+        try:
+            self.widget.after(self.interval_ms, self._drain)
+        except Exception:
+            pass
+
+
+class GeocodeWorker:
+    # جست‌وجوی غیرهمزمان: درخواست‌های قدیمی‌تر لغو و درخواست‌های یکسانِ در جریان ادغام می‌شوند.
+    # key تعیین می‌کند چه درخواست‌هایی «یکسان»اند (پیش‌فرض: متن یکسان‌شده‌ی عبارت جست‌وجو)
+    def __init__(self, dispatcher, resolver, max_parallel=2, key=normalize_query):
+        self.dispatcher = dispatcher
+        self.resolver = resolver
+        self.key = key
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(max_parallel)
+        self.generation = 0
+        self.in_flight = {}  # کلید عبارت -> [(generation, callback), ...]
+
+    def submit(self, query, callback):
+        key = self.key(query)
+        with self.lock:
+            self.generation += 1
+            waiters = self.in_flight.get(key)
+            if waiters is not None:
+                # همین عبارت در حال جست‌وجوست؛ فقط منتظر نتیجه‌اش می‌مانیم
+                waiters.append((self.generation, callback))
+                return
+            self.in_flight[key] = [(self.generation, callback)]
+        threading.Thread(target=self._run, args=(query, key), daemon=True).start()
+
+    def cancel(self):
+        with self.lock:
+            self.generation += 1
+
+    def _is_wanted(self, key):
+        return any(g == self.generation for g, _ in self.in_flight.get(key, []))
+
+    def _run(self, query, key):
+        with self.slots:
+            with self.lock:
+                # اگر تا رسیدن نوبت، جست‌وجوی جدیدتری آمده باشد، اصلاً درخواست نمی‌فرستیم
+                if not self._is_wanted(key):
+                    self.in_flight.pop(key, None)
+                    return
+            error = None
+            try:
+                result = self.resolver(query)
+            except Exception as e:
+                result, error = None, e
+
+        with self.lock:
+            waiters = self.in_flight.pop(key, [])
+            current = self.generation
+        for generation, callback in waiters:
+            if generation == current:
+                self.dispatcher.post(callback, query, result, error)
+
+
+# =========================
+# ژئوکد آفلاین (گزتیر)
+# =========================
+PLACE_IMPORTANCE = {  # اهمیت پایه‌ی هر نوع place؛ عوارض دیگر (amenity، tourism، ...) 0.2
+    "city": 0.7, "town": 0.55, "borough": 0.45, "suburb": 0.45, "quarter": 0.4, "village": 0.4,
+    "neighbourhood": 0.35, "island": 0.35, "hamlet": 0.3, "locality": 0.25, "square": 0.3,
+}
+GAZETTEER_FEATURE_KEYS = ("place", "amenity", "tourism", "historic", "leisure", "railway", "aeroway", "shop", "office")
+GAZETTEER_NAME_KEYS = ("name", "name:fa", "name:en", "int_name", "alt_name", "old_name", "official_name", "short_name")
+
+# یکسان‌سازی نویسه‌های عربی/فارسی و ارقام؛ اعراب و مد و همزه‌ی روی حروف با NFKD جدا و حذف می‌شوند
+_PLACE_CHARS = str.maketrans({
+    "ي": "ی", "ى": "ی", "ك": "ک", "ة": "ه", "ە": "ه", "ـ": None, "\u200c": " ", "\u200d": None,
+    **{chr(0x06F0 + d): str(d) for d in range(10)}, **{chr(0x0660 + d): str(d) for d in range(10)},
+})
+
+
+def normalize_place_name(text):
+    text = unicodedata.normalize("NFKD", str(text))
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return text.translate(_PLACE_CHARS).casefold()
+
+
+def place_tokens(text):
+    return re.findall(r"\w+", normalize_place_name(text))
+
+
+def deletion_variants(term):
+    # همسایگی حذفیِ یک‌نویسه‌ای (SymSpell): دو کلمه با فاصله‌ی ویرایشی ۱ دست‌کم یک گونه‌ی مشترک دارند
+    return {term[:i] + term[i + 1:] for i in range(len(term))}
+
+
+def within_one_edit(a, b):
+    # فاصله‌ی ویرایشی (با جابه‌جایی دو نویسه‌ی کنار هم) حداکثر ۱
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    i = 0
+    while i < min(len(a), len(b)) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:] or (a[i + 1:i + 2] == b[i:i + 1] and a[i:i + 1] == b[i + 1:i + 2]
+                                          and a[i + 2:] == b[i + 2:])
+    return a[i + 1:] == b[i:] if len(a) > len(b) else a[i:] == b[i + 1:]
+
+
+def _place_importance(tags):
+    place = tags.get("place")
+    importance = PLACE_IMPORTANCE.get(place, 0.2)
+    try:
+        population = float(tags.get("population", "0").replace(",", "").split(";")[0])
+    except ValueError:
+        population = 0.0
+    if population > 0:
+        importance += min(0.3, math.log10(population + 1) / 25.0)
+    if tags.get("capital") in ("yes", "2", "4") or "wikidata" in tags or "wikipedia" in tags:
+        importance += 0.1
+    return round(min(importance, 1.0), 4)
+
+
+def read_osm_places(path):
+    # نقطه‌های نام‌دار OSM: (نام، نام نمایشی، lat، lon، اهمیت، همه‌ی نام‌ها)
+    for elem in _iter_osm(path, ("node",)):
+        tags = {t.get("k"): t.get("v") for t in elem.iter("tag")}
+        name = tags.get("name:fa") or tags.get("name")
+        if not name or not any(key in tags for key in GAZETTEER_FEATURE_KEYS):
+            continue
+        names = [tags[key] for key in GAZETTEER_NAME_KEYS if tags.get(key)]
+        city = tags.get("addr:city") or tags.get("is_in", "").split(",")[0].strip()
+        display = f"{name}، {city}" if city and city != name else name
+        yield name, display, float(elem.get("lat")), float(elem.get("lon")), _place_importance(tags), names + [city]
+
+
+def build_gazetteer(osm_path, out_path=GAZETTEER_FILE):
+    # جدول‌ها: places (با توکن‌های هر مکان)، terms (توکن -> مکان‌ها به ترتیب اهمیت)،
+    # vocab (واژگان و بسامد) و typos (گونه‌های حذفی -> واژه) برای تطبیق با غلط تایپی
+    tmp = out_path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
+    conn.executescript(
+        "PRAGMA journal_mode=OFF; PRAGMA synchronous=OFF;"
+        "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);"
+        "CREATE TABLE places (id INTEGER PRIMARY KEY, name TEXT, display TEXT, lat REAL, lon REAL,"
+        " importance REAL, tokens TEXT);"
+        "CREATE TABLE terms (term TEXT, rank REAL, place INTEGER, PRIMARY KEY (term, rank, place)) WITHOUT ROWID;"
+        "CREATE TABLE vocab (term TEXT PRIMARY KEY, freq INTEGER) WITHOUT ROWID;"
+        "CREATE TABLE typos (variant TEXT, term TEXT, PRIMARY KEY (variant, term)) WITHOUT ROWID;"
+    )
+    freq = {}
+    places = []
+    terms = []
+    for place_id, (name, display, lat, lon, importance, names) in enumerate(read_osm_places(osm_path), 1):
+        tokens = sorted({token for text in names if text for token in place_tokens(text)})
+        places.append((place_id, name, display, lat, lon, importance, " ".join(tokens)))
+        for token in tokens:
+            terms.append((token, -importance, place_id))
+            freq[token] = freq.get(token, 0) + 1
+        if len(places) >= 10_000:
+            conn.executemany("INSERT INTO places VALUES (?, ?, ?, ?, ?, ?, ?)", places)
+            conn.executemany("INSERT INTO terms VALUES (?, ?, ?)", terms)
+            places, terms = [], []
+    conn.executemany("INSERT INTO places VALUES (?, ?, ?, ?, ?, ?, ?)", places)
+    conn.executemany("INSERT INTO terms VALUES (?, ?, ?)", terms)
+    conn.executemany("INSERT INTO vocab VALUES (?, ?)", freq.items())
+    conn.executemany("INSERT OR IGNORE INTO typos VALUES (?, ?)", (
+        (variant, term) for term in freq if len(term) >= GAZETTEER_TYPO_MIN_LEN for variant in deletion_variants(term)
+    ))
+    count = conn.execute("SELECT COUNT(*) FROM places").fetchone()[0]
+    meta = {"source": os.path.basename(osm_path), "built": timestamp(), "places": count, "terms": len(freq)}
+    conn.executemany("INSERT INTO meta VALUES (?, ?)", ((k, str(v)) for k, v in meta.items()))
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+    os.replace(tmp, out_path)
+    return meta
+
+
+class Gazetteer:
+    # جست‌وجوی محلی روی فایل build-gazetteer: تطبیق کامل، پیشوندی (آخرین کلمه) و با یک غلط تایپی؛
+    # رتبه = اهمیت - جریمه‌ی تطبیق - وزن × log10(1 + فاصله تا مرکز نقشه به کیلومتر)
+    PREFIX_PENALTY = 0.05
+    TYPO_PENALTY = 0.25
+    MAX_PREFIX_TERMS = 64
+
+    def __init__(self, path=GAZETTEER_FILE, scan=GAZETTEER_SCAN):
+        self.scan = scan
+        uri = "file:" + pathname2url(os.path.abspath(path)) + "?mode=ro"
+        self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("SELECT 1 FROM places LIMIT 1")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def _expand(self, token, prefix):
+        # واژه‌های نمایه که با token جور می‌شوند: [(واژه، جریمه، بسامد)]، بهترین‌ها اول
+        found = {}
+        row = self.conn.execute("SELECT freq FROM vocab WHERE term=?", (token,)).fetchone()
+        if row:
+            found[token] = (0.0, row[0])
+        if len(token) >= GAZETTEER_TYPO_MIN_LEN - 1:
+            variants = deletion_variants(token) | {token}
+            marks = ",".join("?" * len(variants))
+            rows = self.conn.execute(
+                f"SELECT DISTINCT typos.term, freq FROM typos JOIN vocab ON vocab.term=typos.term"
+                f" WHERE variant IN ({marks})", tuple(variants)
+            ).fetchall()
+            rows += self.conn.execute(f"SELECT term, freq FROM vocab WHERE term IN ({marks})", tuple(variants)).fetchall()
+            for term, count in rows:
+                if term not in found and len(term) >= GAZETTEER_TYPO_MIN_LEN and within_one_edit(token, term):
+                    found[term] = (self.TYPO_PENALTY, count)
+        if prefix:
+            rows = self.conn.execute(
+                "SELECT term, freq FROM vocab WHERE term > ? AND term < ? LIMIT ?",
+                (token, token + "\U0010ffff", self.MAX_PREFIX_TERMS)
+            ).fetchall()
+            for term, count in rows:
+                if term not in found or found[term][0] > self.PREFIX_PENALTY:
+                    found[term] = (self.PREFIX_PENALTY, count)
+        return sorted(((t, p, c) for t, (p, c) in found.items()), key=lambda x: (x[1], -x[2]))
+
+    def _token_penalty(self, token, matches, words, prefix):
+        # matches: واژه‌های جورشده از _expand؛ پیشوندها ممکن است بریده شده باشند پس startswith هم بررسی می‌شود
+        best = None
+        for word in words:
+            penalty = matches.get(word)
+            if penalty is None and prefix and word.startswith(token):
+                penalty = self.PREFIX_PENALTY
+            if penalty is not None and (best is None or penalty < best):
+                best = penalty
+        return best
+
+    def search(self, query, near=None, limit=SUGGEST_LIMIT):
+        tokens = place_tokens(query)
+        if not tokens:
+            return []
+        last = len(tokens) - 1
+        with self.lock:
+            # کم‌بسامدترین کلمه مکان‌های نامزد را می‌دهد و بقیه روی توکن‌های همان مکان‌ها بررسی می‌شوند
+            expanded = [self._expand(token, i == last) for i, token in enumerate(tokens)]
+            if not all(expanded):
+                return []
+            pivot = min(range(len(tokens)), key=lambda i: sum(c for _, _, c in expanded[i]))
+            candidates = {}
+            for term, penalty, _ in expanded[pivot]:
+                rows = self.conn.execute(
+                    "SELECT id, name, display, lat, lon, importance, tokens FROM terms JOIN places ON id=place"
+                    " WHERE term=? LIMIT ?", (term, self.scan - len(candidates))
+                ).fetchall()
+                for row in rows:
+                    if row[0] not in candidates:
+                        candidates[row[0]] = (penalty, row)
+                if len(candidates) >= self.scan:
+                    break
+        matches = [{term: penalty for term, penalty, _ in found} for found in expanded]
+
+        scored = []
+        for penalty, (_, name, display, lat, lon, importance, words) in candidates.values():
+            words = words.split(" ")
+            for i, token in enumerate(tokens):
+                if i == pivot:
+                    continue
+                extra = self._token_penalty(token, matches[i], words, i == last)
+                if extra is None:
+                    break
+                penalty += extra
+            else:
+                score = importance - penalty
+                if near is not None:
+                    score -= GAZETTEER_DISTANCE_WEIGHT * math.log10(1 + haversine_m(near[0], near[1], lat, lon) / 1000)
+                scored.append((score, name, display, lat, lon))
+        scored.sort(key=lambda item: -item[0])
+        return [{"label": name, "address": display, "lat": lat, "lon": lon, "source": "gazetteer", "score": score}
+                for score, name, display, lat, lon in scored[:limit]]
+
+    def geocode(self, query, near=None):
+        # همان خروجی fetch_geocode: (lat, lon, display_name) یا None
+        found = self.search(query, near=near, limit=1)
+        if not found:
+            return None
+        return found[0]["lat"], found[0]["lon"], found[0]["address"]
+
+
+def open_gazetteer(path=GAZETTEER_FILE):
+    if GAZETTEER_MODE == "off" or not os.path.exists(path):
+        return None
+    try:
+        return Gazetteer(path)
+    except sqlite3.Error:
+        return None
+
+
+# =========================
+# ویدجت‌های سفارشی
+# =========================
+class LocationEntry(ctk.CTkEntry):
+    def __init__(self, parent, input_var, submit_callback):
+        self.color_index = 15
+        self.error = False
+        super().__init__(
+            master=parent,
+            textvariable=input_var,
+            corner_radius=8,
+            border_width=3,
+            fg_color="#FFFFFF",
+            border_color="#CCCCCC",
+            text_color="#000000",
+            font=ctk.CTkFont(family="Tahoma", size=14),
+            placeholder_text="نام مکان را وارد کنید و Enter بزنید"
+        )
+        self.bind("<Return>", submit_callback)
+        input_var.trace_add("write", self.clean_error)
+
+    def display_error(self):
+        self.error = True
+        if self.color_index > 0:
+            self.color_index -= 1
+            color = COLOR_RANGE[self.color_index]
+            self.configure(border_color=f"#F{color}{color}", text_color=f"#{color}00")
+            self.after(40, self.display_error)
+
+    def clean_error(self, *args):
+        if self.error:
+            self.configure(border_color="#CCCCCC", text_color="#000000")
+            self.color_index = 15
+            self.error = False
+
+
+class SuggestionList(ctk.CTkFrame):
+    # فهرست پیشنهاد زیر کادر جست‌وجو؛ ردیف‌ها یک بار ساخته و فقط متنشان عوض می‌شود
+    def __init__(self, parent, anchor_widget, on_pick, rows=SUGGEST_LIMIT, **kwargs):
+        super().__init__(master=parent, **kwargs)
+        self.anchor_widget = anchor_widget
+        self.on_pick = on_pick
+        self.items = []
+        self.active = -1
+        self.buttons = []
+        for i in range(rows):
+            btn = ctk.CTkButton(
+                self, text="", height=26, anchor="w", command=lambda i=i: self.pick(i),
+                font=ctk.CTkFont(family="Tahoma", size=12),
+                fg_color="transparent", hover_color="#ECECEC", text_color="#222"
+            )
+            self.buttons.append(btn)
+
+    def show(self, items):
+        self.items = items[:len(self.buttons)]
+        self.active = -1
+        if not self.items:
+            self.hide()
+            return
+        for i, btn in enumerate(self.buttons):
+            if i < len(self.items):
+                item = self.items[i]
+                mark = "🕘 " if item.get("source") != "remote" else "🌐 "
+                btn.configure(text=mark + str(item.get("address") or item.get("label"))[:60], fg_color="transparent")
+                btn.pack(fill="x", padx=2, pady=1)
+            else:
+                btn.pack_forget()
+        self.place(in_=self.anchor_widget, relx=0, rely=1.0, relwidth=1.0, y=2)
+        self.lift()
+
+    def hide(self):
+        self.items = []
+        self.active = -1
+        self.place_forget()
+
+    def visible(self):
+        return bool(self.items)
+
+    def move(self, step):
+        if not self.items:
+            return
+        if 0 <= self.active < len(self.items):
+            self.buttons[self.active].configure(fg_color="transparent")
+        self.active = (self.active + step) % len(self.items)
+        self.buttons[self.active].configure(fg_color="#DCE9F7")
+
+    def pick(self, index=None):
+        index = self.active if index is None else index
+        if 0 <= index < len(self.items):
+            item = self.items[index]
+            self.hide()
+            self.on_pick(item)
+            return True
+        return False
+
+
+class HistoryList(ctk.CTkFrame):
+    # فهرست مجازی تاریخچه: فقط ردیف‌های قابل‌مشاهده، از یک مجموعه‌ی ثابت ویجت بازیافتی ساخته می‌شوند
+    ROW_HEIGHT = 40
+
+    def __init__(self, parent, items, on_select, on_delete, **kwargs):
+        super().__init__(master=parent, **kwargs)
+        self.items = items  # همان فهرست self.history؛ کپی نمی‌شود
+        self.on_select = on_select
+        self.on_delete = on_delete
+        self.first = 0
+        self.rows = []  # [(frame, btn, del_btn, shown_entry)]
+
+        self.scrollbar = ctk.CTkScrollbar(self, command=self._on_scrollbar)
+        self.scrollbar.pack(side="right", fill="y", padx=(0, 2), pady=4)
+        self.body = ctk.CTkFrame(self, fg_color="transparent")
+        self.body.pack(side="left", fill="both", expand=True, padx=(6, 0), pady=4)
+        self.body.bind("<Configure>", self._on_resize)
+        self._bind_wheel(self.body)
+
+    def _bind_wheel(self, widget):
+        widget.bind("<MouseWheel>", self._on_wheel, add="+")
+        widget.bind("<Button-4>", self._on_wheel, add="+")
+        widget.bind("<Button-5>", self._on_wheel, add="+")
+
+    def _make_row(self, slot):
+        frame = ctk.CTkFrame(self.body, fg_color="#FFFFFF", corner_radius=6, height=self.ROW_HEIGHT)
+        btn = ctk.CTkButton(
+            frame, text="", command=lambda: self._select(slot),
+            font=ctk.CTkFont(family="Tahoma", size=14),
+            anchor="w", fg_color="transparent", hover_color="#ECECEC", text_color="#222"
+        )
+        btn.pack(side="left", fill="x", expand=True, padx=2, pady=2)
+        del_btn = ctk.CTkButton(
+            frame, text="✕", command=lambda: self._delete(slot),
+            width=34, fg_color="transparent", hover_color="#F8D7DA", text_color="#900"
+        )
+        del_btn.pack(side="right", padx=2, pady=2)
+        for widget in (frame, btn, del_btn):
+            self._bind_wheel(widget)
+        return [frame, btn, del_btn, None]
+
+    def _on_resize(self, event):
+        # اندازه‌ی مجموعه‌ی ویجت‌ها فقط با ارتفاع فهرست تغییر می‌کند، نه با تعداد آیتم‌ها
+        needed = max(1, math.ceil(event.height / self.ROW_HEIGHT))
+        while len(self.rows) < needed:
+            self.rows.append(self._make_row(len(self.rows)))
+        while len(self.rows) > needed:
+            self.rows.pop()[0].destroy()
+        self.refresh()
+
+    def _visible_count(self):
+        return max(1, self.body.winfo_height() // self.ROW_HEIGHT)
+
+    def _clamp(self):
+        self.first = max(0, min(self.first, len(self.items) - self._visible_count()))
+
+    @timed("ui.history_refresh", "ui")
+    def refresh(self):
+        self._clamp()
+        for slot, row in enumerate(self.rows):
+            index = self.first + slot
+            entry = self.items[index] if index < len(self.items) else None
+            if entry is row[3]:
+                continue
+            row[3] = entry
+            if entry is None:
+                row[0].place_forget()
+            else:
+                row[1].configure(text=entry["label"])
+                row[0].place(x=0, y=slot * self.ROW_HEIGHT, relwidth=1.0, height=self.ROW_HEIGHT - 4)
+
+        total = len(self.items)
+        if total:
+            self.scrollbar.set(self.first / total, min(1.0, (self.first + self._visible_count()) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def invalidate(self):
+        # refresh بعدی همه‌ی ردیف‌ها را دوباره می‌کشد، حتی اگر همان ورودی‌ها را نشان دهند
+        for row in self.rows:
+            row[3] = None
+
+    def inserted(self, index, count=1):
+        # درج بالاتر از دید فعلی، ردیف‌های نمایش‌داده‌شده را جابه‌جا نمی‌کند
+        if index < self.first:
+            self.first += count
+        self.refresh()
+
+    def removed(self, index):
+        if index < self.first:
+            self.first -= 1
+        self.refresh()
+
+    def scroll_to(self, first):
+        self.first = int(first)
+        self.refresh()
+
+    def _on_scrollbar(self, *args):
+        if not args:
+            return
+        if args[0] == "moveto":
+            self.scroll_to(float(args[1]) * len(self.items))
+        elif args[0] == "scroll":
+            step = self._visible_count() if args[2] == "pages" else 1
+            self.scroll_to(self.first + int(args[1]) * step)
+
+    def _on_wheel(self, event):
+        if event.num == 4:
+            delta = -3
+        elif event.num == 5:
+            delta = 3
+        else:
+            delta = -3 if event.delta > 0 else 3
+        self.scroll_to(self.first + delta)
+
+    def _entry_at(self, slot):
+        index = self.first + slot
+        return self.items[index] if index < len(self.items) else None
+
+    def _select(self, slot):
+        entry = self._entry_at(slot)
+        if entry is not None:
+            self.on_select(entry)
+
+    def _delete(self, slot):
+        entry = self._entry_at(slot)
+        if entry is not None:
+            self.on_delete(entry)
+
+
+class MapAnimator:
+    # زمان‌بند واحد انیمیشن نقشه: هر انیمیشن جدید قبلی را لغو می‌کند، پیشرفت بر اساس زمان واقعی است
+    # (فریم‌های کند یعنی گام‌های کمتر) و کاشی‌ها فقط بعد از توقف حرکت درخواست می‌شوند
+    def __init__(self, map_widget, frame_ms=16):
+        self.map = map_widget
+        self.frame_ms = frame_ms
+        self.frame_cost_ms = float(frame_ms)  # میانگین نمایی هزینه‌ی هر فریم
+        self.after_id = None
+        self.on_done = None
+
+    @property
+    def running(self):
+        return self.after_id is not None
+
+    def cancel(self):
+        # انیمیشن نیمه‌کاره: پیش‌بارگذاری از مرکز فعلی از سر گرفته و on_done (مثلاً به‌روزرسانی وضعیت) صدا زده می‌شود
+        on_done, self.on_done = self.on_done, None
+        if self.after_id is None:
+            return
+        m = self.map
+        try:
+            m.after_cancel(self.after_id)
+        except Exception:
+            pass
+        self.after_id = None
+        center = tkintermapview.decimal_to_osm(*m.get_position(), round(m.zoom))
+        m.pre_cache_position = (round(center[0]), round(center[1]))
+        m.pre_cache_paused = False
+        if on_done:
+            on_done()
+
+    def fly_to(self, lat, lon, zoom=None, duration_ms=400, on_done=None):
+        self.cancel()
+        m = self.map
+        start_lat, start_lon = m.get_position()
+        start_zoom = m.zoom
+        end_zoom = start_zoom if zoom is None else max(m.min_zoom, min(m.max_zoom, zoom))
+
+        # برای جابه‌جایی‌های بلند، وسط مسیر کمی دور می‌شویم (fly-to)
+        sx, sy = tkintermapview.decimal_to_osm(start_lat, start_lon, round(start_zoom))
+        ex, ey = tkintermapview.decimal_to_osm(lat, lon, round(start_zoom))
+        view_tiles = max(m.width, m.height, 1) / m.tile_size
+        distance_views = math.hypot(ex - sx, ey - sy) / view_tiles
+        dip = min(max(math.log2(distance_views), 0.0), 6.0) if distance_views > 1 else 0.0
+
+        self.on_done = on_done
+        start_time = time.perf_counter()
+
+        def step():
+            self.after_id = None
+            frame_start = time.perf_counter()
+            t = min(1.0, (frame_start - start_time) * 1000.0 / max(duration_ms, 1))
+            if t >= 1.0:
+                self._finish(lat, lon, end_zoom)
+                return
+            ease = (1 - math.cos(math.pi * t)) / 2  # ease in-out
+            z = start_zoom + (end_zoom - start_zoom) * ease - dip * math.sin(math.pi * t)
+            self._frame(start_lat + (lat - start_lat) * ease, start_lon + (lon - start_lon) * ease, z)
+
+            cost = (time.perf_counter() - frame_start) * 1000.0
+            self.frame_cost_ms = 0.8 * self.frame_cost_ms + 0.2 * cost
+            self.after_id = m.after(max(self.frame_ms, int(self.frame_cost_ms * 1.2)), step)
+
+        if duration_ms <= 0:
+            self._finish(lat, lon, end_zoom)
+        else:
+            step()
+
+    def _frame(self, lat, lon, zoom):
+        m = self.map
+        if round(zoom) != round(m.zoom):
+            m.set_zoom(zoom)
+        else:
+            m.zoom = zoom
+        tx, ty = tkintermapview.decimal_to_osm(lat, lon, round(m.zoom))
+        half_w = (m.lower_right_tile_pos[0] - m.upper_left_tile_pos[0]) / 2
+        half_h = (m.lower_right_tile_pos[1] - m.upper_left_tile_pos[1]) / 2
+        old_x = (m.lower_right_tile_pos[0] + m.upper_left_tile_pos[0]) / 2
+        old_y = (m.lower_right_tile_pos[1] + m.upper_left_tile_pos[1]) / 2
+        if abs(tx - old_x) > half_w or abs(ty - old_y) > half_h:
+            # پرش بزرگ‌تر از یک صفحه: ساخت دوباره‌ی آرایه ارزان‌تر از درج ردیف‌به‌ردیف است
+            m.set_position(lat, lon)
+        else:
+            m.upper_left_tile_pos = (tx - half_w, ty - half_h)
+            m.lower_right_tile_pos = (tx + half_w, ty + half_h)
+            m.check_map_border_crossing()
+            m.draw_move()
+        # در حین حرکت هیچ کاشی‌ای دانلود نمی‌شود؛ فقط کاشی‌های موجود در کش نمایش داده می‌شوند
+        m.image_load_queue_tasks = []
+        m.pre_cache_paused = True
+
+    def _finish(self, lat, lon, zoom):
+        m = self.map
+        m.pre_cache_paused = False
+        if zoom != m.zoom:
+            m.set_zoom(zoom)
+        m.set_position(lat, lon)  # آرایه‌ی کاشی نهایی و صف دانلود از اینجا ساخته می‌شود
+        on_done, self.on_done = self.on_done, None
+        if on_done:
+            on_done()
+
+
+class MapWidget(tkintermapview.TkinterMapView):
+    def __init__(self, parent, on_left_click=None, on_mouse_move=None, tile_store=None):
+        # پیش از super چون سازنده‌ی والد خودش set_zoom را صدا می‌زند و نخ‌های بارگذاری کاشی را راه می‌اندازد
+        self.zoom_listeners = []
+        self.view_listeners = []
+        self.drag_handlers = []
+        self.drag_handler = None  # لایه‌ای که کشیدن فعلی ماوس را در اختیار گرفته (نقشه جابه‌جا نمی‌شود)
+        self.style_key = "map"
+        self.pre_cache_paused = False  # در حین انیمیشن؛ نخ pre_cache فقط منتظر می‌ماند
+        self.tile_store = tile_store or TileStore(TILE_STORE_FILE)
+        self.tile_pools = TilePools()
+        super().__init__(master=parent)
+        self.tile_image_cache = self.tile_pools.pool(self.style_key)
+        self.on_left_click = on_left_click
+        self.on_mouse_move = on_mouse_move
+
+        # کلیک چپ روی نقشه
+        self.add_left_click_map_command(self._handle_left_click)
+
+        # حرکت ماوس؛ رویدادها تا فریم بعد ادغام می‌شوند
+        self._canvas_to_coords = self._resolve_coords_converter()
+        self._pending_motion = None
+        self._motion_scheduled = False
+        self.canvas.bind("<Motion>", self._handle_mouse_move, add="+")
+
+        # انیمیشن‌ها؛ هر تعامل کاربر با نقشه انیمیشن در جریان را متوقف می‌کند
+        self.animator = MapAnimator(self)
+        self.canvas.bind("<Button-1>", lambda e: self.animator.cancel(), add="+")
+
+        # گرم کردن استایل‌های مجاور برای دید فعلی، وقتی نقشه ساکن است و کاشی قابل‌مشاهده‌ای در صف نیست
+        self.prewarm_jobs = deque()
+        self.prewarm_wakeup = threading.Event()
+        self.prewarm_after_id = None
+        self.prewarm_thread = None
+        self.add_view_listener(self.schedule_prewarm)
+
+    def map_view_style(self, style_key: str):
+        if style_key not in TILE_STYLES:
+            style_key = "map"
+        self.style_key = style_key
+        self.set_tile_server(TILE_STYLES[style_key]["url"])
+        self.set_zoom(self.zoom)
+
+    def set_tile_server(self, tile_server, tile_size=256, max_zoom=19):
+        # مثل نسخه‌ی کتابخانه، با این تفاوت که کش کاشی خالی نمی‌شود: استخر همان استایل جایش می‌نشیند
+        self.image_load_queue_tasks = []
+        self.max_zoom = max_zoom
+        self.tile_size = tile_size
+        self.min_zoom = math.ceil(math.log2(math.ceil(self.width / self.tile_size)))
+        self.tile_server = tile_server
+        self.tile_image_cache = self.tile_pools.pool(self.style_key)
+        self.canvas.delete("tile")
+        self.image_load_queue_results = []
+        self.draw_initial_array()
+
+    def get_tile_image_from_cache(self, zoom, x, y):
+        return self.tile_image_cache.lookup(f"{zoom}{x}{y}")
+
+    def _decode_tile(self, data):
+        try:
+            return ImageTk.PhotoImage(Image.open(io.BytesIO(data)))
+        except Exception:
+            return self.empty_tile_image
+
+    def pre_cache(self):
+        # همان حلقه‌ی کتابخانه، با دو تفاوت: موقعیت هر دور یک بار خوانده می‌شود (تغییرش از نخ اصلی وسط
+        # حلقه بی‌اثر است) و در حین انیمیشن به جای پاک کردن موقعیت، با pre_cache_paused متوقف می‌شود
+        last_position = None
+        radius = 1
+        zoom = round(self.zoom)
+        db_cursor = sqlite3.connect(self.database_path).cursor() if self.database_path is not None else None
+        while self.running:
+            position = self.pre_cache_position
+            if position != last_position:
+                last_position = position
+                zoom = round(self.zoom)
+                radius = 1
+            if position is None or radius > 8 or self.pre_cache_paused:
+                time.sleep(0.1)
+                continue
+            px, py = position
+            ring = [(x, py + d) for x in range(px - radius, px + radius + 1) for d in (radius, -radius)]
+            ring += [(px + d, y) for y in range(py - radius + 1, py + radius) for d in (radius, -radius)]
+            for x, y in ring:
+                if f"{zoom}{x}{y}" not in self.tile_image_cache:
+                    self.request_image(zoom, x, y, db_cursor=db_cursor)
+            radius += 1
+
+    @timed("tile.request", "tiles")
+    def request_image(self, zoom, x, y, db_cursor=None):
+        # جایگزین دانلود مستقیم کتابخانه: کاشی‌ها از انبار دیسکی TileStore خوانده می‌شوند
+        # (اگر در این فاصله استایل عوض شود، کاشی به استخر استایل خودش می‌رود)
+        style_key, tile_server, pool = self.style_key, self.tile_server, self.tile_image_cache
+        data = self.tile_store.load(style_key, tile_server, zoom, x, y)
+        if data is None or not self.running:
+            return self.empty_tile_image
+        image_tk = self._decode_tile(data)
+        pool[f"{zoom}{x}{y}"] = image_tk
+        return image_tk
+
+    def schedule_prewarm(self):
+        if not TILE_PREWARM_STYLES:
+            return
+        if self.prewarm_after_id is not None:
+            self.after_cancel(self.prewarm_after_id)
+        self.prewarm_after_id = self.after(TILE_PREWARM_DELAY_MS, self._start_prewarm)
+
+    def _start_prewarm(self):
+        # کاشی‌های دید فعلی در استایل‌های مجاور؛ کارهای قبلی (دید قدیمی) کنار گذاشته می‌شوند
+        self.prewarm_after_id = None
+        zoom = round(self.zoom)
+        last = (1 << zoom) - 1
+        x0, y0 = (max(0, math.floor(v)) for v in self.upper_left_tile_pos)
+        x1, y1 = (min(last, math.ceil(v)) for v in self.lower_right_tile_pos)
+        jobs = deque()
+        for style_key in adjacent_styles(self.style_key):
+            pool = self.tile_pools.pool(style_key)
+            url = TILE_STYLES[style_key]["url"]
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    if f"{zoom}{x}{y}" not in pool:
+                        jobs.append((style_key, url, pool, zoom, x, y))
+        self.prewarm_jobs = jobs
+        if jobs:
+            if self.prewarm_thread is None:
+                self.prewarm_thread = threading.Thread(target=self._prewarm_loop, daemon=True)
+                self.prewarm_thread.start()
+            self.prewarm_wakeup.set()
+
+    def _prewarm_loop(self):
+        while self.running:
+            try:
+                style_key, url, pool, zoom, x, y = self.prewarm_jobs.popleft()
+            except IndexError:
+                self.prewarm_wakeup.wait(1.0)
+                self.prewarm_wakeup.clear()
+                continue
+            # اولویت پایین: تا وقتی کاشی‌های قابل‌مشاهده‌ی استایل فعلی در صف‌اند، صبر می‌کنیم
+            while self.running and (self.image_load_queue_tasks or self.animator.after_id is not None):
+                time.sleep(0.05)
+            if style_key == self.style_key or f"{zoom}{x}{y}" in pool:
+                continue
+            data = self.tile_store.load(style_key, url, zoom, x, y)
+            if data is not None and self.running:
+                pool[f"{zoom}{x}{y}"] = self._decode_tile(data)
+
+    def add_zoom_listener(self, callback):
+        self.zoom_listeners.append(callback)
+
+    def draw_zoom(self):
+        # لایه‌ها پیش از بازترسیم، داده‌ی خود را با زوم جدید هماهنگ می‌کنند
+        for listener in self.zoom_listeners:
+            listener(round(self.zoom))
+        super().draw_zoom()
+
+    def add_view_listener(self, callback):
+        self.view_listeners.append(callback)
+
+    def draw_initial_array(self):
+        super().draw_initial_array()
+        for listener in self.view_listeners:
+            listener()
+
+    def draw_move(self, called_after_zoom: bool = False):
+        super().draw_move(called_after_zoom)
+        for listener in self.view_listeners:
+            listener()
+
+    def add_drag_handler(self, handler):
+        # handler: press(x, y) -> bool، drag(x, y)، release(x, y)، right_click(x, y) -> bool
+        self.drag_handlers.append(handler)
+
+    def mouse_click(self, event):
+        for handler in self.drag_handlers:
+            if handler.press(event.x, event.y):
+                self.drag_handler = handler
+                return
+        super().mouse_click(event)
+
+    def mouse_move(self, event):
+        if self.drag_handler is not None:
+            self.drag_handler.drag(event.x, event.y)
+            return
+        super().mouse_move(event)
+
+    def mouse_release(self, event):
+        if self.drag_handler is not None:
+            handler, self.drag_handler = self.drag_handler, None
+            handler.release(event.x, event.y)
+            return
+        super().mouse_release(event)
+
+    def mouse_right_click(self, event):
+        for handler in self.drag_handlers:
+            if handler.right_click(event.x, event.y):
+                return
+        super().mouse_right_click(event)
+
+    def _handle_left_click(self, coords_tuple):
+        lat, lon = coords_tuple
+        if self.on_left_click:
+            self.on_left_click(lat, lon)
+
+    def _resolve_coords_converter(self):
+        # تبدیل مختصات پیکسل به جغرافیایی؛ بسته به نسخه‌ی tkintermapview نام متد فرق می‌کند
+        for attr_name in (
+            "convert_canvas_coords_to_decimal_coords",
+            "convert_canvas_coords_to_gps",
+            "get_position_from_xy",
+        ):
+            func = getattr(self, attr_name, None)
+            if callable(func):
+                return func
+        return None
+
+    def _handle_mouse_move(self, event):
+        self._pending_motion = (event.x, event.y)
+        if not self._motion_scheduled:
+            self._motion_scheduled = True
+            self.after(MOUSE_MOVE_FRAME_MS, self._flush_mouse_move)
+
+    @timed("ui.mouse_move", "ui")
+    def _flush_mouse_move(self):
+        self._motion_scheduled = False
+        if self._pending_motion is None or not self.on_mouse_move:
+            return
+        x, y = self._pending_motion
+        self._pending_motion = None
+
+        lat, lon = None, None
+        if self._canvas_to_coords is not None:
+            try:
+                result = self._canvas_to_coords(x, y)
+                if isinstance(result, tuple) and len(result) == 2:
+                    lat, lon = float(result[0]), float(result[1])
+            except Exception:
+                pass
+        if lat is None or lon is None:
+            lat, lon = self.get_position()
+        self.on_mouse_move(lat, lon)
+
+    def animate_to(self, target_lat, target_lon, duration_ms=350, steps=24):
+        # steps فقط برای سازگاری؛ تعداد گام‌ها حالا از زمان واقعی هر فریم به دست می‌آید
+        if steps <= 1:
+            duration_ms = 0
+        self.animator.fly_to(target_lat, target_lon, duration_ms=duration_ms)
+
+    def fly_to(self, lat, lon, zoom=None, duration_ms=400, on_done=None):
+        self.animator.fly_to(lat, lon, zoom=zoom, duration_ms=duration_ms, on_done=on_done)
+
+    def clear_all_markers(self):
+        try:
+            self.delete_all_marker()
+        except Exception:
+            try:
+                self.delete_all_markers()
+            except Exception:
+                pass
+
+
+# =========================
+# خوشه‌بندی مارکرها
+# =========================
+class MarkerClusterLayer:
+    # خوشه‌بندی شبکه‌ای سلسله‌مراتبی: سلول هر زوم دقیقاً چهار سلول زوم بعدی را در بر می‌گیرد،
+    # پس شاخص یک‌بار (و با هر افزودن به صورت O(تعداد زوم‌ها)) ساخته می‌شود و
+    # در هر رسم فقط سلول‌های داخل صفحه خوانده و فقط مارکرهای تغییرکرده ساخته/حذف می‌شوند.
+    def __init__(self, map_widget, on_marker_click=None, cell_px=CLUSTER_CELL_PX, max_zoom=CLUSTER_MAX_ZOOM):
+        self.map = map_widget
+        self.on_marker_click = on_marker_click
+        self.cell_px = cell_px
+        self.max_zoom = max_zoom
+        self.points = {}  # id -> (lat, lon, text, world_x, world_y)
+        # هر زوم: (cx, cy) -> [count, sum_lat, sum_lon, sample_id]؛ در max_zoom عنصر پنجم مجموعه‌ی idهاست
+        self.grids = [{} for _ in range(max_zoom + 1)]
+        self.next_id = 0
+        self.rendered = {}  # کلید -> مارکر
+        self.render_scheduled = False
+        map_widget.add_view_listener(self.schedule_render)
+
+    def _cell(self, world_x, world_y, zoom):
+        scale = (1 << zoom) / self.cell_px
+        return int(world_x * scale), int(world_y * scale)
+
+    def add(self, lat, lon, text):
+        point_id = self.next_id
+        self.next_id += 1
+        world_x, world_y = project_world_px(lat, lon)
+        self.points[point_id] = (lat, lon, text, world_x, world_y)
+        for zoom, grid in enumerate(self.grids):
+            key = self._cell(world_x, world_y, zoom)
+            cell = grid.get(key)
+            if cell is None:
+                cell = grid[key] = [0, 0.0, 0.0, point_id]
+                if zoom == self.max_zoom:
+                    cell.append(set())
+            cell[0] += 1
+            cell[1] += lat
+            cell[2] += lon
+            if zoom == self.max_zoom:
+                cell[4].add(point_id)
+        self.schedule_render()
+        return point_id
+
+    def add_many(self, items):
+        # افزودن دسته‌ای: فقط ریزترین زوم از روی نقاط ساخته می‌شود و هر زوم پایین‌تر از سلول‌های زوم بالایی
+        ids = []
+        delta = {}
+        top = self.max_zoom
+        for lat, lon, text in items:
+            point_id = self.next_id
+            self.next_id += 1
+            world_x, world_y = project_world_px(lat, lon)
+            self.points[point_id] = (lat, lon, text, world_x, world_y)
+            ids.append(point_id)
+            key = self._cell(world_x, world_y, top)
+            d = delta.get(key)
+            if d is None:
+                d = delta[key] = [0, 0.0, 0.0, point_id, set()]
+            d[0] += 1
+            d[1] += lat
+            d[2] += lon
+            d[4].add(point_id)
+
+        for zoom in range(top, -1, -1):
+            grid = self.grids[zoom]
+            parent_delta = {}
+            for key, d in delta.items():
+                cell = grid.get(key)
+                if cell is None:
+                    grid[key] = d if zoom == top else d[:4]
+                else:
+                    cell[0] += d[0]
+                    cell[1] += d[1]
+                    cell[2] += d[2]
+                    if zoom == top:
+                        cell[4].update(d[4])
+                if zoom:
+                    pkey = (key[0] >> 1, key[1] >> 1)
+                    p = parent_delta.get(pkey)
+                    if p is None:
+                        parent_delta[pkey] = [d[0], d[1], d[2], d[3]]
+                    else:
+                        p[0] += d[0]
+                        p[1] += d[1]
+                        p[2] += d[2]
+            delta = parent_delta
+        self.schedule_render()
+        return ids
+
+    def remove(self, point_id):
+        point = self.points.pop(point_id, None)
+        if point is None:
+            return
+        lat, lon, _, world_x, world_y = point
+        for zoom in range(self.max_zoom, -1, -1):
+            grid = self.grids[zoom]
+            key = self._cell(world_x, world_y, zoom)
+            cell = grid[key]
+            cell[0] -= 1
+            cell[1] -= lat
+            cell[2] -= lon
+            if zoom == self.max_zoom:
+                cell[4].discard(point_id)
+            if cell[0] == 0:
+                del grid[key]
+            elif cell[3] == point_id:
+                cell[3] = self._any_member(zoom, key)
+        self.schedule_render()
+
+    def _children(self, zoom, key):
+        grid = self.grids[zoom + 1]
+        cx, cy = key
+        return [k for k in ((2 * cx, 2 * cy), (2 * cx + 1, 2 * cy), (2 * cx, 2 * cy + 1), (2 * cx + 1, 2 * cy + 1))
+                if k in grid]
+
+    def _any_member(self, zoom, key):
+        while zoom < self.max_zoom:
+            key = self._children(zoom, key)[0]
+            zoom += 1
+        return next(iter(self.grids[zoom][key][4]))
+
+    def clear(self):
+        for marker in self.rendered.values():
+            marker.delete()
+        self.rendered.clear()
+        self.points.clear()
+        self.grids = [{} for _ in range(self.max_zoom + 1)]
+
+    def schedule_render(self):
+        if not self.render_scheduled:
+            self.render_scheduled = True
+            self.map.after_idle(self.render)
+
+    def _visible_cells(self, level):
+        m = self.map
+        zoom = round(m.zoom)
+        # دید فعلی به مختصات پیکسلی زوم ۰، با حاشیه‌ی یک سلول برای کاهش ساخت/حذف هنگام جابه‌جایی
+        to_world = 256.0 / (1 << zoom)
+        scale = (1 << level) / self.cell_px
+        x0 = int(m.upper_left_tile_pos[0] * to_world * scale) - 1
+        y0 = int(m.upper_left_tile_pos[1] * to_world * scale) - 1
+        x1 = int(m.lower_right_tile_pos[0] * to_world * scale) + 1
+        y1 = int(m.lower_right_tile_pos[1] * to_world * scale) + 1
+        grid = self.grids[level]
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(grid):
+            return [(k, c) for k, c in grid.items() if x0 <= k[0] <= x1 and y0 <= k[1] <= y1]
+        return [((x, y), grid[(x, y)]) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1) if (x, y) in grid]
+
+    @timed("ui.cluster_render", "ui")
+    def render(self):
+        self.render_scheduled = False
+        zoom = round(self.map.zoom)
+        level = min(zoom, self.max_zoom)
+
+        wanted = {}
+        for key, cell in self._visible_cells(level):
+            if cell[0] == 1 or zoom > self.max_zoom:
+                ids = cell[4] if zoom > self.max_zoom else (cell[3],)
+                for point_id in ids:
+                    wanted[("p", point_id)] = None
+            else:
+                wanted[("c", level, key, cell[0])] = cell
+
+        for key in [k for k in self.rendered if k not in wanted]:
+            self.rendered.pop(key).delete()
+        for key, cell in wanted.items():
+            if key in self.rendered:
+                continue
+            if key[0] == "p":
+                self.rendered[key] = self._point_marker(key[1])
+            else:
+                self.rendered[key] = self._cluster_marker(level, key[2], cell)
+
+    def _point_marker(self, point_id):
+        lat, lon, text, _, _ = self.points[point_id]
+        return self.map.set_marker(
+            lat, lon, text=text,
+            command=lambda marker: self.on_marker_click and self.on_marker_click(marker, lat, lon, text)
+        )
+
+    def _cluster_marker(self, level, key, cell):
+        count = cell[0]
+        lat, lon = cell[1] / count, cell[2] / count
+        return self.map.set_marker(
+            lat, lon, text=str(count),
+            marker_color_circle="#FFFFFF", marker_color_outside="#4A90E2", text_color="#114",
+            command=lambda marker: self.expand(level, key)
+        )
+
+    def expand(self, level, key):
+        # تا زومی پایین می‌رویم که خوشه واقعاً به چند بخش تقسیم شود
+        while level < self.max_zoom:
+            children = self._children(level, key)
+            if len(children) != 1:
+                break
+            key = children[0]
+            level += 1
+        cell = self.grids[level][key]
+        self.map.fly_to(cell[1] / cell[0], cell[2] / cell[0], zoom=level + 1)
+
+
+# =========================
+# لایه‌ی چندضلعی قابل ویرایش
+# =========================
+class EditablePolygonLayer:
+    # چندضلعی مستقیم روی بوم: هر ضلع و هر رأس یک آیتم جداست، پس افزودن/جابه‌جایی/حذف رأس فقط
+    # همان چند آیتم را تغییر می‌دهد. مختصات هر رأس یک‌بار تصویر می‌شود و برای هر زوم کش می‌شود؛
+    # جابه‌جایی نقشه با یک canvas.move انجام می‌شود و فقط تغییر زوم/اندازه همه را دوباره جا می‌دهد.
+    TAG = "edit_polygon"
+
+    def __init__(self, map_widget, on_change=None, color="#FF9900", fill_color="#FFD07A", width=2):
+        self.map = map_widget
+        self.canvas = map_widget.canvas
+        self.on_change = on_change
+        self.color = color
+        self.fill_color = fill_color
+        self.width = width
+        self.points = []  # (lat, lon)
+        self.world = []  # مختصات زوم ۰ هر رأس
+        self.tile_xy = {}  # زوم -> مختصات کاشی رئوس در آن زوم
+        self.segments = []  # ضلع i از رأس i به i+1
+        self.handles = []
+        self.closing = None  # ضلع آخر به اول
+        self.band = None  # خط کشسان از رأس آخر تا ماوس و از ماوس تا رأس اول
+        self.fill = None
+        self.drawing = False
+        self.view = None  # (زوم، عرض و ارتفاع دید بر حسب کاشی، اندازه‌ی ویجت) در آخرین جاگذاری
+        self.origin = None  # upper_left_tile_pos در آخرین جاگذاری
+        self.drag_index = None
+        self.dragged = False
+        map_widget.add_view_listener(self.on_view)
+        map_widget.add_drag_handler(self)
+        self.canvas.bind("<Motion>", self._rubber_band, add="+")
+
+    # ---- تبدیل مختصات
+    def _xy(self, zoom):
+        xy = self.tile_xy.get(zoom)
+        if xy is None:
+            scale = (1 << zoom) / 256.0
+            xy = self.tile_xy[zoom] = [(x * scale, y * scale) for x, y in self.world]
+        return xy
+
+    def _transform(self):
+        m = self.map
+        zoom = round(m.zoom)
+        ul, lr = m.upper_left_tile_pos, m.lower_right_tile_pos
+        kx = m.width / (lr[0] - ul[0])
+        ky = m.height / (lr[1] - ul[1])
+        return zoom, ul, kx, ky
+
+    def _canvas_pos(self, index):
+        zoom, ul, kx, ky = self._transform()
+        tx, ty = self._xy(zoom)[index]
+        return (tx - ul[0]) * kx, (ty - ul[1]) * ky
+
+    # ---- ساخت آیتم‌ها
+    def _line(self, a, b, dash=None):
+        return self.canvas.create_line(*a, *b, fill=self.color, width=self.width, dash=dash,
+                                       capstyle="round", tags=("polygon", self.TAG))
+
+    def _handle(self, x, y):
+        r = POLYGON_HANDLE_PX
+        item = self.canvas.create_oval(x - r, y - r, x + r, y + r, fill="#FFFFFF", outline=self.color,
+                                       width=2, tags=("polygon", self.TAG, "edit_polygon_handle"))
+        return item
+
+    def _closing_coords(self):
+        return (*self._canvas_pos(len(self.points) - 1), *self._canvas_pos(0))
+
+    def _update_closing(self):
+        # ضلع بسته‌کننده فقط وقتی رسم می‌شود که حداقل سه رأس داریم؛ در حالت ترسیم خط‌چین است
+        if len(self.points) < 3:
+            if self.closing is not None:
+                self.canvas.delete(self.closing)
+                self.closing = None
+            return
+        if self.closing is None:
+            self.closing = self._line((0, 0), (0, 0))
+        self.canvas.coords(self.closing, *self._closing_coords())
+        self.canvas.itemconfigure(self.closing, dash=(4, 4) if self.drawing else "")
+        if self.fill is not None:
+            self.canvas.coords(self.fill, *self._flat_coords())
+
+    def _flat_coords(self):
+        zoom, ul, kx, ky = self._transform()
+        flat = []
+        for tx, ty in self._xy(zoom):
+            flat.append((tx - ul[0]) * kx)
+            flat.append((ty - ul[1]) * ky)
+        return flat
+
+    def _raise_handles(self):
+        self.canvas.tag_raise("edit_polygon_handle", self.TAG)
+
+    # ---- تغییر رئوس
+    def start(self):
+        self.clear()
+        self.drawing = True
+
+    def append(self, lat, lon):
+        self.points.append((lat, lon))
+        wx, wy = project_world_px(lat, lon)
+        self.world.append((wx, wy))
+        for zoom, xy in self.tile_xy.items():
+            scale = (1 << zoom) / 256.0
+            xy.append((wx * scale, wy * scale))
+        if self.view is None:
+            self._remember_view()
+        x, y = self._canvas_pos(len(self.points) - 1)
+        if len(self.points) >= 2:
+            self.segments.append(self._line(self._canvas_pos(len(self.points) - 2), (x, y)))
+        self.handles.append(self._handle(x, y))
+        self._update_closing()
+        self._raise_handles()
+        self.map.manage_z_order()
+
+    def stop(self):
+        # خروج از حالت ترسیم بدون بستن منطقه
+        self.drawing = False
+        self._hide_band()
+        if self.closing is not None:
+            self.canvas.itemconfigure(self.closing, dash="")
+
+    def finish(self):
+        self.drawing = False
+        self._hide_band()
+        if self.fill is None and len(self.points) >= 3:
+            self.fill = self.canvas.create_polygon(*self._flat_coords(), fill=self.fill_color, outline="",
+                                                   stipple="gray25", tags=("polygon", self.TAG))
+            self.canvas.tag_lower(self.fill, self.TAG)
+        self._update_closing()
+        return list(self.points)
+
+    def clear(self):
+        self.canvas.delete(self.TAG)
+        self.points.clear()
+        self.world.clear()
+        self.tile_xy.clear()
+        self.segments.clear()
+        self.handles.clear()
+        self.closing = self.band = self.fill = None
+        self.drawing = False
+        self.drag_index = None
+        self.view = self.origin = None
+
+    def move_vertex(self, index, lat, lon):
+        self.points[index] = (lat, lon)
+        wx, wy = project_world_px(lat, lon)
+        self.world[index] = (wx, wy)
+        for zoom, xy in self.tile_xy.items():
+            scale = (1 << zoom) / 256.0
+            xy[index] = (wx * scale, wy * scale)
+        self._place_vertex(index, *self._canvas_pos(index))
+
+    def _place_vertex(self, index, x, y):
+        # فقط دستگیره و دو ضلع مجاور رأس
+        r = POLYGON_HANDLE_PX
+        self.canvas.coords(self.handles[index], x - r, y - r, x + r, y + r)
+        if index > 0:
+            ax, ay, _, _ = self.canvas.coords(self.segments[index - 1])
+            self.canvas.coords(self.segments[index - 1], ax, ay, x, y)
+        if index < len(self.segments):
+            _, _, bx, by = self.canvas.coords(self.segments[index])
+            self.canvas.coords(self.segments[index], x, y, bx, by)
+        if self.closing is not None and index in (0, len(self.points) - 1):
+            x0, y0, x1, y1 = self.canvas.coords(self.closing)
+            if index == 0:
+                self.canvas.coords(self.closing, x0, y0, x, y)
+            else:
+                self.canvas.coords(self.closing, x, y, x1, y1)
+        if self.fill is not None:
+            coords = self.canvas.coords(self.fill)
+            coords[2 * index:2 * index + 2] = [x, y]
+            self.canvas.coords(self.fill, *coords)
+
+    def delete_vertex(self, index):
+        n = len(self.points)
+        del self.points[index]
+        del self.world[index]
+        for xy in self.tile_xy.values():
+            del xy[index]
+        self.canvas.delete(self.handles.pop(index))
+        # دو ضلع مجاور حذف و در صورت نیاز با یک ضلع جایگزین می‌شوند
+        if index == n - 1:
+            if self.segments:
+                self.canvas.delete(self.segments.pop())
+        elif index == 0:
+            self.canvas.delete(self.segments.pop(0))
+        else:
+            self.canvas.delete(self.segments.pop(index))
+            self.canvas.coords(self.segments[index - 1], *self._canvas_pos(index - 1), *self._canvas_pos(index))
+        if self.fill is not None:
+            if len(self.points) < 3:
+                self.canvas.delete(self.fill)
+                self.fill = None
+            else:
+                coords = self.canvas.coords(self.fill)
+                del coords[2 * index:2 * index + 2]
+                self.canvas.coords(self.fill, *coords)
+        self._update_closing()
+        self._hide_band()
+
+    # ---- جابه‌جایی و زوم نقشه
+    def _remember_view(self):
+        m = self.map
+        ul, lr = m.upper_left_tile_pos, m.lower_right_tile_pos
+        self.view = (round(m.zoom), lr[0] - ul[0], lr[1] - ul[1], m.width, m.height)
+        self.origin = ul
+
+    def on_view(self):
+        if not self.points:
+            return
+        m = self.map
+        ul, lr = m.upper_left_tile_pos, m.lower_right_tile_pos
+        view = (round(m.zoom), lr[0] - ul[0], lr[1] - ul[1], m.width, m.height)
+        if view == self.view:
+            dx = (self.origin[0] - ul[0]) * m.width / view[1]
+            dy = (self.origin[1] - ul[1]) * m.height / view[2]
+            if dx or dy:
+                self.canvas.move(self.TAG, dx, dy)
+            self.origin = ul
+            return
+        self.view, self.origin = view, ul
+        self._reposition()
+
+    def _reposition(self):
+        # بعد از تغییر زوم: مختصات کش‌شده‌ی همان زوم فقط مقیاس و انتقال می‌خورند
+        flat = self._flat_coords()
+        r = POLYGON_HANDLE_PX
+        for i, item in enumerate(self.handles):
+            x, y = flat[2 * i], flat[2 * i + 1]
+            self.canvas.coords(item, x - r, y - r, x + r, y + r)
+        for i, item in enumerate(self.segments):
+            self.canvas.coords(item, *flat[2 * i:2 * i + 4])
+        if self.closing is not None:
+            self.canvas.coords(self.closing, *flat[-2:], *flat[:2])
+        if self.fill is not None:
+            self.canvas.coords(self.fill, *flat)
+        self._hide_band()
+
+    # ---- خط کشسان
+    def _rubber_band(self, event):
+        if not self.drawing or not self.points or self.drag_index is not None:
+            return
+        last = self._canvas_pos(len(self.points) - 1)
+        coords = (*last, event.x, event.y)
+        if len(self.points) >= 2:
+            coords += self._canvas_pos(0)
+        if self.band is None:
+            self.band = self.canvas.create_line(*coords, fill=self.color, width=1, dash=(3, 3),
+                                                tags=("polygon", self.TAG))
+        else:
+            self.canvas.coords(self.band, *coords)
+
+    def _hide_band(self):
+        if self.band is not None:
+            self.canvas.delete(self.band)
+            self.band = None
+
+    # ---- کشیدن و حذف رئوس (فراخوانی از MapWidget)
+    def _hit(self, x, y):
+        r = POLYGON_HANDLE_PX + 2
+        for item in reversed(self.canvas.find_overlapping(x - r, y - r, x + r, y + r)):
+            if item in self.handles:
+                return self.handles.index(item)
+        return None
+
+    def press(self, x, y):
+        self.drag_index = self._hit(x, y) if self.handles else None
+        if self.drag_index is not None:
+            self.dragged = False
+            self._hide_band()
+            return True
+        return False
+
+    def drag(self, x, y):
+        self.dragged = True
+        self._place_vertex(self.drag_index, x, y)
+
+    def release(self, x, y):
+        index, self.drag_index = self.drag_index, None
+        if not self.dragged:
+            return
+        lat, lon = self.map.convert_canvas_coords_to_decimal_coords(x, y)
+        self.move_vertex(index, lat, lon)
+        if self.on_change:
+            self.on_change()
 
-    def clear_all_markers(self):
-        try:
-            self.delete_all_marker()
-        except Exception:
-            try:
-                self.delete_all_markers()
-            except Exception:
-                pass
+    def right_click(self, x, y):
+        index = self._hit(x, y) if self.handles else None
+        if index is None:
+            return False
+        self.delete_vertex(index)
+        if self.on_change:
+            self.on_change()
+        return True
 
 
 # =========================
 # برنامه اصلی
 # =========================
 class MapApp(ctk.CTk):
-    def __init__(self):
+    def __init__(self, mainloop=True):
         super().__init__()
         self.title(APP_TITLE)
         self.geometry("1200x750")
@@ -228,25 +4533,63 @@ class MapApp(ctk.CTk):
 
         #  داخلی
         self.input_var = ctk.StringVar()
-        self.history = load_history()  # [{label,address,lat,lon,ts}]
+        self.history_journal = HistoryJournal()
+        self.history = []  # [{label,address,lat,lon,ts}]؛ بعد از اولین فریم در پس‌زمینه پر می‌شود
+        self.history_index = PointIndex()
+        self.history_backlog = None  # [فهرست خوانده‌شده از دیسک، تعداد واردشده] تا پایان بارگذاری
+        self.history_generation = 0  # clear_all آن را زیاد می‌کند تا نتیجه‌ی بارگذاری قدیمی کنار گذاشته شود
+        self.history_ready = False
+        self.history_unmerged = set()  # id ورودی‌هایی که پیش از پایان بارگذاری افزوده شده‌اند (برای حذف تکرار)
+        self.first_frame_ms = None
+        self.startup_report = False
+        self.geocode_cache = SqliteCache(
+            CACHE_FILE, "geocode", ttl_s=GEOCODE_CACHE_TTL_S, max_entries=GEOCODE_CACHE_MAX_ENTRIES
+        )
+        self.route_cache = RouteCache(CACHE_FILE)
+        self.dispatcher = UiDispatcher(self)
+        self.geocoder = GeocodeWorker(self.dispatcher, self.get_location)
+        self.gazetteer = open_gazetteer()
+        # پیشنهاد هنگام تایپ: شاخص پیشوندی تاریخچه و نتایج کش‌شده، سپس (اختیاری) شبکه
+        # (هر دو شاخص در پس‌زمینه ساخته می‌شوند؛ تغییرات این فاصله در شاخص خالیِ فعلی ثبت و بعد ادغام می‌شوند)
+        self.history_prefix = PrefixIndex()
+        self.cache_prefix = PrefixIndex()
+        self.suggester = GeocodeWorker(self.dispatcher, fetch_suggestions, max_parallel=1)
+        # درخواست‌های مسیر با همان کلید کش مسیر (مبدأ/مقصد گرد‌شده) یکسان شمرده می‌شوند
+        self.route_worker = GeocodeWorker(
+            self.dispatcher, lambda query: self.get_route(*query), max_parallel=1,
+            key=lambda query: self.route_cache.key(*query)
+        )
+        self.suggest_after_id = None
         self.current_style = "map"
 
         # ترسیم منطقه
         self.drawing_polygon = False
-        self.polygon_points = []
-        self.polygon_object = None
+        self.finished_polygon = None  # آخرین منطقه‌ی تاییدشده
+        self.polygon_result = None  # مساحت/محیط/نقاط داخل finished_polygon
+        self.prefetcher = None
+        self.importer = None
+        self.trip_planner = None
 
         #  مسیر‌یابی
+        self.routers = make_routers()
         self.routing_mode = False
         self.route_start = None  # (lat, lon) یا None
         self.route_line = None   # شیء مسیر رسم‌شده
+        self.route_levels = None  # سطوح ساده‌شده‌ی مسیر برای زوم‌های مختلف
         self.route_start_marker = None
         self.route_end_marker = None
 
         #  تمام‌صفحه
-        self.map = MapWidget(self, on_left_click=self.on_map_click, on_mouse_move=self.on_mouse_move)
+        self.tile_store = TileStore(TILE_STORE_FILE)
+        self.map = MapWidget(
+            self, on_left_click=self.on_map_click, on_mouse_move=self.on_mouse_move, tile_store=self.tile_store
+        )
         self.map.place(relx=0.5, rely=0.5, anchor="center", relwidth=1, relheight=1)
         self.map.map_view_style(self.current_style)
+        self.map.add_zoom_listener(self.on_zoom_change)
+        self.marker_layer = MarkerClusterLayer(self.map, on_marker_click=self.show_marker_info)
+        self.polygon_layer = EditablePolygonLayer(self.map, on_change=self.on_polygon_edited)
+        self.map.add_right_click_menu_command("مکان‌های ذخیره‌شده‌ی نزدیک", self.show_nearby_history, pass_coords=True)
         self.map.set_position(35.6892, 51.3890)  # Tehran
         self.map.set_zoom(11)
 
@@ -258,6 +4601,15 @@ class MapApp(ctk.CTk):
         # کادر جست‌وجو
         self.location_entry = LocationEntry(self.side_panel, self.input_var, self.submit_location)
         self.location_entry.pack(fill="x", padx=10, pady=(10, 6))
+        self.suggestions = SuggestionList(
+            self.side_panel, self.location_entry, on_pick=self.pick_suggestion,
+            fg_color="#FFFFFF", corner_radius=8, border_width=1, border_color="#CCCCCC"
+        )
+        self.input_var.trace_add("write", self.on_input_changed)
+        self.location_entry.bind("<Down>", lambda e: self.suggestions.move(1))
+        self.location_entry.bind("<Up>", lambda e: self.suggestions.move(-1))
+        self.location_entry.bind("<Escape>", lambda e: self.suggestions.hide())
+        self.location_entry.bind("<FocusOut>", lambda e: self.after(200, self.suggestions.hide), add="+")
 
         # ردیف کنترل‌ها (پاک‌سازی، پایان/لغو چندضلعی)
         controls = ctk.CTkFrame(self.side_panel, fg_color="transparent")
@@ -289,33 +4641,41 @@ class MapApp(ctk.CTk):
         )
         self.poly_toggle.pack(fill="x", padx=10, pady=(0, 8))
 
+        # دانلود آفلاین کاشی‌های منطقه‌ی ترسیم‌شده
+        self.btn_prefetch = ctk.CTkButton(
+            self.side_panel, text="دانلود آفلاین منطقه", command=self.prefetch_polygon_tiles,
+            fg_color="#E6F2FF", hover_color="#D6E8FF", text_color="#114"
+        )
+        self.btn_prefetch.pack(fill="x", padx=10, pady=(0, 8))
+
+        # ورود فایل نقاط
+        self.btn_import = ctk.CTkButton(
+            self.side_panel, text="ورود فایل نقاط (CSV / GeoJSON)", command=self.import_points,
+            fg_color="#E6E6E6", hover_color="#D6D6D6", text_color="#222"
+        )
+        self.btn_import.pack(fill="x", padx=10, pady=(0, 8))
+
+        # سفر چندتوقفی
+        self.btn_trip = ctk.CTkButton(
+            self.side_panel, text="بهینه‌سازی سفر (نقاط داخل نقشه)", command=self.plan_trip,
+            fg_color="#E6E6E6", hover_color="#D6D6D6", text_color="#222"
+        )
+        self.btn_trip.pack(fill="x", padx=10, pady=(0, 8))
+
+        # خروجی منطقه‌ی تاییدشده و نقاط داخل آن
+        self.btn_export_polygon = ctk.CTkButton(
+            self.side_panel, text="خروجی منطقه و نقاط داخل (GeoJSON)", command=self.export_polygon,
+            fg_color="#E6E6E6", hover_color="#D6D6D6", text_color="#222"
+        )
+        self.btn_export_polygon.pack(fill="x", padx=10, pady=(0, 8))
+
         # دکمه‌های استایل
         self.style_buttons_frame = ctk.CTkFrame(self.side_panel, fg_color="transparent")
         self.style_buttons_frame.pack(fill="x", padx=10, pady=6)
         self.style_buttons_frame.grid_columnconfigure((0, 1, 2), weight=1, uniform="s")
 
-        # ساخت دکمه‌ها بر اساس TILE_STYLES
+        # خود دکمه‌ها بعد از اولین فریم ساخته می‌شوند (build_style_buttons)
         self.style_buttons = {}
-        row, col = 0, 0
-        for key, info in TILE_STYLES.items():
-            btn = ctk.CTkButton(
-                self.style_buttons_frame,
-                text=info["name"],
-                command=lambda k=key: self.change_style(k),
-                fg_color="#DBDBDB",
-                hover_color="#C9C9C9",
-                text_color="#111",
-                height=36
-            )
-            btn.grid(row=row, column=col, sticky="ew", padx=4, pady=4)
-            self.style_buttons[key] = btn
-            col += 1
-            if col > 2:
-                col = 0
-                row += 1
-
-        # هایلایت استایل فعلی
-        self.highlight_style_button(self.current_style)
 
         # کنترل‌های مسیر‌یابی
         routing_frame = ctk.CTkFrame(self.side_panel, fg_color="transparent")
@@ -335,9 +4695,11 @@ class MapApp(ctk.CTk):
         self.btn_route_clear.grid(row=0, column=1, sticky="ew", padx=4, pady=4)
 
         # لیست تاریخچه
-        self.history_frame = ctk.CTkScrollableFrame(self.side_panel, fg_color="#FFFFFF", corner_radius=8)
-        self.history_frame.pack(expand=True, fill="both", padx=10, pady=(6, 10))
-        self.refresh_history_ui()
+        self.history_list = HistoryList(
+            self.side_panel, self.history, on_select=self.jump_to_history_entry,
+            on_delete=self.delete_history_entry, fg_color="#FFFFFF", corner_radius=8
+        )
+        self.history_list.pack(expand=True, fill="both", padx=10, pady=(6, 10))
 
         # نوار وضعیت پایین
         self.status_bar = ctk.CTkFrame(self, height=34, fg_color="#F0F0F0")
@@ -346,62 +4708,286 @@ class MapApp(ctk.CTk):
         self.status_label = ctk.CTkLabel(self.status_bar, text="Lat: ---, Lon: ---", anchor="w")
         self.status_label.pack(side="left", padx=12, pady=4)
 
+        # نمایش زنده‌ی معیارهای کارایی (روشن/خاموش) و خروجی گرفتن از آن‌ها
+        self.btn_perf = ctk.CTkButton(
+            self.status_bar, text="Perf", width=48, height=24, command=self.toggle_metrics_overlay,
+            fg_color="#E6E6E6", hover_color="#D6D6D6", text_color="#222"
+        )
+        self.btn_perf.pack(side="right", padx=(0, 8), pady=4)
+
         self.center_label = ctk.CTkLabel(self.status_bar, text="Center: ---, ---", anchor="e")
         self.center_label.pack(side="right", padx=12, pady=4)
 
+        self.metrics_label = ctk.CTkLabel(self.status_bar, text="", anchor="e", font=("Consolas", 11))
+        self.btn_metrics_export = ctk.CTkButton(
+            self.status_bar, text="Export", width=56, height=24, command=self.export_metrics,
+            fg_color="#E6E6E6", hover_color="#D6D6D6", text_color="#222"
+        )
+        self.lag_monitor = EventLoopLagMonitor(self)
+        self.metrics_after_id = None
+
         # به‌روزرسانی مرکز هنگام حرکت یا زوم
         self.map.bind("<ButtonRelease-1>", lambda e: self.update_center_status())
         self.map.bind("<MouseWheel>", lambda e: self.after(50, self.update_center_status()))
         self.update_center_status()
 
         self.protocol("WM_DELETE_WINDOW", self.on_close)
-        self.mainloop()
+        self.after(0, self._on_first_frame)
+        # mainloop=False: برای اجرای خودکار (بنچمارک) که خودش حلقه‌ی رویداد را می‌چرخاند
+        if mainloop:
+            self.mainloop()
+
+    # =========================
+    # راه‌اندازی
+    # =========================
+    def _on_first_frame(self):
+        # نقشه و پنل رسم شده‌اند؛ بقیه‌ی کارهای راه‌اندازی از اینجا شروع می‌شوند
+        self.update_idletasks()
+        now = time.perf_counter()
+        METRICS.record("startup.first_frame", STARTUP_T0, now, "startup")
+        self.first_frame_ms = (now - STARTUP_T0) * 1000.0
+        self.build_style_buttons()
+        self.load_history()
+
+    def build_style_buttons(self):
+        if self.style_buttons:
+            return
+        row, col = 0, 0
+        for key, info in TILE_STYLES.items():
+            btn = ctk.CTkButton(
+                self.style_buttons_frame,
+                text=info["name"],
+                command=lambda k=key: self.change_style(k),
+                fg_color="#DBDBDB",
+                hover_color="#C9C9C9",
+                text_color="#111",
+                height=36
+            )
+            btn.grid(row=row, column=col, sticky="ew", padx=4, pady=4)
+            self.style_buttons[key] = btn
+            col += 1
+            if col > 2:
+                col = 0
+                row += 1
+
+        # هایلایت استایل فعلی
+        self.highlight_style_button(self.current_style)
+
+    def load_history(self):
+        generation = self.history_generation
+
+        def loaded(history):
+            # روی نخ بارگذاری؛ ورود به self.history روی نخ اصلی و تکه‌تکه انجام می‌شود
+            if generation == self.history_generation:
+                self.history_backlog = [history, 0]
+                self.dispatcher.post(self._ingest_history_chunk)
+
+        self.history_journal.load_async(loaded)
+
+    def _ingest_history_chunk(self):
+        # ورودی‌های قدیمی‌تر زیر ورودی‌هایی می‌روند که کاربر در همین فاصله اضافه کرده
+        backlog = self.history_backlog
+        if backlog is None:
+            return
+        history, start = backlog
+        chunk = history[start:start + HISTORY_LOAD_CHUNK]
+        backlog[1] = start + len(chunk)
+        # ورودی‌هایی که کاربر در همین فاصله افزوده هنوز با نسخه‌ی دیسک مقایسه نشده‌اند؛
+        # نسخه‌ی قدیمی‌تر دیسک می‌ماند و تکراریِ درون حافظه کنار می‌رود، مثل add_history_entry
+        if self.history_unmerged:
+            for entry in chunk:
+                dup = self.history_index.find_within(entry["lat"], entry["lon"], HISTORY_DEDUP_RADIUS_M)
+                if dup is not None and id(dup) in self.history_unmerged:
+                    self.history_unmerged.discard(id(dup))
+                    self._forget_history_entry(dup, journal=history_key(dup) != history_key(entry))
+        index = len(self.history)
+        self.history.extend(chunk)
+        for entry in chunk:
+            self.history_index.insert(entry)
+        self.history_list.inserted(index, len(chunk))
+        if backlog[1] < len(history):
+            self.after(1, self._ingest_history_chunk)
+            return
+        self.history_backlog = None
+        self._on_history_ready()
+
+    def _on_history_ready(self):
+        self.history_ready = True
+        self.history_unmerged.clear()
+        now = time.perf_counter()
+        METRICS.record("startup.history_ready", STARTUP_T0, now, "startup")
+        # شاخص پیشنهاد از کل تاریخچه ساخته می‌شود؛ افزوده‌های قبل از این لحظه هم در همین فهرست‌اند
+        self.history_prefix = PrefixIndex()
+        threading.Thread(target=self._build_suggestion_indexes, args=(list(self.history),), daemon=True).start()
+        if self.startup_report:
+            print(json.dumps({
+                "first_frame_ms": round(self.first_frame_ms, 1),
+                "history_ready_ms": round((now - STARTUP_T0) * 1000.0, 1),
+                "history": len(self.history),
+            }), flush=True)
+            self.after_idle(self.on_close)
 
     # =========================
     # جست‌وجوی مکان
     # =========================
+    @timed("net.geocode", "network")
     def get_location(self, query):
-        url = "https://nominatim.openstreetmap.org/search"
-        params = {"q": query, "format": "json", "limit": 1, "addressdetails": 1}
-        headers = {"User-Agent": "keyvan-map-app (contact: example@example.com)"}
+        # خطای شبکه بالا می‌رود تا GeocodeWorker آن را از «پیدا نشد» جدا گزارش کند
+        gazetteer = self.gazetteer
+        if gazetteer is None:
+            return geocode_query(query, cache=self.geocode_cache)
+        near = self.map.get_position()
+        if GAZETTEER_MODE == "primary":
+            return gazetteer.geocode(query, near) or geocode_query(query, cache=self.geocode_cache)
         try:
-            response = requests.get(url, params=params, headers=headers, timeout=8)
-            if response.status_code == 200:
-                data = response.json()
-                if data:
-                    lat = float(data[0]["lat"])
-                    lon = float(data[0]["lon"])
-                    address = data[0]["display_name"]
-                    return lat, lon, address
-        except Exception:
-            pass
-        return None
+            return geocode_query(query, cache=self.geocode_cache)
+        except requests.RequestException:
+            # Nominatim در دسترس نیست؛ اگر گزتیر هم چیزی نیافت همان خطای شبکه گزارش می‌شود
+            result = gazetteer.geocode(query, near)
+            if result is None:
+                raise
+            return result
 
     # =========================
     # رویدادها و منطق
     # =========================
     def submit_location(self, event=None):
+        # ردیف انتخاب‌شده با کلیدهای جهت در فهرست پیشنهاد
+        if self.suggestions.visible() and self.suggestions.active >= 0:
+            self.suggestions.pick()
+            return
         text = self.input_var.get().strip()
         if not text:
             self.location_entry.display_error()
             return
+        self.cancel_suggestions()
+        self.suggestions.hide()
+
+        # مکان‌هایی که قبلاً دیده شده‌اند بدون هیچ درخواست شبکه‌ای
+        local = self.history_prefix.exact(text) or self.cache_prefix.exact(text)
+        if local is not None:
+            self.on_location_result(text, (local["lat"], local["lon"], local["address"]))
+            return
+
+        # جست‌وجو در پس‌زمینه؛ نتیجه از طریق on_location_result برمی‌گردد
+        self.status_label.configure(text=f"در حال جست‌وجو: {text}")
+        self.geocoder.submit(text, self.on_location_result)
 
-        result = self.get_location(text)
+    def on_location_result(self, query, result, error=None):
+        if error is not None:
+            self.location_entry.display_error()
+            self.status_label.configure(text=f"خطا در ارتباط با سرویس جست‌وجو ({type(error).__name__}).")
+            return
         if not result:
             self.location_entry.display_error()
+            self.status_label.configure(text=f"مکانی برای «{query}» پیدا نشد.")
             return
 
         lat, lon, address = result
+        self.remember_suggestion(query, lat, lon, address)
         self.add_history_entry(address, lat, lon)
-        self.input_var.set("")
+        # اگر کاربر در این فاصله عبارت دیگری تایپ کرده، آن را پاک نمی‌کنیم
+        if normalize_query(self.input_var.get()) == normalize_query(query):
+            self.input_var.set("")
+        self.status_label.configure(text=address)
         self.focus_map(lat, lon, zoom=14, smooth=True)
         self.add_marker(lat, lon, address)
 
+    # =========================
+    # پیشنهاد هنگام تایپ
+    # =========================
+    def _build_suggestion_indexes(self, history, with_cache=True):
+        built_history = PrefixIndex()
+        built_history.add_many(((h["label"], h["address"]), h) for h in history)
+        built_cache = None
+        if with_cache:
+            pairs = []
+            for key, value in self.geocode_cache.items():
+                try:
+                    lat, lon, address = value
+                except (TypeError, ValueError):
+                    continue
+                item = {"label": str(address).split(",")[0], "address": address, "lat": lat, "lon": lon,
+                        "source": "cache"}
+                pairs.append(((key, address), item))
+            built_cache = PrefixIndex()
+            built_cache.add_many(pairs)
+        self.dispatcher.post(self._install_suggestion_indexes, built_history, built_cache, {id(h) for h in history})
+
+    def _install_suggestion_indexes(self, built_history, built_cache, built_ids):
+        # ورودی‌هایی که در حین ساخت حذف شده‌اند کنار گذاشته و افزوده‌های این فاصله اضافه می‌شوند؛
+        # شاخص فعلی کنار گذاشته می‌شود پس ترتیب نصب چند ساخت هم‌زمان مهم نیست
+        alive = {id(h) for h in self.history}
+        built_history.retain(lambda item: id(item) in alive)
+        built_history.add_many(((h["label"], h["address"]), h) for h in self.history if id(h) not in built_ids)
+        self.history_prefix = built_history
+        if built_cache is not None:
+            built_cache.absorb(self.cache_prefix)
+            self.cache_prefix = built_cache
+
+    def remember_suggestion(self, query, lat, lon, address):
+        if self.cache_prefix.exact(query) is None:
+            item = {"label": str(address).split(",")[0], "address": address, "lat": lat, "lon": lon, "source": "cache"}
+            self.cache_prefix.add((query, address), item)
+
+    def local_suggestions(self, text):
+        # تاریخچه اول، سپس نتایج کش و گزتیر؛ مکان‌های تکراری (مختصات یکسان) یک بار
+        found = []
+        seen = set()
+        items = self.history_prefix.search(text) + self.cache_prefix.search(text)
+        if self.gazetteer is not None and len(items) < SUGGEST_LIMIT:
+            items += self.gazetteer.search(text, near=self.map.get_position())
+        for item in items:
+            spot = (round(item["lat"], 5), round(item["lon"], 5))
+            if spot not in seen:
+                seen.add(spot)
+                found.append(item)
+        return found[:SUGGEST_LIMIT]
+
+    def on_input_changed(self, *args):
+        text = self.input_var.get().strip()
+        self.cancel_suggestions()
+        if not text:
+            self.suggestions.hide()
+            return
+        local = self.local_suggestions(text)
+        self.suggestions.show(local)
+        # پیشنهاد شبکه فقط پس از مکث در تایپ و وقتی نتایج محلی کم است
+        if SUGGEST_REMOTE_URL and len(text) >= SUGGEST_MIN_CHARS and len(local) < SUGGEST_LIMIT:
+            self.suggest_after_id = self.after(SUGGEST_DEBOUNCE_MS, lambda: self._request_suggestions(text))
+
+    def cancel_suggestions(self):
+        if self.suggest_after_id is not None:
+            self.after_cancel(self.suggest_after_id)
+            self.suggest_after_id = None
+        self.suggester.cancel()
+
+    def _request_suggestions(self, text):
+        self.suggest_after_id = None
+        self.suggester.submit(text, self.on_remote_suggestions)
+
+    def on_remote_suggestions(self, query, results, error=None):
+        if error is not None or not results:
+            return
+        if normalize_query(self.input_var.get()) != normalize_query(query):
+            return
+        items = self.local_suggestions(query)
+        seen = {(round(i["lat"], 5), round(i["lon"], 5)) for i in items}
+        for lat, lon, address in results:
+            if (round(lat, 5), round(lon, 5)) not in seen:
+                items.append({"label": address.split(",")[0], "address": address, "lat": lat, "lon": lon,
+                              "source": "remote"})
+        self.suggestions.show(items[:SUGGEST_LIMIT])
+
+    def pick_suggestion(self, item):
+        self.cancel_suggestions()
+        self.on_location_result(self.input_var.get(), (item["lat"], item["lon"], item["address"]))
+
+    @timed("ui.map_click", "ui")
     def on_map_click(self, lat, lon):
         if self.drawing_polygon:
-            self.polygon_points.append((lat, lon))
-            self.draw_polygon_preview()
-            self.status_label.configure(text=f"Polygon points: {len(self.polygon_points)}")
+            self.polygon_layer.append(lat, lon)
+            self.status_label.configure(text=f"Polygon points: {len(self.polygon_layer.points)}")
             return
 
         if self.routing_mode:
@@ -410,25 +4996,11 @@ class MapApp(ctk.CTk):
                 self._replace_route_start_marker(lat, lon)
                 self.status_label.configure(text="مبدأ انتخاب شد. مقصد را کلیک کنید.")
             else:
-                route_end = (lat, lon)
                 self._replace_route_end_marker(lat, lon)
 
-                # دریافت و رسم مسیر
-                route = self.get_route(self.route_start[0], self.route_start[1], route_end[0], route_end[1])
-                if route and route.get("points"):
-                    self.draw_route(route["points"])
-                    # گزارش کوتاه فاصله/زمان
-                    dist_km = route["distance_m"] / 1000.0
-                    dur_min = route["duration_s"] / 60.0
-                    self.status_label.configure(
-                        text=f"مسیر رسم شد - فاصله: {dist_km:.2f}km، زمان: {dur_min:.1f}min"
-                    )
-                    # فوکوس نرم روی مسیر: مرکز مسیر
-                    mid_idx = len(route["points"]) // 2
-                    self.focus_map(route["points"][mid_idx][0], route["points"][mid_idx][1], smooth=True)
-                else:
-                    self.status_label.configure(text="خطا در دریافت مسیر.")
-
+                # دریافت مسیر در پس‌زمینه (محدودیت نرخ و timeout نخ اصلی را قفل نمی‌کنند)؛ رسم در on_route_result
+                self.status_label.configure(text="در حال دریافت مسیر...")
+                self.route_worker.submit((self.route_start[0], self.route_start[1], lat, lon), self.on_route_result)
                 self.route_start = None
             return
 
@@ -437,13 +5009,95 @@ class MapApp(ctk.CTk):
         self.add_history_entry(label, lat, lon)
         self.add_marker(lat, lon, label)
 
+    def on_route_result(self, query, route, error=None):
+        if error is None and route and route.get("points"):
+            self.draw_route(route["points"])
+            # گزارش کوتاه فاصله/زمان
+            dist_km = route["distance_m"] / 1000.0
+            dur_min = route["duration_s"] / 60.0
+            self.status_label.configure(
+                text=f"مسیر رسم شد - فاصله: {dist_km:.2f}km، زمان: {dur_min:.1f}min"
+            )
+            # فوکوس نرم روی مسیر: مرکز مسیر
+            mid_idx = len(route["points"]) // 2
+            self.focus_map(route["points"][mid_idx][0], route["points"][mid_idx][1], smooth=True)
+        else:
+            self.status_label.configure(text="خطا در دریافت مسیر.")
+
     def on_mouse_move(self, lat, lon):
-        self.status_label.configure(text=f"Lat: {lat:.5f}, Lon: {lon:.5f}")
+        text = f"Lat: {lat:.5f}, Lon: {lon:.5f}"
+        # بازچینی برچسب فقط وقتی متن نمایش‌داده‌شده واقعاً عوض شده
+        if self.status_label.cget("text") != text:
+            self.status_label.configure(text=text)
+
+    def on_zoom_change(self, zoom):
+        # جایگزینی سطح جزئیات مسیر متناسب با زوم جدید (بدون ترسیم؛ نقشه خودش بازترسیم می‌کند)
+        if self.route_line is not None and self.route_levels is not None:
+            self.route_line.position_list = self.route_levels.for_zoom(zoom)
 
     def update_center_status(self):
         clat, clon = self.map.get_position()
         self.center_label.configure(text=f"Center: {clat:.5f}, {clon:.5f}")
 
+    # =========================
+    # معیارهای کارایی
+    # =========================
+    OVERLAY_METRICS = (
+        ("net.geocode", "geo"), ("net.route", "route"), ("tile.fetch", "tile"),
+        ("ui.map_click", "click"), ("ui.mouse_move", "move"), ("ui.history_refresh", "list"),
+        ("ui.loop_lag", "lag"),
+    )
+
+    def toggle_metrics_overlay(self):
+        if self.metrics_after_id is not None:
+            self.after_cancel(self.metrics_after_id)
+            self.metrics_after_id = None
+            METRICS.enabled = False
+            self.lag_monitor.stop()
+            self.metrics_label.pack_forget()
+            self.btn_metrics_export.pack_forget()
+            self.btn_perf.configure(fg_color="#E6E6E6")
+            return
+        METRICS.enabled = True
+        self.lag_monitor.start()
+        self.btn_metrics_export.pack(side="right", padx=(0, 6), pady=4)
+        self.metrics_label.pack(side="right", padx=6, pady=4)
+        self.btn_perf.configure(fg_color="#B9D7F5")
+        self.update_metrics_overlay()
+
+    def update_metrics_overlay(self):
+        # میانه/صدک ۹۵ هر معیار به میلی‌ثانیه
+        parts = []
+        for name, short in self.OVERLAY_METRICS:
+            p50, p95 = METRICS.percentiles(name, 50, 95)
+            if p95:
+                parts.append(f"{short} {p50:.0f}/{p95:.0f}")
+        text = " | ".join(parts) + " ms" if parts else "در حال جمع‌آوری..."
+        # حافظه‌ی کاشی‌های رمزگشایی‌شده و نرخ برخورد استخر استایل فعلی
+        pools = self.map.tile_pools.stats()
+        rate = pools["styles"].get(self.map.style_key, {}).get("hit_rate")
+        text += f" | tiles {pools['bytes'] / 2 ** 20:.0f}MB"
+        if rate is not None:
+            text += f" hit {rate:.0%}"
+        self.metrics_label.configure(text=text)
+        self.metrics_after_id = self.after(METRICS_OVERLAY_MS, self.update_metrics_overlay)
+
+    def export_metrics(self):
+        path = filedialog.asksaveasfilename(
+            title="خروجی معیارها", defaultextension=".json", initialfile="metrics.json",
+            filetypes=[("Metrics JSON", "*.json"), ("Chrome trace", "*.trace.json")]
+        )
+        if not path:
+            return
+        try:
+            if path.endswith(".trace.json"):
+                METRICS.export_chrome_trace(path)
+            else:
+                METRICS.export_json(path, extra={"tile_pools": self.map.tile_pools.stats()})
+            self.status_label.configure(text=f"معیارها ذخیره شد: {os.path.basename(path)}")
+        except OSError as e:
+            self.status_label.configure(text=f"خطا در ذخیره‌ی معیارها: {e}")
+
     # =========================
     # استایل‌ها
     # =========================
@@ -465,62 +5119,142 @@ class MapApp(ctk.CTk):
     def add_history_entry(self, address, lat, lon):
         label = address.split(",")[0] if address else f"{lat:.5f}, {lon:.5f}"
         entry = {"label": label, "address": address, "lat": lat, "lon": lon, "ts": timestamp()}
-        # جلوگیری از تکرار دقیق
-        if not any(abs(h["lat"] - lat) < 1e-7 and abs(h["lon"] - lon) < 1e-7 for h in self.history):
+        # جلوگیری از تکرار: نقطه‌ای در شعاع HISTORY_DEDUP_RADIUS_M از قبل ذخیره نشده باشد
+        if self.history_index.find_within(lat, lon, HISTORY_DEDUP_RADIUS_M) is None:
             self.history.insert(0, entry)
-            save_history(self.history)
-            self.add_history_row(entry)
+            self.history_index.insert(entry)
+            if not self.history_ready:
+                self.history_unmerged.add(id(entry))
+            self.history_prefix.add((entry["label"], entry["address"]), entry)
+            self.history_journal.add(entry)
+            self.history_journal.maybe_compact(self.history)
+            self.history_list.inserted(0)
         else:
             self.refresh_history_ui()
 
-    def add_history_row(self, entry):
-        frame = ctk.CTkFrame(self.history_frame, fg_color="#FFFFFF", corner_radius=6)
-        frame.pack(fill="x", pady=4, padx=6)
-
-        def jump():
-            self.focus_map(entry["lat"], entry["lon"], zoom=14, smooth=True)
-            self.add_marker(entry["lat"], entry["lon"], entry["address"])
-
-        btn = ctk.CTkButton(
-            frame, text=entry["label"], command=jump,
-            font=ctk.CTkFont(family="Tahoma", size=14),
-            anchor="w", fg_color="transparent", hover_color="#ECECEC", text_color="#222"
-        )
-        btn.pack(side="left", fill="x", expand=True, padx=2, pady=2)
+    def show_nearby_history(self, coords):
+        lat, lon = coords
+        nearby = self.history_index.nearest(lat, lon)
+        if not nearby:
+            self.status_label.configure(text="مکان ذخیره‌شده‌ای در این اطراف نیست.")
+            return
+        parts = []
+        for d, entry in nearby:
+            dist = f"{d:.0f}m" if d < 1000 else f"{d / 1000:.1f}km"
+            parts.append(f"{entry['label']} ({dist})")
+        self.status_label.configure(text=" | ".join(parts))
 
-        del_btn = ctk.CTkButton(
-            frame, text="✕", command=lambda: self.delete_history_entry(entry, frame),
-            width=34, fg_color="transparent", hover_color="#F8D7DA", text_color="#900"
-        )
-        del_btn.pack(side="right", padx=2, pady=2)
+    def jump_to_history_entry(self, entry):
+        self.focus_map(entry["lat"], entry["lon"], zoom=14, smooth=True)
+        self.add_marker(entry["lat"], entry["lon"], entry["address"])
 
     def refresh_history_ui(self):
-        for child in self.history_frame.winfo_children():
-            child.destroy()
-        for entry in self.history:
-            self.add_history_row(entry)
+        self.history_list.refresh()
+
+    def delete_history_entry(self, entry):
+        self._forget_history_entry(entry)
 
-    def delete_history_entry(self, entry, frame_widget):
+    def _forget_history_entry(self, entry, journal=True):
+        # journal=False وقتی ورودی دیگری با همان کلید جایش را می‌گیرد (حذف در ژورنال هر دو را پاک می‌کرد)
         try:
-            self.history.remove(entry)
+            index = self.history.index(entry)
         except ValueError:
-            pass
-        save_history(self.history)
+            return
+        del self.history[index]
+        self.history_index.remove(entry)
+        self.history_unmerged.discard(id(entry))
+        self.history_prefix.remove((entry["label"], entry["address"]), entry)
+        if journal:
+            self.history_journal.delete(entry)
+            self.history_journal.maybe_compact(self.history)
+        self.history_list.removed(index)
+
+    def import_points(self):
+        if self.importer is not None:
+            self.importer.cancel()
+            self.status_label.configure(text="ورود فایل متوقف شد.")
+            return
+        path = filedialog.askopenfilename(
+            title="ورود فایل نقاط",
+            filetypes=[("CSV / GeoJSON", "*.csv *.tsv *.txt *.geojson *.json *.geojsonl *.ndjson"), ("All files", "*.*")]
+        )
+        if not path:
+            return
+        self.importer = PointImporter(path)
+        self.import_added = 0
+        self.import_duplicates = 0
+        self.btn_import.configure(text="توقف ورود فایل")
+        self.importer.start()
+        self.after(IMPORT_TICK_MS, self._import_tick)
+
+    def _import_tick(self):
+        # در هر تیک حداکثر یک دسته تا رابط کاربری پاسخ‌گو بماند
+        importer = self.importer
+        if importer is None:
+            return
         try:
-            frame_widget.destroy()
-        except Exception:
-            pass
+            batch = importer.next_batch()
+        except queue.Empty:
+            batch = ()
+        if batch is None or importer.cancelled.is_set():
+            self._finish_import(importer)
+            return
+        if batch:
+            self._apply_import_batch(batch)
+        self.status_label.configure(
+            text=f"ورود: {self.import_added} نقطه ({self.import_duplicates} تکراری، {importer.rejected} نامعتبر)"
+        )
+        self.after(IMPORT_TICK_MS, self._import_tick)
+
+    def _apply_import_batch(self, batch):
+        added = []
+        for entry in batch:
+            if self.history_index.find_within(entry["lat"], entry["lon"], HISTORY_DEDUP_RADIUS_M) is None:
+                self.history_index.insert(entry)
+                added.append(entry)
+                if not self.history_ready:
+                    self.history_unmerged.add(id(entry))
+        self.import_duplicates += len(batch) - len(added)
+        if not added:
+            return
+        self.history[0:0] = reversed(added)  # جدیدترین‌ها بالای فهرست، مثل افزودن تکی
+        # شاخص پیشنهاد در پایان ورود یک بار در پس‌زمینه بازسازی می‌شود (_finish_import)
+        self.history_journal.add_many(added)
+        self.history_journal.maybe_compact(self.history)
+        self.history_list.inserted(0, len(added))
+        self.marker_layer.add_many((e["lat"], e["lon"], e["address"]) for e in added)
+        self.import_added += len(added)
+
+    def _finish_import(self, importer):
+        self.importer = None
+        if self.import_added:
+            threading.Thread(target=self._build_suggestion_indexes, args=(list(self.history), False),
+                             daemon=True).start()
+        self.btn_import.configure(text="ورود فایل نقاط (CSV / GeoJSON)")
+        if importer.error is not None:
+            text = f"خطا در خواندن فایل: {importer.error}"
+        else:
+            text = (f"ورود تمام شد: {self.import_added} نقطه‌ی جدید، "
+                    f"{self.import_duplicates} تکراری، {importer.rejected} نامعتبر.")
+        self.status_label.configure(text=text)
 
     def clear_all(self):
         # پاک‌سازی مارکرها
+        self.marker_layer.clear()
         self.map.clear_all_markers()
 
-        # پاک‌سازی تاریخچه
+        # پاک‌سازی تاریخچه (و کنار گذاشتن بارگذاری نیمه‌کاره)
+        self.history_generation += 1
+        self.history_backlog = None
         self.history.clear()
-        save_history(self.history)
+        self.history_index.clear()
+        self.history_prefix.clear()
+        self.history_journal.clear()
         self.refresh_history_ui()
+        if not self.history_ready:
+            self._on_history_ready()
 
-        # پاک‌سازی چندضلعی و مسیر
+        # پاک‌سازی چندضلعی و مسیر (مسیرِ در راه هم دیگر رسم نمی‌شود)
         self.cancel_polygon()
         self.clear_route()
 
@@ -528,23 +5262,22 @@ class MapApp(ctk.CTk):
     # مارکرها و فوکوس
     # =========================
     def add_marker(self, lat, lon, text=None):
-        m = self.map.set_marker(
-            lat, lon, text=text or f"{lat:.5f}, {lon:.5f}",
-            command=lambda marker: self.show_marker_info(marker, lat, lon, text)
-        )
-        return m
+        # مارکرها از طریق لایه‌ی خوشه‌بندی رسم می‌شوند؛ خروجی شناسه‌ی نقطه در لایه است
+        return self.marker_layer.add(lat, lon, text or f"{lat:.5f}, {lon:.5f}")
 
     def show_marker_info(self, marker, lat, lon, text):
         info = f"{text or '-'}\n{lat:.6f}, {lon:.6f}"
         self.status_label.configure(text=info)
 
     def focus_map(self, lat, lon, zoom=None, smooth=True):
+        if smooth:
+            # زوم و جابه‌جایی در یک انیمیشن؛ بارگذاری کاشی‌ها تا پایان حرکت عقب می‌افتد
+            self.map.fly_to(lat, lon, zoom=zoom, duration_ms=400, on_done=self.update_center_status)
+            return
+        self.map.animator.cancel()
         if zoom is not None:
             self.map.set_zoom(zoom)
-        if smooth:
-            self.map.animate_to(lat, lon, duration_ms=400, steps=24)
-        else:
-            self.map.set_position(lat, lon)
+        self.map.set_position(lat, lon)
         self.update_center_status()
 
     # =========================
@@ -557,62 +5290,158 @@ class MapApp(ctk.CTk):
 
         self.drawing_polygon = not self.drawing_polygon
         if self.drawing_polygon:
-            self.polygon_points.clear()
+            self.finished_polygon = None
+            self.polygon_result = None
+            self.polygon_layer.start()
             self.poly_toggle.configure(text="روشن : ترسیم منطقه", fg_color="#DFF0D8", text_color="#063")
             self.status_label.configure(text="Polygon mode: click to add points. Finish/Cancel to complete.")
         else:
+            self.polygon_layer.stop()
             self.poly_toggle.configure(text="خاموش : ترسیم منطقه", fg_color="#E6E6E6", text_color="#222")
             self.status_label.configure(text="Lat: ---, Lon: ---")
 
-    def draw_polygon_preview(self):
-        if self.polygon_object:
-            try:
-                self.map.delete(self.polygon_object)
-            except Exception:
-                pass
-            self.polygon_object = None
-
-        if len(self.polygon_points) >= 2:
-            self.polygon_object = self.map.set_polygon(
-                self.polygon_points,
-                outline_color="#FF9900",
-                fill_color="",
-                border_width=2
-            )
-
     def finish_polygon(self):
-        if self.drawing_polygon and len(self.polygon_points) >= 3:
-            if self.polygon_object:
-                try:
-                    self.map.delete(self.polygon_object)
-                except Exception:
-                    pass
-                self.polygon_object = None
-
-            self.polygon_object = self.map.set_polygon(
-                self.polygon_points,
-                outline_color="#FF9900",
-                fill_color="#FFD07A",
-                border_width=2
-            )
-
-            self.status_label.configure(text=f"Polygon completed with {len(self.polygon_points)} points.")
+        if self.drawing_polygon and len(self.polygon_layer.points) >= 3:
+            self.finished_polygon = self.polygon_layer.finish()
+            self.analyze_finished_polygon()
             self.drawing_polygon = False
             self.poly_toggle.configure(text="خاموش : ترسیم منطقه", fg_color="#E6E6E6", text_color="#222")
         else:
             self.status_label.configure(text="Polygon needs at least 3 points to finish.")
 
+    def on_polygon_edited(self):
+        # کشیدن یا حذف رأس (کلیک راست) روی منطقه‌ی در حال ترسیم یا تاییدشده
+        points = self.polygon_layer.points
+        if self.drawing_polygon:
+            self.status_label.configure(text=f"Polygon points: {len(points)}")
+        elif len(points) >= 3:
+            self.finished_polygon = list(points)
+            self.analyze_finished_polygon()
+        else:
+            self.finished_polygon = None
+            self.polygon_result = None
+            self.status_label.configure(text="منطقه کمتر از سه رأس دارد.")
+
+    def analyze_finished_polygon(self):
+        try:
+            result = analyze_polygon(self.finished_polygon, self.history)
+        except ImportError:
+            self.polygon_result = None
+            self.status_label.configure(
+                text=f"Polygon completed with {len(self.finished_polygon)} points. (برای مساحت numpy را نصب کنید)"
+            )
+            return
+        self.polygon_result = result
+        area = result["area_m2"]
+        area_text = f"{area / 1e6:.3f} km²" if area >= 1e5 else f"{area:.0f} m²"
+        perimeter = result["perimeter_m"]
+        perimeter_text = f"{perimeter / 1000:.2f} km" if perimeter >= 1000 else f"{perimeter:.0f} m"
+        self.status_label.configure(
+            text=f"مساحت: {area_text} | محیط: {perimeter_text} | نقاط ذخیره‌شده‌ی داخل: {len(result['inside'])}"
+        )
+
+    def export_polygon(self):
+        if not self.finished_polygon:
+            self.status_label.configure(text="ابتدا یک منطقه ترسیم و تایید کنید.")
+            return
+        # تاریخچه ممکن است بعد از بستن منطقه تغییر کرده باشد
+        self.analyze_finished_polygon()
+        if self.polygon_result is None:
+            return
+        path = filedialog.asksaveasfilename(
+            title="خروجی منطقه", defaultextension=".geojson", initialfile="area.geojson",
+            filetypes=[("GeoJSON", "*.geojson *.json")]
+        )
+        if not path:
+            return
+        try:
+            export_polygon_geojson(path, self.finished_polygon, self.polygon_result)
+            self.status_label.configure(
+                text=f"منطقه و {len(self.polygon_result['inside'])} نقطه ذخیره شد: {os.path.basename(path)}"
+            )
+        except OSError as e:
+            self.status_label.configure(text=f"خطا در ذخیره‌ی فایل: {e}")
+
     def cancel_polygon(self):
         self.drawing_polygon = False
-        self.polygon_points.clear()
-        if self.polygon_object:
-            try:
-                self.map.delete(self.polygon_object)
-            except Exception:
-                pass
-            self.polygon_object = None
+        self.finished_polygon = None
+        self.polygon_result = None
+        self.polygon_layer.clear()
         self.poly_toggle.configure(text="خاموش : ترسیم منطقه", fg_color="#E6E6E6", text_color="#222")
 
+    # =========================
+    # دانلود آفلاین کاشی‌ها
+    # =========================
+    def prefetch_polygon_tiles(self):
+        # دکمه در حین دانلود نقش «توقف» را دارد
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+            self.status_label.configure(text="در حال توقف دانلود...")
+            return
+
+        if self.finished_polygon:
+            zoom_range = ctk.CTkInputDialog(
+                title="دانلود آفلاین", text="بازه‌ی زوم را وارد کنید (مثلاً 12-16):"
+            ).get_input()
+            try:
+                min_zoom, max_zoom = sorted(int(z) for z in zoom_range.replace(" ", "").split("-"))
+            except (AttributeError, ValueError):
+                self.status_label.configure(text="بازه‌ی زوم نامعتبر است.")
+                return
+            min_zoom, max_zoom = max(min_zoom, 0), min(max_zoom, 19)
+            prefetcher = TilePrefetcher(
+                self.tile_store, self.current_style, self.finished_polygon, min_zoom, max_zoom
+            )
+        else:
+            # ادامه‌ی دانلودی که نیمه‌کاره مانده بود
+            job = self.tile_store.get_meta(TilePrefetcher.JOB_META)
+            if not job:
+                self.status_label.configure(text="ابتدا یک منطقه ترسیم و تایید کنید.")
+                return
+            prefetcher = TilePrefetcher.from_job(self.tile_store, job)
+
+        count, size = prefetcher.estimate()
+        if count > PREFETCH_MAX_TILES:
+            self.status_label.configure(text=f"تعداد کاشی‌ها ({count}) بیش از حد مجاز است؛ بازه‌ی زوم را کم کنید.")
+            return
+        # دانلودی بزرگ‌تر از سقف انبار، کاشی‌های خودش را با LRU بیرون می‌اندازد
+        if size > self.tile_store.max_bytes:
+            self.status_label.configure(
+                text=f"حجم تقریبی ({size / 1_048_576:.0f} MB) از سقف انبار کاشی "
+                     f"({self.tile_store.max_bytes / 1_048_576:.0f} MB) بیشتر است؛ بازه‌ی زوم یا منطقه را کوچک کنید."
+            )
+            return
+        style_name = TILE_STYLES[prefetcher.style_key]["name"]
+        if not messagebox.askyesno(
+            "دانلود آفلاین",
+            f"{count} کاشی ({size / 1_048_576:.1f} MB تقریبی)\n"
+            f"استایل {style_name}، زوم {prefetcher.min_zoom} تا {prefetcher.max_zoom}\nشروع شود؟"
+        ):
+            return
+
+        self.prefetcher = prefetcher
+        self.btn_prefetch.configure(text="توقف دانلود")
+        prefetcher.start(
+            on_progress=lambda *args: self.dispatcher.post(self.on_prefetch_progress, *args),
+            on_done=lambda p: self.dispatcher.post(self.on_prefetch_done, p)
+        )
+
+    def on_prefetch_progress(self, done, total, downloaded_bytes):
+        self.status_label.configure(
+            text=f"دانلود کاشی: {done}/{total} ({downloaded_bytes / 1_048_576:.1f} MB)"
+        )
+
+    def on_prefetch_done(self, prefetcher):
+        self.prefetcher = None
+        self.btn_prefetch.configure(text="دانلود آفلاین منطقه")
+        if prefetcher.cancelled.is_set():
+            self.status_label.configure(text=f"دانلود متوقف شد ({prefetcher.done}/{prefetcher.total}).")
+        else:
+            self.status_label.configure(
+                text=f"دانلود تمام شد: {prefetcher.done - prefetcher.skipped} جدید، "
+                     f"{prefetcher.skipped} موجود، {prefetcher.failed} ناموفق."
+            )
+
     # =========================
     # مسیر‌یابی
     # =========================
@@ -633,15 +5462,18 @@ class MapApp(ctk.CTk):
             self.btn_route_toggle.configure(text="خاموش : مسیریابی", fg_color="#E6E6E6", text_color="#222")
             self.status_label.configure(text="Lat: ---, Lon: ---")
             self.route_start = None
+            self.route_worker.cancel()  # مسیرِ در راه بعد از خاموش شدن رسم نمی‌شود
 
     def clear_route(self):
-        # حذف خط مسیر
+        # حذف خط مسیر (و کنار گذاشتن مسیری که هنوز در حال دریافت است)
+        self.route_worker.cancel()
         if self.route_line:
             try:
                 self.map.delete(self.route_line)
             except Exception:
                 pass
             self.route_line = None
+        self.route_levels = None
 
         if self.route_start_marker:
             try:
@@ -683,25 +5515,89 @@ class MapApp(ctk.CTk):
         except Exception:
             self.route_end_marker = None
 
+    @timed("net.route", "network")
     def get_route(self, start_lat, start_lon, end_lat, end_lon):
-        url = f"https://router.project-osrm.org/route/v1/driving/{start_lon},{start_lat};{end_lon},{end_lat}"
-        params = {"overview": "full", "geometries": "geojson"}
-        try:
-            r = requests.get(url, params=params, timeout=10)
-            if r.status_code == 200:
-                data = r.json()
-                if not data.get("routes"):
-                    return None
-                route0 = data["routes"][0]
-                coords = route0["geometry"]["coordinates"]
-                points = [(lat, lon) for lon, lat in coords]
-                distance_m = float(route0.get("distance", 0.0))
-                duration_s = float(route0.get("duration", 0.0))
-                return {"points": points, "distance_m": distance_m, "duration_s": duration_s}
-        except Exception:
-            pass
+        cached = self.route_cache.get(start_lat, start_lon, end_lat, end_lon)
+        if cached:
+            return cached
+
+        route = self.fetch_route(start_lat, start_lon, end_lat, end_lon)
+        if route:
+            self.route_cache.put(start_lat, start_lon, end_lat, end_lon, route)
+            return route
+
+        # بدون اینترنت: نسخه‌ی منقضی‌شده‌ی کش بهتر از هیچ است
+        return self.route_cache.get(start_lat, start_lon, end_lat, end_lon, allow_stale=True)
+
+    def fetch_route(self, start_lat, start_lon, end_lat, end_lon):
+        # موتورها به ترتیب امتحان می‌شوند؛ خطای یکی (بیرون از گراف، قطع شبکه) نوبت را به بعدی می‌دهد
+        for router in self.routers:
+            try:
+                return router.route([(start_lat, start_lon), (end_lat, end_lon)])
+            except (requests.RequestException, ValueError, KeyError):
+                continue
         return None
 
+    def visible_history(self):
+        # ورودی‌های تاریخچه‌ای که در محدوده‌ی فعلی نقشه دیده می‌شوند
+        zoom = round(self.map.zoom)
+        north, west = tkintermapview.osm_to_decimal(*self.map.upper_left_tile_pos, zoom)
+        south, east = tkintermapview.osm_to_decimal(*self.map.lower_right_tile_pos, zoom)
+        return [h for h in self.history if south <= h["lat"] <= north and west <= h["lon"] <= east]
+
+    def plan_trip(self):
+        if self.trip_planner is not None:
+            self.trip_planner.cancel()
+            self.status_label.configure(text="بهینه‌سازی سفر متوقف شد.")
+            return
+        # توقف‌ها: نقاط تاریخچه در دید فعلی (جدیدترین اول، مبدأ = جدیدترین)؛ در غیر این صورت کل تاریخچه
+        entries = self.visible_history()
+        if len(entries) < 2:
+            entries = self.history
+        entries = entries[:TRIP_MAX_STOPS]
+        if len(entries) < 2:
+            self.status_label.configure(text="برای سفر چندتوقفی حداقل دو نقطه در تاریخچه لازم است.")
+            return
+
+        stops = [(h["lat"], h["lon"]) for h in entries]
+        planner = self.trip_planner = TripPlanner(CACHE_FILE)
+        self.btn_trip.configure(text="توقف بهینه‌سازی")
+        self.status_label.configure(text=f"بهینه‌سازی سفر با {len(stops)} توقف...")
+
+        def work():
+            # هر خطای پیش‌بینی‌نشده (پاسخ خراب OSRM، اشکال در حل‌کننده) هم باید دکمه را آزاد کند
+            route = None
+            try:
+                route = planner.plan(
+                    stops, on_progress=lambda done, total: self.dispatcher.post(self.on_trip_progress, done, total)
+                )
+            except Exception:
+                self.dispatcher.post(self.report_callback_exception, *sys.exc_info())
+            finally:
+                planner.close()
+            self.dispatcher.post(self.on_trip_done, planner, route)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def on_trip_progress(self, done, total):
+        self.status_label.configure(text=f"دریافت ماتریس فاصله: {done}/{total}")
+
+    def on_trip_done(self, planner, route):
+        if planner is not self.trip_planner:
+            return
+        self.trip_planner = None
+        self.btn_trip.configure(text="بهینه‌سازی سفر (نقاط داخل نقشه)")
+        if planner.cancelled:
+            return
+        if not route or not route.get("points"):
+            self.status_label.configure(text="خطا در بهینه‌سازی سفر.")
+            return
+        self.draw_route(route["points"])
+        self.status_label.configure(
+            text=f"سفر {len(route['order'])} توقف - فاصله: {route['distance_m'] / 1000.0:.2f}km، "
+                 f"زمان: {route['duration_s'] / 60.0:.1f}min"
+        )
+
     def draw_route(self, points):
         # حذف مسیر قبلی
         if self.route_line:
@@ -710,18 +5606,23 @@ class MapApp(ctk.CTk):
             except Exception:
                 pass
             self.route_line = None
+        self.route_levels = None
 
         if not points:
             return
 
+        # فقط رئوس قابل‌مشاهده در زوم فعلی به نقشه داده می‌شوند
+        self.route_levels = PolylineLevels(points)
+        visible_points = self.route_levels.for_zoom(self.map.zoom)
+
         try:
-            self.route_line = self.map.set_path(points, color="#FF3333", width=3)
+            self.route_line = self.map.set_path(visible_points, color="#FF3333", width=3)
             return
         except Exception:
             self.route_line = None
 
         try:
-            self.route_line = self.map.set_polygon(points, outline_color="#FF3333", fill_color="", border_width=3)
+            self.route_line = self.map.set_polygon(visible_points, outline_color="#FF3333", fill_color="", border_width=3)
         except Exception:
             self.route_line = None
 
@@ -729,9 +5630,125 @@ class MapApp(ctk.CTk):
     # پایان برنامه
     # =========================
     def on_close(self):
-        save_history(self.history)
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+        if self.importer is not None:
+            self.importer.cancel()
+        if self.trip_planner is not None:
+            self.trip_planner.cancel()
+        # بخشی از تاریخچه که هنوز وارد برنامه نشده نباید با snapshot ناقص از دست برود
+        self.history_journal.wait_loaded()
+        backlog, self.history_backlog = self.history_backlog, None
+        if backlog is not None:
+            self.history.extend(backlog[0][backlog[1]:])
+        self.history_journal.close(self.history)
+        self.geocode_cache.close()
+        self.route_cache.close()
+        for router in self.routers:
+            router.close()
+        if self.gazetteer is not None:
+            self.gazetteer.close()
+        self.tile_store.close()
         self.destroy()
 
 
+# =========================
+# خط فرمان
+# =========================
+def run_batch_geocode(args):
+    cache = None if args.no_cache else SqliteCache(
+        CACHE_FILE, "geocode", ttl_s=GEOCODE_CACHE_TTL_S, max_entries=GEOCODE_CACHE_MAX_ENTRIES
+    )
+    batch = BatchGeocoder(args.output, cache=cache, workers=args.workers, rate_per_s=args.rate,
+                          retries=args.retries, backoff_s=args.backoff)
+    last = [0.0]
+
+    def progress(counts):
+        now = time.monotonic()
+        if now - last[0] >= 1.0:
+            last[0] = now
+            print(f"\rok={counts['ok']} not_found={counts['not_found']} error={counts['error']} "
+                  f"resumed={counts['resumed']}", end="", file=sys.stderr, flush=True)
+
+    try:
+        summary = batch.run(iter_queries(args.input), on_progress=None if args.quiet else progress)
+    except KeyboardInterrupt:
+        print("\ninterrupted; rerun the same command to resume", file=sys.stderr)
+        return 130
+    finally:
+        if cache is not None:
+            cache.close()
+    if not args.quiet:
+        print(file=sys.stderr)
+    print(json.dumps(summary, ensure_ascii=False))
+    return 0 if summary["error"] == 0 else 1
+
+
+def run_build_graph(args):
+    start = time.perf_counter()
+    meta = build_road_graph(args.input, args.output)
+    meta["build_s"] = round(time.perf_counter() - start, 2)
+    meta["bytes"] = os.path.getsize(args.output)
+    print(json.dumps(meta, ensure_ascii=False))
+    return 0
+
+
+def run_build_gazetteer(args):
+    start = time.perf_counter()
+    meta = build_gazetteer(args.input, args.output)
+    meta["build_s"] = round(time.perf_counter() - start, 2)
+    meta["bytes"] = os.path.getsize(args.output)
+    print(json.dumps(meta, ensure_ascii=False))
+    return 0
+
+
+def positive_float(value):
+    # نوع آرگومان: نرخ صفر یا منفی در TokenBucket به تقسیم بر صفر یا انتظار بی‌پایان می‌رسد
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number: {value!r}")
+    if not number > 0 or math.isinf(number):
+        raise argparse.ArgumentTypeError(f"must be a positive number: {value!r}")
+    return number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="mapviewer.py", description=APP_TITLE)
+    commands = parser.add_subparsers(dest="command")
+
+    geocode = commands.add_parser("geocode", help="batch-geocode a file of address queries")
+    geocode.add_argument("input", help="text file (one query per line) or CSV with a query/address column")
+    geocode.add_argument("-o", "--output", required=True, help="results file (.csv or .jsonl); resumed if it exists")
+    geocode.add_argument("-w", "--workers", type=int, default=GEOCODE_BATCH_WORKERS)
+    geocode.add_argument("--rate", type=positive_float, default=GEOCODE_RATE_PER_S, help="max requests per second (global)")
+    geocode.add_argument("--retries", type=int, default=GEOCODE_RETRIES)
+    geocode.add_argument("--backoff", type=float, default=GEOCODE_BACKOFF_S, help="base retry delay in seconds")
+    geocode.add_argument("--no-cache", action="store_true", help=f"do not read/write {CACHE_FILE}")
+    geocode.add_argument("-q", "--quiet", action="store_true")
+    geocode.set_defaults(func=run_batch_geocode)
+
+    graph = commands.add_parser("build-graph", help="build an offline road graph from an OSM XML extract")
+    graph.add_argument("input", help="OSM XML extract (.osm, .osm.gz or .osm.bz2)")
+    graph.add_argument("-o", "--output", default=OFFLINE_GRAPH_FILE)
+    graph.set_defaults(func=run_build_graph)
+
+    gazetteer = commands.add_parser("build-gazetteer", help="build an offline place index from an OSM XML extract")
+    gazetteer.add_argument("input", help="OSM XML extract (.osm, .osm.gz or .osm.bz2)")
+    gazetteer.add_argument("-o", "--output", default=GAZETTEER_FILE)
+    gazetteer.set_defaults(func=run_build_gazetteer)
+
+    parser.add_argument("--startup-report", action="store_true",
+                        help="print startup timings as JSON once history is loaded, then exit")
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        app = MapApp(mainloop=False)
+        app.startup_report = args.startup_report
+        app.mainloop()
+        return 0
+    return args.func(args)
+
+
 if __name__ == "__main__":
-    MapApp()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file